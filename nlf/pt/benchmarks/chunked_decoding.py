@@ -0,0 +1,73 @@
+"""Measures the time and peak memory of decoding many points with shared weights
+(LocalizerHead.apply_weights3d_same_canonicals_impl) with various decoding memory budgets,
+and checks that the chunked results match the unchunked ones.
+
+The head is built from the same flags as for training and save_model.py. The features and
+weights are random, which does not affect speed or memory. Run for example as:
+    python -m nlf.pt.benchmarks.chunked_decoding --device=cpu --proc-side=384 ...
+"""
+
+import argparse
+
+import torch
+from simplepyutils import FLAGS, logger
+
+import nlf.pt.init as init
+import nlf.pt.models.field as pt_field
+import nlf.pt.models.nlf_model as pt_nlf_model
+from nlf.pt.benchmarks.util import measure_time
+from nlf.pt.multiperson.instrumentation import StageProfiler
+
+
+def initialize():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--compute-dtype', type=str, default='float32')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--num-points', type=int, default=10475)
+    parser.add_argument('--budgets-mb', type=int, nargs='+', default=(0, 4096, 1024, 256))
+    parser.add_argument('--repeat', type=int, default=3)
+    init.initialize(parent_parser=parser)
+
+
+def main():
+    initialize()
+    device = torch.device(FLAGS.device)
+    dtype = getattr(torch, FLAGS.compute_dtype)
+    torch.manual_seed(0)
+
+    head = pt_nlf_model.LocalizerHead(pt_field.build_field(), torch.nn.BatchNorm2d)
+    side = FLAGS.proc_side // FLAGS.stride_test
+    c = FLAGS.backbone_link_dim
+    n_out_channels = 2 + FLAGS.depth
+    features = torch.randn(FLAGS.batch_size, c, side, side, device=device, dtype=dtype)
+    w_tensor = torch.randn(FLAGS.num_points, n_out_channels, c, device=device, dtype=dtype)
+    w_tensor /= c**0.5
+    b_tensor = torch.zeros(FLAGS.num_points, n_out_channels, device=device, dtype=dtype)
+
+    def decode():
+        return head.apply_weights3d_same_canonicals_impl(features, w_tensor, b_tensor)
+
+    reference = None
+    for budget in FLAGS.budgets_mb:
+        head.decode_memory_budget_mb = budget
+        crop_chunk_size, point_chunk_size = head.decode_chunk_sizes(
+            FLAGS.batch_size, FLAGS.num_points, side * side, features.element_size()
+        )
+        profiler = StageProfiler()
+        result = profiler(decode)
+        peak_mb = profiler.stats['total']['peak_memory_mb']
+        if reference is None:
+            reference = result
+        max_diff = max(torch.max(torch.abs(a - b)).item() for a, b in zip(result, reference))
+        t = measure_time(decode, device, n_warmup=1, n_repeat=FLAGS.repeat)
+        logger.info(
+            f'Budget {budget} MB: chunks of {crop_chunk_size} crops and {point_chunk_size} '
+            f'points, {t * 1000:.1f} ms, peak memory {peak_mb:.0f} MB, '
+            f'max abs difference to budget {FLAGS.budgets_mb[0]} MB {max_diff:.2e}'
+        )
+
+
+if __name__ == '__main__':
+    with torch.inference_mode():
+        main()
@@ -0,0 +1,89 @@
+"""Compares the throughput of the crop model (backbone and localizer head) in float32, bfloat16
+and float16, by default on the CPU, to choose the compute dtype for a device.
+
+The model is built from the same flags as for training and save_model.py, with random weights,
+which do not affect the speed. Run for example as:
+    python -m nlf.pt.benchmarks.compute_dtype --device=cpu --backbone=efficientnetv2-s ...
+"""
+
+import argparse
+import copy
+
+import torch
+from simplepyutils import FLAGS, logger
+
+import nlf.pt.backbones.builder as backbone_builder
+import nlf.pt.init as init
+import nlf.pt.models.field as pt_field
+import nlf.pt.models.nlf_model as pt_nlf_model
+from nlf.pt.benchmarks.util import measure_time
+
+
+def initialize():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument(
+        '--compute-dtypes', type=str, nargs='+', default=('float32', 'bfloat16', 'float16')
+    )
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--num-points', type=int, default=1024)
+    parser.add_argument('--num-threads', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    init.initialize(parent_parser=parser)
+
+
+def main():
+    initialize()
+    device = torch.device(FLAGS.device)
+    if FLAGS.num_threads > 0:
+        torch.set_num_threads(FLAGS.num_threads)
+    torch.manual_seed(0)
+
+    res = FLAGS.proc_side
+    crops = torch.rand(FLAGS.batch_size, 3, res, res, device=device)
+    intrinsic_matrix = torch.tensor(
+        [[res, 0, res / 2], [0, res, res / 2], [0, 0, 1]], dtype=torch.float32, device=device
+    ).repeat(FLAGS.batch_size, 1, 1)
+    flip = torch.zeros(FLAGS.batch_size, dtype=torch.bool, device=device)
+    canonical_points = torch.rand(FLAGS.num_points, 3, device=device) - 0.5
+
+    backbone, normalizer, out_channels = backbone_builder.build_backbone()
+    weight_field = pt_field.build_field()
+    model_float32 = pt_nlf_model.NLFModel(backbone, weight_field, normalizer, out_channels)
+    model_float32 = model_float32.to(device).eval()
+
+    reference = None
+    reference_name = None
+    for compute_dtype in FLAGS.compute_dtypes:
+        dtype = getattr(torch, compute_dtype)
+        model = copy.deepcopy(model_float32)
+        model.compute_dtype = compute_dtype
+        model.backbone.to(dtype)
+        model.heatmap_head.layer.to(dtype)
+        weights = model.get_weights_for_canonical_points(canonical_points)
+        crops_cast = crops.to(dtype)
+
+        def predict():
+            return model.predict_multi_same_weights(crops_cast, intrinsic_matrix, weights, flip)
+
+        try:
+            t = measure_time(predict, device, n_warmup=1, n_repeat=FLAGS.repeat)
+        except RuntimeError as e:
+            # Some operations have no implementation for some dtypes on some devices
+            logger.warning(f'{compute_dtype}: failed with {e}')
+            continue
+
+        poses = predict()[0].float()
+        if reference is None:
+            reference, reference_name = poses, compute_dtype
+        max_diff = torch.max(torch.abs(poses - reference)).item()
+        logger.info(
+            f'{compute_dtype}: {t * 1000:.1f} ms per batch of {FLAGS.batch_size}, '
+            f'{FLAGS.batch_size / t:.1f} crops/s, '
+            f'max abs difference to {reference_name} {max_diff:.2f} mm'
+        )
+
+
+if __name__ == '__main__':
+    with torch.inference_mode():
+        main()
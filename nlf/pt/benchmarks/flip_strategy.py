@@ -0,0 +1,88 @@
+"""Compares the two ways of decoding crops of which some use the flipped weights
+(LocalizerHead.decode_features_multi_same_weights): partitioning the crops and decoding each
+group with its own conv, or one conv with both weight sets and a per-crop selection.
+The timings and peak memory for various numbers of crops and points help to set
+flip_select_max_items (--flip-select-max-items in save_model.py) for the target hardware.
+
+The head is built from the same flags as for training and save_model.py. The features and
+weights are random. Run for example as:
+    python -m nlf.pt.benchmarks.flip_strategy --device=cuda --proc-side=384 ...
+"""
+
+import argparse
+
+import torch
+from simplepyutils import FLAGS, logger
+
+import nlf.pt.init as init
+import nlf.pt.models.field as pt_field
+import nlf.pt.models.nlf_model as pt_nlf_model
+from nlf.pt.benchmarks.util import measure_time
+from nlf.pt.multiperson.instrumentation import StageProfiler
+
+
+def initialize():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--compute-dtype', type=str, default='float16')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=(8, 32, 128))
+    parser.add_argument('--num-points', type=int, nargs='+', default=(24, 128, 1024, 6890))
+    parser.add_argument('--repeat', type=int, default=10)
+    init.initialize(parent_parser=parser)
+
+
+def main():
+    initialize()
+    device = torch.device(FLAGS.device)
+    dtype = getattr(torch, FLAGS.compute_dtype)
+    torch.manual_seed(0)
+
+    head = pt_nlf_model.LocalizerHead(pt_field.build_field(), torch.nn.BatchNorm2d).to(device)
+    side = FLAGS.proc_side // FLAGS.stride_test
+    c = FLAGS.backbone_link_dim
+    n_out_channels = 2 + FLAGS.depth
+
+    for n_points in FLAGS.num_points:
+        weights = {
+            k: torch.randn(n_points, n_out_channels, c, device=device, dtype=dtype) / c**0.5
+            for k in ['w_tensor', 'w_tensor_flipped']
+        }
+        weights['b_tensor'] = torch.zeros(n_points, n_out_channels, device=device, dtype=dtype)
+        weights['b_tensor_flipped'] = weights['b_tensor']
+
+        for batch_size in FLAGS.batch_sizes:
+            features = torch.randn(batch_size, c, side, side, device=device, dtype=dtype)
+            # As in test-time augmentation, where every other augmentation is flipped
+            flip = torch.arange(batch_size, device=device) % 2 == 1
+
+            times = {}
+            peak_memory_mb = {}
+            results = {}
+            for strategy in ['partition', 'select']:
+                head.flip_strategy = strategy
+
+                def decode():
+                    return head.decode_features_multi_same_weights(features, weights, flip)
+
+                results[strategy] = decode()
+                times[strategy] = measure_time(decode, device, n_repeat=FLAGS.repeat)
+                profiler = StageProfiler()
+                profiler(decode)
+                peak_memory_mb[strategy] = profiler.stats['total']['peak_memory_mb']
+
+            max_diff = max(
+                torch.max(torch.abs(a - b)).item()
+                for a, b in zip(results['partition'], results['select'])
+            )
+            logger.info(
+                f'{batch_size} crops, {n_points} points ({batch_size * n_points} items): '
+                f'partition {times["partition"] * 1000:.2f} ms '
+                f'{peak_memory_mb["partition"]:.1f} MB, '
+                f'select {times["select"] * 1000:.2f} ms {peak_memory_mb["select"]:.1f} MB, '
+                f'max abs difference {max_diff:.2e}'
+            )
+
+
+if __name__ == '__main__':
+    with torch.inference_mode():
+        main()
@@ -0,0 +1,113 @@
+"""Benchmarks the merging of test-time augmentation results with weighted_geometric_median,
+against the previous implementation with a fixed number of iterations."""
+
+import argparse
+
+import simplepyutils as spu
+import torch
+from simplepyutils import FLAGS, logger
+
+from nlf.pt.benchmarks.util import measure_time
+from nlf.pt.multiperson.multiperson_model import weighted_geometric_median, weighted_mean
+
+
+def initialize():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--num-boxes', type=int, default=100)
+    parser.add_argument('--num-aug', type=int, default=5)
+    parser.add_argument('--num-points', type=int, default=1079)
+    parser.add_argument('--n-iter', type=int, default=10)
+    parser.add_argument('--tol', type=float, default=0.1)
+    parser.add_argument('--repeat', type=int, default=20)
+    spu.argparse.initialize(parser)
+
+
+def main():
+    initialize()
+    device = torch.device(FLAGS.device)
+    torch.manual_seed(0)
+
+    # Poses in millimeters, scattered around a per-box mean pose like augmented predictions are
+    shape = (FLAGS.num_boxes, FLAGS.num_aug, FLAGS.num_points, 3)
+    mean_poses = torch.randn(FLAGS.num_boxes, 1, FLAGS.num_points, 3, device=device) * 300
+    poses = mean_poses + torch.randn(shape, device=device) * 30
+    uncerts = torch.rand(shape[:3], device=device) * 0.3 + 0.05
+    weights = uncerts**-1.5
+
+    def reference():
+        return weighted_geometric_median_reference(
+            poses, weights, n_iter=FLAGS.n_iter, dim=-3, eps=50.0
+        )
+
+    def fixed_iter():
+        return weighted_geometric_median(poses, weights, n_iter=FLAGS.n_iter, dim=-3, eps=50.0)
+
+    def early_stop():
+        return weighted_geometric_median(
+            poses, weights, n_iter=FLAGS.n_iter, dim=-3, eps=50.0, tol=FLAGS.tol
+        )
+
+    y_ref, w_ref = reference()
+    for name, fn in [('fixed', fixed_iter), (f'tol={FLAGS.tol}', early_stop)]:
+        y, w = fn()
+        max_diff = torch.max(torch.abs(y - y_ref)).item()
+        max_weight_diff = torch.max(torch.abs(w - w_ref) / w_ref).item()
+        logger.info(
+            f'{name}: max abs median difference {max_diff:.4f} mm, '
+            f'max relative weight difference {max_weight_diff:.2e}'
+        )
+
+    logger.info(f'Shape {list(shape)}, {FLAGS.n_iter} iterations')
+    t_ref = measure_time(reference, device, n_repeat=FLAGS.repeat)
+    for name, fn in [('fixed', fixed_iter), (f'tol={FLAGS.tol}', early_stop)]:
+        t = measure_time(fn, device, n_repeat=FLAGS.repeat)
+        logger.info(
+            f'{name}: reference {t_ref * 1000:.2f} ms, new {t * 1000:.2f} ms, '
+            f'speedup {t_ref / t:.2f}x'
+        )
+
+    single_poses = poses[:, :1]
+    single_weights = weights[:, :1]
+    t_ref = measure_time(
+        lambda: weighted_geometric_median_reference(single_poses, single_weights, dim=-3),
+        device,
+        n_repeat=FLAGS.repeat,
+    )
+    t = measure_time(
+        lambda: weighted_geometric_median(single_poses, single_weights, dim=-3),
+        device,
+        n_repeat=FLAGS.repeat,
+    )
+    logger.info(
+        f'num_aug=1: reference {t_ref * 1000:.2f} ms, new {t * 1000:.2f} ms, '
+        f'speedup {t_ref / t:.2f}x'
+    )
+
+
+def weighted_geometric_median_reference(x, w, n_iter=10, dim=-2, eps=1e-1, keepdim=False):
+    """The previous implementation, which always runs all iterations on the full tensor."""
+    if dim < 0:
+        dim = len(x.shape) + dim
+
+    if w is None:
+        w = torch.ones_like(x[..., :1])
+    else:
+        w = w.unsqueeze(-1)
+
+    new_weights = w
+    y = weighted_mean(x, new_weights, dim=dim, keepdim=True)
+    for _ in range(n_iter):
+        dist = torch.norm(x - y, dim=-1, keepdim=True)
+        new_weights = w / (dist + eps)
+        y = weighted_mean(x, new_weights, dim=dim, keepdim=True)
+
+    if not keepdim:
+        y = y.squeeze(dim)
+
+    return y, new_weights.squeeze(-1)
+
+
+if __name__ == '__main__':
+    with torch.inference_mode():
+        main()
@@ -0,0 +1,105 @@
+"""Measures the error of the float32 geometry path of MultipersonNLF (geometry_precision='float32')
+against the float64 path, and the time both take.
+
+The predicted poses are rotated from the crop cameras back to the original camera, then moved to
+world coordinates, which can be far from the origin (e.g. kilometers in georeferenced scenes).
+The script exits with an error if the float32 path deviates by more than --max-diff-mm."""
+
+import argparse
+import sys
+
+import simplepyutils as spu
+import torch
+from simplepyutils import FLAGS, logger
+
+from nlf.pt.benchmarks.util import measure_time
+from nlf.pt.multiperson.multiperson_model import rotate_centered
+
+
+def initialize():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--num-boxes', type=int, default=100)
+    parser.add_argument('--num-aug', type=int, default=5)
+    parser.add_argument('--num-points', type=int, default=1079)
+    parser.add_argument('--max-depth-m', type=float, default=50.0)
+    parser.add_argument('--world-offset-m', type=float, default=5000.0)
+    parser.add_argument('--max-diff-mm', type=float, default=1.0)
+    parser.add_argument('--repeat', type=int, default=20)
+    spu.argparse.initialize(parser)
+
+
+def main():
+    initialize()
+    device = torch.device(FLAGS.device)
+    torch.manual_seed(0)
+
+    # Poses in millimeters in the crop cameras, people at various depths
+    n_boxes, num_aug, n_points = FLAGS.num_boxes, FLAGS.num_aug, FLAGS.num_points
+    depths = torch.rand(num_aug, n_boxes, 1, 1, device=device) * (FLAGS.max_depth_m - 1) + 1
+    poses = torch.randn(num_aug, n_boxes, n_points, 3, device=device) * 300
+    poses[..., 2:] += depths * 1000
+    R = random_rotation((num_aug, n_boxes), device).unsqueeze(1)
+
+    # World-to-camera transform with a large translation
+    extr_rot = random_rotation((n_boxes,), device).double()
+    extr_transl = torch.randn(n_boxes, 3, device=device, dtype=torch.float64)
+    extr_transl *= FLAGS.world_offset_m * 1000 / torch.norm(extr_transl, dim=-1, keepdim=True)
+    extrinsic_matrix = torch.eye(4, device=device, dtype=torch.float64).repeat(n_boxes, 1, 1)
+    extrinsic_matrix[:, :3, :3] = extr_rot
+    extrinsic_matrix[:, :3, 3] = extr_transl
+    inv_extrinsic_matrix = torch.linalg.inv(extrinsic_matrix)
+
+    def float64_path():
+        poses_camspace = (poses.double() @ R.double()).mean(dim=0)
+        inv_rot = inv_extrinsic_matrix[:, :3, :3]
+        inv_transl = inv_extrinsic_matrix[:, :3, 3]
+        return poses_camspace @ inv_rot.mT + inv_transl.unsqueeze(-2)
+
+    def float32_path():
+        poses_camspace = rotate_centered(poses, R).mean(dim=0)
+        return rotate_centered(
+            poses_camspace,
+            inv_extrinsic_matrix[:, :3, :3].mT,
+            inv_extrinsic_matrix[:, :3, 3].unsqueeze(-2),
+        )
+
+    def naive_float32_path():
+        poses_camspace = (poses @ R).mean(dim=0)
+        inv_extr = inv_extrinsic_matrix.float()
+        return poses_camspace @ inv_extr[:, :3, :3].mT + inv_extr[:, :3, 3].unsqueeze(-2)
+
+    reference = float64_path()
+    rounding_error = torch.max(torch.abs(reference.float().double() - reference)).item()
+    logger.info(
+        f'World offset {FLAGS.world_offset_m} m, rounding the float64 result to float32 alone '
+        f'changes it by up to {rounding_error:.4f} mm'
+    )
+    max_diff = None
+    for name, fn in [('float32 centered', float32_path), ('float32 naive', naive_float32_path)]:
+        diff = torch.max(torch.abs(fn().double() - reference)).item()
+        t_ref = measure_time(float64_path, device, n_repeat=FLAGS.repeat)
+        t = measure_time(fn, device, n_repeat=FLAGS.repeat)
+        logger.info(
+            f'{name}: max abs difference {diff:.4f} mm, float64 {t_ref * 1000:.2f} ms, '
+            f'float32 {t * 1000:.2f} ms, speedup {t_ref / t:.2f}x'
+        )
+        if max_diff is None:
+            max_diff = diff
+
+    if max_diff > FLAGS.max_diff_mm:
+        logger.error(f'The float32 path deviates by more than {FLAGS.max_diff_mm} mm')
+        sys.exit(1)
+
+
+def random_rotation(batch_shape, device):
+    q, r = torch.linalg.qr(torch.randn(*batch_shape, 3, 3, device=device))
+    q = q * torch.sign(torch.diagonal(r, dim1=-2, dim2=-1)).unsqueeze(-2)
+    # Make it a proper rotation
+    q[..., 2] *= torch.sign(torch.linalg.det(q)).unsqueeze(-1)
+    return q
+
+
+if __name__ == '__main__':
+    with torch.inference_mode():
+        main()
@@ -0,0 +1,93 @@
+"""Checks that the fused heatmap decoding (model_util.decode_heatmaps_fused) gives the same
+results as the previous decoding with separate softmax and expectation steps, and compares
+their speed, with and without the blocked CPU path.
+
+The script exits with an error if the results deviate by more than --max-diff."""
+
+import argparse
+import sys
+
+import simplepyutils as spu
+import torch
+from simplepyutils import FLAGS, logger
+
+from nlf.pt import ptu
+from nlf.pt.benchmarks.util import measure_time
+from nlf.pt.models import util as model_util
+
+
+def initialize():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--num-points', type=int, default=1024)
+    parser.add_argument('--depth', type=int, default=8)
+    parser.add_argument('--side', type=int, default=12)
+    parser.add_argument('--block-bytes', type=int, default=4 * 2**20)
+    parser.add_argument('--max-diff', type=float, default=1e-4)
+    parser.add_argument('--repeat', type=int, default=10)
+    spu.argparse.initialize(parser)
+
+
+def main():
+    initialize()
+    device = torch.device(FLAGS.device)
+    torch.manual_seed(0)
+
+    shape = (FLAGS.batch_size, FLAGS.num_points, 2 + FLAGS.depth, FLAGS.side, FLAGS.side)
+    logits = torch.randn(shape, device=device) * 3
+    cell_coords25d = model_util.heatmap_coords([FLAGS.depth, FLAGS.side, FLAGS.side], device)
+    cell_coords2d = model_util.heatmap_coords([FLAGS.side, FLAGS.side], device)
+    block_size = max(1, FLAGS.block_bytes // (logits[0, 0].numel() * 4))
+
+    def reference():
+        return decode_heatmaps_reference(logits)
+
+    def fused():
+        # The fused decoding overwrites the logits, as in the model, where they are temporary
+        return model_util.decode_heatmaps_fused(logits.clone(), cell_coords25d, cell_coords2d)
+
+    def fused_blocked():
+        return model_util.decode_heatmaps_fused(
+            logits.clone(), cell_coords25d, cell_coords2d, block_size
+        )
+
+    def clone_only():
+        return logits.clone()
+
+    results_ref = reference()
+    t_clone = measure_time(clone_only, device, n_repeat=FLAGS.repeat)
+    t_ref = measure_time(reference, device, n_repeat=FLAGS.repeat)
+    max_diff = 0.0
+    for name, fn in [('fused', fused), (f'fused, blocks of {block_size}', fused_blocked)]:
+        results = fn()
+        diffs = [torch.max(torch.abs(a - b)).item() for a, b in zip(results, results_ref)]
+        max_diff = max(max_diff, max(diffs))
+        t = measure_time(fn, device, n_repeat=FLAGS.repeat) - t_clone
+        logger.info(
+            f'{name}: max abs difference of coords2d {diffs[0]:.2e}, coords3d {diffs[1]:.2e}, '
+            f'uncertainties {diffs[2]:.2e}; reference {t_ref * 1000:.2f} ms, '
+            f'fused {t * 1000:.2f} ms, speedup {t_ref / t:.2f}x'
+        )
+
+    if max_diff > FLAGS.max_diff:
+        logger.error(f'The fused decoding deviates by more than {FLAGS.max_diff}')
+        sys.exit(1)
+
+
+def decode_heatmaps_reference(logits):
+    """The previous decoding, with separate softmax, summation and expectation steps."""
+    uncertainty_map = logits[:, :, 0]
+    coords_metric_xy = ptu.soft_argmax(logits[:, :, 1], dim=[3, 2])
+    heatmap25d = ptu.softmax(logits[:, :, 2:], dim=[4, 3, 2])
+    heatmap2d = torch.sum(heatmap25d, dim=2)
+    uncertainties = torch.einsum('nphw,nphw->np', uncertainty_map, heatmap2d)
+    coords25d = ptu.decode_heatmap(heatmap25d, dim=[4, 3, 2])
+    coords2d = coords25d[..., :2]
+    coords3d = torch.cat([coords_metric_xy, coords25d[..., 2:]], dim=-1)
+    return coords2d, coords3d, uncertainties
+
+
+if __name__ == '__main__':
+    with torch.inference_mode():
+        main()
@@ -0,0 +1,53 @@
+"""Benchmarks the conversion of uint8 and uint16 frames to linear float16 values with a lookup
+table (im_to_linear), against evaluating the power function at every pixel as before."""
+
+import argparse
+
+import simplepyutils as spu
+import torch
+from simplepyutils import FLAGS, logger
+
+from nlf.pt.benchmarks.util import measure_time
+from nlf.pt.multiperson.multiperson_model import im_to_linear
+
+
+def initialize():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--repeat', type=int, default=20)
+    spu.argparse.initialize(parser)
+
+
+def main():
+    initialize()
+    device = torch.device(FLAGS.device)
+    torch.manual_seed(0)
+    shape = (FLAGS.batch_size, 3, FLAGS.height, FLAGS.width)
+
+    for dtype, max_value in [(torch.uint8, 255), (torch.uint16, 65535)]:
+        images = torch.randint(0, max_value + 1, shape, dtype=torch.int32, device=device).to(dtype)
+        max_diff = torch.max(
+            torch.abs(im_to_linear(images).float() - im_to_linear_reference(images).float())
+        ).item()
+        t_ref = measure_time(lambda: im_to_linear_reference(images), device, n_repeat=FLAGS.repeat)
+        t = measure_time(lambda: im_to_linear(images), device, n_repeat=FLAGS.repeat)
+        logger.info(
+            f'{dtype}: max abs difference {max_diff:.2e}, reference {t_ref * 1000:.2f} ms, '
+            f'lookup table {t * 1000:.2f} ms, speedup {t_ref / t:.2f}x'
+        )
+
+
+def im_to_linear_reference(im):
+    """The previous implementation, which evaluates the power function at every pixel."""
+    if im.dtype == torch.uint8:
+        return im.to(dtype=torch.float16).mul_(1.0 / 255.0).pow_(2.2)
+    else:
+        return im.to(dtype=torch.float16).mul_(1.0 / 65504.0).nan_to_num_(posinf=1.0).pow_(2.2)
+
+
+if __name__ == '__main__':
+    with torch.inference_mode():
+        main()
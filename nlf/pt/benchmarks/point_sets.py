@@ -0,0 +1,97 @@
+"""Compares predicting several point sets on the same crops one by one, which runs the backbone
+for each set, against encoding the crops once with get_feature_handle and decoding all sets
+together with decode_feature_handle.
+
+The model is built from the same flags as for training and save_model.py, with random weights.
+Run for example as:
+    python -m nlf.pt.benchmarks.point_sets --device=cuda --backbone=efficientnetv2-s ...
+"""
+
+import argparse
+
+import torch
+from simplepyutils import FLAGS, logger
+
+import nlf.pt.backbones.builder as backbone_builder
+import nlf.pt.init as init
+import nlf.pt.models.field as pt_field
+import nlf.pt.models.nlf_model as pt_nlf_model
+from nlf.pt.benchmarks.util import measure_time
+from nlf.pt.multiperson.multiperson_model import concat_weights
+
+
+def initialize():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--compute-dtype', type=str, default='float16')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--num-points', type=int, nargs='+', default=(6890, 24, 64))
+    parser.add_argument('--repeat', type=int, default=10)
+    init.initialize(parent_parser=parser)
+
+
+def main():
+    initialize()
+    device = torch.device(FLAGS.device)
+    dtype = getattr(torch, FLAGS.compute_dtype)
+    torch.manual_seed(0)
+
+    res = FLAGS.proc_side
+    crops = torch.rand(FLAGS.batch_size, 3, res, res, device=device, dtype=dtype)
+    intrinsic_matrix = torch.tensor(
+        [[res, 0, res / 2], [0, res, res / 2], [0, 0, 1]], dtype=torch.float32, device=device
+    ).repeat(FLAGS.batch_size, 1, 1)
+    flip = torch.arange(FLAGS.batch_size, device=device) % 2 == 1
+
+    backbone, normalizer, out_channels = backbone_builder.build_backbone()
+    weight_field = pt_field.build_field()
+    model = pt_nlf_model.NLFModel(
+        backbone, weight_field, normalizer, out_channels, compute_dtype=FLAGS.compute_dtype
+    )
+    model = model.to(device).eval()
+    model.backbone.to(dtype)
+    model.heatmap_head.layer.to(dtype)
+
+    weights_list = [
+        model.get_weights_for_canonical_points(torch.rand(n, 3, device=device) - 0.5)
+        for n in FLAGS.num_points
+    ]
+    weights_concat = concat_weights(weights_list)
+    point_splits = list(FLAGS.num_points)
+
+    def separately():
+        return [
+            model.predict_multi_same_weights(crops, intrinsic_matrix, w, flip)
+            for w in weights_list
+        ]
+
+    def shared_features():
+        handle = model.get_feature_handle(crops, intrinsic_matrix, flip)
+        return [model.decode_feature_handle(handle, w) for w in weights_list]
+
+    def shared_features_concat():
+        handle = model.get_feature_handle(crops, intrinsic_matrix, flip)
+        return model.decode_feature_handle(handle, weights_concat, point_splits)
+
+    poses_ref = torch.cat([p for p, u in separately()], dim=1)
+    poses_shared = torch.cat([p for p, u in shared_features()], dim=1)
+    poses_concat = shared_features_concat()[0]
+    logger.info(
+        f'Max abs difference to separate predictions: shared features '
+        f'{torch.max(torch.abs(poses_shared - poses_ref)).item():.4f} mm, concatenated sets '
+        f'{torch.max(torch.abs(poses_concat - poses_ref)).item():.4f} mm'
+    )
+
+    t_ref = measure_time(separately, device, n_repeat=FLAGS.repeat)
+    candidates = [('shared features', shared_features), ('concatenated', shared_features_concat)]
+    for name, fn in candidates:
+        t = measure_time(fn, device, n_repeat=FLAGS.repeat)
+        logger.info(
+            f'{name}: separately {t_ref * 1000:.1f} ms, new {t * 1000:.1f} ms, '
+            f'speedup {t_ref / t:.2f}x'
+        )
+
+
+if __name__ == '__main__':
+    with torch.inference_mode():
+        main()
@@ -0,0 +1,117 @@
+"""Compares the batched pose NMS (plausibility_check.pose_non_max_suppression_batched) with the
+previous NMS, which ran separately for each image, in time and peak memory. Also checks that
+both keep the same poses.
+
+The people counts can be skewed, with one crowded frame among many sparse ones. Run e.g.:
+    python -m nlf.pt.benchmarks.pose_nms --num-images=64 --people-per-image=2 --crowd-size=60
+"""
+
+import argparse
+
+import simplepyutils as spu
+import torch
+from simplepyutils import FLAGS, logger
+
+from nlf.pt.benchmarks.util import measure_time
+from nlf.pt.multiperson import plausibility_check as plausib
+from nlf.pt.multiperson.instrumentation import StageProfiler
+
+
+def initialize():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--num-images', type=int, default=64)
+    parser.add_argument('--people-per-image', type=int, default=2)
+    parser.add_argument('--crowd-size', type=int, default=60)
+    parser.add_argument('--num-points', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=10)
+    spu.argparse.initialize(parser)
+
+
+def main():
+    initialize()
+    device = torch.device(FLAGS.device)
+    torch.manual_seed(0)
+
+    counts = torch.full((FLAGS.num_images,), FLAGS.people_per_image, device=device)
+    counts[0] = FLAGS.crowd_size
+    image_ids = torch.repeat_interleave(torch.arange(FLAGS.num_images, device=device), counts)
+    n_poses = image_ids.shape[0]
+    # Two detections of most people, so that there is something to suppress
+    people = torch.randn(n_poses // 2 + 1, FLAGS.num_points, 3, device=device) * 500
+    poses = people[torch.arange(n_poses, device=device) // 2]
+    poses += torch.randn(n_poses, FLAGS.num_points, 3, device=device) * 30
+    poses[..., 2] += 5000
+    scores = torch.rand(n_poses, device=device)
+    is_valid = torch.rand(n_poses, device=device) > 0.1
+
+    def batched():
+        return plausib.pose_non_max_suppression_batched(
+            poses, scores, is_valid, image_ids, FLAGS.num_images
+        )
+
+    def per_image():
+        return pose_non_max_suppression_per_image(
+            poses, scores, is_valid, image_ids, FLAGS.num_images
+        )
+
+    result = batched()
+    result_ref = per_image()
+    logger.info(
+        f'Kept {result.shape[0]} of {n_poses} poses, same as per image: '
+        f'{torch.equal(result, result_ref)}'
+    )
+    for name, fn in [('per image', per_image), ('batched', batched)]:
+        profiler = StageProfiler()
+        profiler(fn)
+        t = measure_time(fn, device, n_repeat=FLAGS.repeat)
+        logger.info(
+            f'{name}: {t * 1000:.2f} ms, '
+            f'peak memory {profiler.stats["total"]["peak_memory_mb"]:.1f} MB'
+        )
+
+
+def pose_non_max_suppression_per_image(poses, scores, is_pose_valid, image_ids, n_images):
+    kept = []
+    for i_image in range(n_images):
+        indices = torch.nonzero(image_ids == i_image).squeeze(1)
+        kept_image = pose_non_max_suppression_previous(
+            poses[indices], scores[indices], is_pose_valid[indices]
+        )
+        kept.append(indices[kept_image])
+    return torch.cat(kept)
+
+
+# The previous implementation, copied verbatim (renamed)
+def pose_non_max_suppression_previous(poses, scores, is_pose_valid):
+    plausible_indices_single_frame = torch.squeeze(torch.argwhere(is_pose_valid), 1)
+    plausible_poses = poses[plausible_indices_single_frame]
+    plausible_scores = scores[plausible_indices_single_frame]
+    similarity_matrix = plausib.compute_pose_similarity(plausible_poses)
+    nms_indices = non_max_suppression_overlaps_previous(
+        overlaps=similarity_matrix, scores=plausible_scores, overlap_threshold=0.4
+    )
+    return plausible_indices_single_frame[nms_indices]
+
+
+def non_max_suppression_overlaps_previous(
+    overlaps: torch.Tensor, scores: torch.Tensor, overlap_threshold: float
+):
+    n_items = overlaps.shape[0]
+    if n_items == 0:
+        return torch.zeros(0, dtype=torch.int32, device=overlaps.device)
+
+    order = torch.argsort(scores, dim=0, descending=True)  # stable=True
+    keep = []
+    while order.shape[0] > 0:
+        i = order[0]
+        keep.append(i)
+        inds = torch.where(overlaps[i, order[1:]] <= overlap_threshold)[0]
+        order = order[inds + 1]
+
+    return torch.stack(keep)
+
+
+if __name__ == '__main__':
+    with torch.inference_mode():
+        main()
@@ -0,0 +1,24 @@
+import time
+
+import numpy as np
+import torch
+
+
+def measure_time(fn, device, n_warmup=3, n_repeat=10):
+    """Returns the median wall time of calling `fn` in seconds, with device synchronization."""
+    for _ in range(n_warmup):
+        fn()
+    synchronize(device)
+
+    times = []
+    for _ in range(n_repeat):
+        start = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
@@ -0,0 +1,213 @@
+"""Benchmarks crop warping: the batched pyramid warping against the previous implementation,
+which warps each crop separately, on a crowded scene. The results must be identical.
+
+With --num-images > 1, the people are in the first --num-busy-images frames only (by default
+all), while the pyramid covers all frames, as for a chunk of crops of a video batch. E.g.:
+    python -m nlf.pt.benchmarks.warping --num-images=64 --num-busy-images=2 --num-boxes=12
+"""
+
+import argparse
+from typing import Tuple
+
+import numpy as np
+import simplepyutils as spu
+import torch
+import torch.nn.functional as F
+from simplepyutils import FLAGS, logger
+
+from nlf.pt import ptu3d
+from nlf.pt.benchmarks.util import measure_time
+from nlf.pt.multiperson import warping
+from nlf.pt.multiperson.instrumentation import StageProfiler
+
+
+def initialize():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--dtype', type=str, default='float16')
+    parser.add_argument('--num-images', type=int, default=1)
+    parser.add_argument('--num-busy-images', type=int, default=None)
+    parser.add_argument('--image-height', type=int, default=2160)
+    parser.add_argument('--image-width', type=int, default=3840)
+    parser.add_argument('--num-boxes', type=int, default=150)
+    parser.add_argument('--num-aug', type=int, default=5)
+    parser.add_argument('--crop-side', type=int, default=256)
+    parser.add_argument('--antialias-factor', type=int, default=1)
+    parser.add_argument('--fisheye', action=spu.argparse.BoolAction)
+    parser.add_argument('--repeat', type=int, default=10)
+    spu.argparse.initialize(parser)
+
+
+def main():
+    initialize()
+    device = torch.device(FLAGS.device)
+    torch.manual_seed(0)
+    images = torch.rand(
+        FLAGS.num_images,
+        3,
+        FLAGS.image_height,
+        FLAGS.image_width,
+        device=device,
+        dtype=getattr(torch, FLAGS.dtype),
+    )
+    args = make_crop_params(images)
+    grid_cache = {}
+
+    def batched():
+        return warping.warp_images_with_pyramid(images, *args, grid_cache=grid_cache)
+
+    def per_crop():
+        return warp_images_with_pyramid_per_crop(images, *args)
+
+    max_diff = torch.max(torch.abs(batched().float() - per_crop().float())).item()
+    logger.info(f'Max abs difference between batched and per-crop warping: {max_diff}')
+
+    n_crops = args[-1].shape[0]
+    t_batched = measure_time(batched, device, n_repeat=FLAGS.repeat)
+    t_per_crop = measure_time(per_crop, device, n_repeat=FLAGS.repeat)
+    peak_batched = peak_memory_mb(batched)
+    peak_per_crop = peak_memory_mb(per_crop)
+    logger.info(
+        f'{n_crops} crops from {FLAGS.num_busy_images or FLAGS.num_images} of '
+        f'{FLAGS.num_images} image(s): per-crop {t_per_crop * 1000:.1f} ms '
+        f'({peak_per_crop:.0f} MB), batched {t_batched * 1000:.1f} ms ({peak_batched:.0f} MB), '
+        f'speedup {t_per_crop / t_batched:.1f}x'
+    )
+
+
+def peak_memory_mb(fn):
+    profiler = StageProfiler()
+    profiler(fn)
+    return profiler.stats['total']['peak_memory_mb']
+
+
+def make_crop_params(images):
+    """Creates crop geometry similar to what MultipersonNLF produces for randomly placed people
+    of varying sizes, with test-time augmentation via scaling and in-plane rotation."""
+    device = images.device
+    n_images, _, imh, imw = images.shape
+    n_busy_images = FLAGS.num_busy_images or n_images
+    n_boxes = FLAGS.num_boxes * n_busy_images
+    n_aug = FLAGS.num_aug
+    res = FLAGS.crop_side
+    aa = FLAGS.antialias_factor
+
+    intrinsic_matrix = ptu3d.intrinsic_matrix_from_field_of_view(55, [imh, imw], device=device)
+    if FLAGS.fisheye:
+        distortion_coeffs = torch.tensor([[0.05, -0.01, 0.001, 0.0]], device=device)
+    else:
+        distortion_coeffs = torch.zeros((1, 5), device=device)
+
+    rng = np.random.default_rng(0)
+    box_sizes = rng.uniform(0.03, 0.5, size=n_boxes) * imh
+    centers = np.stack(
+        [rng.uniform(0, imw, size=n_boxes), rng.uniform(0, imh, size=n_boxes)], axis=1
+    )
+    centers = torch.tensor(centers, dtype=torch.float32, device=device)
+    box_scales = torch.tensor(res / box_sizes, dtype=torch.float32, device=device)
+    aug_scales = torch.linspace(0.8, 1.1, n_aug, device=device)
+    aug_angles = torch.linspace(-0.4, 0.4, n_aug, device=device)
+    crop_scales = (aug_scales[:, np.newaxis] * box_scales[np.newaxis, :]).reshape(-1)
+
+    # Map the box center to the middle of the crop and zoom in, with an in-plane rotation
+    f = intrinsic_matrix[0, 0, 0]
+    principal_point = intrinsic_matrix[0, :2, 2]
+    rot = ptu3d.rotation_mat(aug_angles, rot_axis='z')
+    new_intrinsic_matrix = torch.zeros((n_aug, n_boxes, 3, 3), device=device)
+    new_intrinsic_matrix[..., 0, 0] = f * crop_scales.reshape(n_aug, n_boxes)
+    new_intrinsic_matrix[..., 1, 1] = f * crop_scales.reshape(n_aug, n_boxes)
+    offsets = (centers - principal_point) * crop_scales.reshape(n_aug, n_boxes, 1)
+    new_intrinsic_matrix[..., :2, 2] = res / 2 - offsets
+    new_intrinsic_matrix[..., 2, 2] = 1
+    new_invprojmats = torch.linalg.inv(new_intrinsic_matrix @ rot[:, np.newaxis])
+    if aa > 1:
+        new_invprojmats = new_invprojmats @ warping.corner_aligned_scale_mat(1 / aa, device)
+
+    image_ids = torch.arange(n_busy_images, device=device).repeat_interleave(FLAGS.num_boxes)
+    return (
+        intrinsic_matrix.expand(n_aug * n_boxes, 3, 3),
+        new_invprojmats.reshape(-1, 3, 3),
+        distortion_coeffs.expand(n_aug * n_boxes, -1),
+        crop_scales * aa,
+        (res * aa, res * aa),
+        torch.tile(image_ids, [n_aug]),
+    )
+
+
+# The previous implementation, copied verbatim, except for the warping. prefixes
+def warp_images_with_pyramid_per_crop(
+    images: torch.Tensor,
+    intrinsic_matrix: torch.Tensor,
+    new_invprojmats: torch.Tensor,
+    distortion_coeffs: torch.Tensor,
+    crop_scales: torch.Tensor,
+    output_shape: Tuple[int, int],
+    image_ids: torch.Tensor,
+    n_pyramid_levels: int = 3,
+):
+    # Create a very simple pyramid with lower resolution images for simple antialiasing.
+    image_levels = [images]
+    for _ in range(1, n_pyramid_levels):
+        # We use simple averaging (box filter) to create the pyramid, for efficiency
+        image_levels.append(F.avg_pool2d(image_levels[-1], 2, 2))
+
+    intrinsic_matrix_levels = [
+        warping.corner_aligned_scale_mat(1 / 2**i_level, device=intrinsic_matrix.device)
+        @ intrinsic_matrix
+        for i_level in range(n_pyramid_levels)
+    ]
+
+    # Decide which pyramid level is most appropriate for each crop
+    i_pyramid_levels = torch.floor(-torch.log2(crop_scales))
+    i_pyramid_levels = torch.clip(i_pyramid_levels, 0, n_pyramid_levels - 1).int()
+
+    return torch.stack(
+        [
+            warp_single_image_per_crop(
+                image_levels[i_pyramid_levels[i]][image_ids[i]],
+                intrinsic_matrix_levels[i_pyramid_levels[i]][i],
+                new_invprojmats[i],
+                distortion_coeffs[i],
+                output_shape,
+            )
+            for i in range(len(image_ids))
+        ]
+    )
+
+
+def warp_single_image_per_crop(
+    image: torch.Tensor,
+    intrinsic_matrix: torch.Tensor,
+    new_invprojmat: torch.Tensor,
+    distortion_coeffs: torch.Tensor,
+    output_shape: Tuple[int, int],
+):
+    device = image.device
+    new_coords = torch.stack(
+        torch.meshgrid(
+            torch.arange(output_shape[1], device=device),
+            torch.arange(output_shape[0], device=device),
+            indexing='xy',
+        ),
+        dim=-1,
+    ).float()
+    new_coords_homog = ptu3d.to_homogeneous(new_coords)
+    old_coords_homog = torch.einsum('hwc,Cc->hwC', new_coords_homog, new_invprojmat)
+    old_coords_homog = ptu3d.to_homogeneous(
+        warping.distort_points(ptu3d.project(old_coords_homog), distortion_coeffs)
+    )
+    old_coords = torch.einsum('hwc,Cc->hwC', old_coords_homog, intrinsic_matrix)[..., :2]
+    size = torch.tensor([image.shape[2], image.shape[1]], dtype=old_coords.dtype, device=device)
+    old_coords_normalized = old_coords.mul_(2.0 / (size - 1)).sub_(1.0)
+    return F.grid_sample(
+        image.unsqueeze(0),
+        old_coords_normalized.unsqueeze(0).to(image.dtype),
+        align_corners=True,
+        mode='bilinear',
+        padding_mode='zeros',
+    ).squeeze(0)
+
+
+if __name__ == '__main__':
+    with torch.inference_mode():
+        main()
@@ -0,0 +1,86 @@
+"""Times the ways of applying the localizer weights to the features (weight_application.py)
+for one shape, for shared and per-crop weights, checks that they agree, and shows which one the
+autotuner picks.
+
+Run for example as:
+    python -m nlf.pt.benchmarks.weight_application --device=cuda --dtype=float16
+"""
+
+import argparse
+
+import simplepyutils as spu
+import torch
+from simplepyutils import FLAGS, logger
+
+from nlf.pt.benchmarks.util import measure_time
+from nlf.pt.models import weight_application
+
+
+def initialize():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--dtype', type=str, default='float16')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--channels', type=int, default=512)
+    parser.add_argument('--side', type=int, default=12)
+    parser.add_argument('--num-points', type=int, default=1024)
+    parser.add_argument('--num-points-per-example', type=int, default=128)
+    parser.add_argument('--out-channels', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=10)
+    spu.argparse.initialize(parser)
+
+
+def main():
+    initialize()
+    device = torch.device(FLAGS.device)
+    dtype = getattr(torch, FLAGS.dtype)
+    torch.manual_seed(0)
+    n, c, side = FLAGS.batch_size, FLAGS.channels, FLAGS.side
+    n_out = FLAGS.out_channels
+    features = torch.randn(n, c, side, side, device=device, dtype=dtype)
+    autotuner = weight_application.Autotuner()
+    device_name = weight_application.get_device_name(device)
+
+    cases = [
+        (
+            False,
+            FLAGS.num_points,
+            torch.randn(FLAGS.num_points * n_out, c, device=device, dtype=dtype) / c**0.5,
+            torch.randn(FLAGS.num_points * n_out, device=device, dtype=dtype),
+            weight_application.apply_shared_weights,
+            weight_application.SHARED_METHODS,
+        ),
+        (
+            True,
+            FLAGS.num_points_per_example,
+            torch.randn(n, FLAGS.num_points_per_example, c, n_out, device=device, dtype=dtype)
+            / c**0.5,
+            torch.randn(n, FLAGS.num_points_per_example, n_out, device=device, dtype=dtype),
+            weight_application.apply_per_example_weights,
+            weight_application.PER_EXAMPLE_METHODS,
+        ),
+    ]
+    for per_example, n_points, w_tensor, b_tensor, apply_fn, methods in cases:
+        signature = weight_application.shape_signature(
+            per_example, features, n_points, n_out, device_name
+        )
+        reference = apply_fn(methods[0], features, w_tensor, b_tensor).float()
+        for method in methods:
+            result = apply_fn(method, features, w_tensor, b_tensor).float()
+            max_diff = torch.max(torch.abs(result - reference)).item()
+            t = measure_time(
+                lambda: apply_fn(method, features, w_tensor, b_tensor),
+                device,
+                n_repeat=FLAGS.repeat,
+            )
+            logger.info(
+                f'{signature} {method}: {t * 1000:.2f} ms, '
+                f'max abs difference to {methods[0]} {max_diff:.2e}'
+            )
+        choice = autotuner.choose(signature, per_example, features, w_tensor, b_tensor)
+        logger.info(f'{signature}: the autotuner picks {choice}')
+
+
+if __name__ == '__main__':
+    with torch.inference_mode():
+        main()
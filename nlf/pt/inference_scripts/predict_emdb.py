@@ -15,6 +15,8 @@ import simplepyutils as spu
 import torch
 import torchvision  # noqa: F401
 from simplepyutils import FLAGS, logger
+from nlf.pt.models import weight_application
+from nlf.pt.multiperson import weights_cache
 from nlf.pt.inference_scripts.predict_tdpw import (
     get_joint_info,
     precuda,
@@ -43,6 +45,7 @@ def initialize():
 def main():
     initialize()
     model = torch.jit.load(FLAGS.model_path)
+    weight_application.set_device_name(model, 'cuda')
 
     ji3d = get_joint_info(model, 'smpl_24')
     faces = np.load(f'{PROJDIR}/smpl_faces.npy')
@@ -59,7 +62,7 @@ def main():
         internal_batch_size=FLAGS.internal_batch_size,
         num_aug=FLAGS.num_aug,
         antialias_factor=2,
-        weights=model.get_weights_for_canonical_points(cano_all),
+        weights=weights_cache.get_weights_for_canonical_points(model, FLAGS.model_path, cano_all),
     )
 
     detect_fn = functools.partial(
@@ -15,6 +15,8 @@ import torch
 import torchvision  # noqa: F401
 from posepile.paths import DATA_ROOT
 from simplepyutils import FLAGS, logger
+from nlf.pt.models import weight_application
+from nlf.pt.multiperson import weights_cache
 from nlf.pt.inference_scripts.predict_tdpw import (
     get_joint_info,
     precuda,
@@ -44,6 +46,7 @@ def initialize():
 def main():
     initialize()
     model = torch.jit.load(FLAGS.model_path)
+    weight_application.set_device_name(model, 'cuda')
     assert FLAGS.num_joints in (17, 25)
     skeleton = f'h36m_{FLAGS.num_joints}'
     ji3d = get_joint_info(model, skeleton)
@@ -53,7 +56,8 @@ def main():
     predict_fn = functools.partial(
         model.estimate_poses_batched, internal_batch_size=FLAGS.internal_batch_size,
         num_aug=FLAGS.num_aug, antialias_factor=2,
-        weights=model.get_weights_for_canonical_points(cano_points))
+        weights=weights_cache.get_weights_for_canonical_points(
+            model, FLAGS.model_path, cano_points))
 
     viz = poseviz.PoseViz(
         ji3d.names, ji3d.stick_figure_edges, world_up=(0, 0, 1), ground_plane_height=0,
@@ -13,6 +13,8 @@ import torchvision  # noqa: F401
 from posepile.paths import DATA_ROOT
 from simplepyutils import FLAGS
 import nlf.matlabfile
+from nlf.pt.models import weight_application
+from nlf.pt.multiperson import weights_cache
 from nlf.pt.inference_scripts.predict_tdpw import (
     get_joint_info,
     precuda,
@@ -37,6 +39,7 @@ def initialize():
 def main():
     initialize()
     model = torch.jit.load(FLAGS.model_path)
+    weight_application.set_device_name(model, 'cuda')
     skeleton = 'mpi_inf_3dhp_17'
     ji3d = get_joint_info(model, skeleton)
 
@@ -47,7 +50,8 @@ def main():
         model.detect_poses_batched, internal_batch_size=FLAGS.internal_batch_size,
         num_aug=FLAGS.num_aug, detector_threshold=0.2, detector_nms_iou_threshold=0.7,
         detector_flip_aug=True, antialias_factor=2, suppress_implausible_poses=False,
-        weights=model.get_weights_for_canonical_points(cano_points))
+        weights=weights_cache.get_weights_for_canonical_points(
+            model, FLAGS.model_path, cano_points))
 
     viz = poseviz.PoseViz(
         ji3d.names, ji3d.stick_figure_edges, world_up=(0, -1, 0), downscale=4,
@@ -22,6 +22,8 @@ from nlf.pt.inference_scripts.predict_tdpw import (
     precuda,
     ragged_split,
 )
+from nlf.pt.models import weight_application
+from nlf.pt.multiperson import weights_cache
 
 
 def initialize():
@@ -42,6 +44,7 @@ def main():
     initialize()
     logger.info('Loading model...')
     model = torch.jit.load(FLAGS.model_path)
+    weight_application.set_device_name(model, 'cuda')
     logger.info('Model loaded.')
 
     body_model_name = 'smpl'
@@ -60,7 +63,7 @@ def main():
         internal_batch_size=FLAGS.internal_batch_size,
         num_aug=FLAGS.num_aug,
         antialias_factor=FLAGS.antialias_factor,
-        weights=model.get_weights_for_canonical_points(cano_all),
+        weights=weights_cache.get_weights_for_canonical_points(model, FLAGS.model_path, cano_all),
     )
 
     labels = np.load(f'{DATA_ROOT}/ssp_3d/labels.npz')
@@ -22,6 +22,9 @@ from posepile.joint_info import JointInfo
 from simplepyutils import FLAGS, logger
 
 from nlf.paths import DATA_ROOT, PROJDIR
+from nlf.pt.models import weight_application
+from nlf.pt.multiperson import weights_cache
+from nlf.pt.multiperson.packed import PackedResult
 from nlf.rendering import Renderer
 
 
@@ -47,6 +50,7 @@ def main():
     initialize()
     logger.info('Loading model...')
     model = torch.jit.load(FLAGS.model_path)
+    weight_application.set_device_name(model, 'cuda')
     logger.info('Model loaded.')
 
     ji3d = get_joint_info(model, 'smpl_24')
@@ -68,7 +72,8 @@ def main():
         antialias_factor=FLAGS.antialias_factor,
         suppress_implausible_poses=False,
         detector_flip_aug=True,
-        weights=model.get_weights_for_canonical_points(cano_all),
+        weights=weights_cache.get_weights_for_canonical_points(model, FLAGS.model_path, cano_all),
+        packed=True,
     )
 
     seq_filepaths = spu.sorted_recursive_glob(f'{DATA_ROOT}/3dpw/sequenceFiles/*/*.pkl')
@@ -164,14 +169,17 @@ def predict_sequence(
             camera_batch = itertools.repeat(None)
             pred = predict_fn(frames_gpu)
 
-        pred['poses3d'] = ragged_concat(
-            pred['poses3d'], [x[..., torch.newaxis] for x in pred['uncertainties']], dim=-1
+        pred = PackedResult(pred)
+        pred.data['poses3d'] = torch.cat(
+            [pred['poses3d'], pred['uncertainties'][..., torch.newaxis]], dim=-1
         )
-        pred = to_np(pred)
+        pred = pred.to_numpy()
 
-        for frame, boxes, poses3d, poses2d, camera in zip(
-            frames_cpu, pred['boxes'], pred['poses3d'], pred['poses2d'], camera_batch
-        ):
+        for i_image, (frame, camera) in enumerate(zip(frames_cpu, camera_batch)):
+            image_pred = pred.image(i_image)
+            boxes = image_pred['boxes']
+            poses3d = image_pred['poses3d']
+            poses2d = image_pred['poses2d']
             if FLAGS.gtassoc:
                 poses3d_ordered, prev_poses2d_pred_ordered = associate_predictions(
                     poses3d,
@@ -281,6 +281,12 @@ def get_parser(parent_parser=None):
     parser.add_argument('--stride-train', type=int, default=32)
     parser.add_argument('--stride-test', type=int, default=32)
     parser.add_argument('--centered-stride', action=spu.argparse.BoolAction, default=True)
+    parser.add_argument(
+        '--autotune-weight-application',
+        action=spu.argparse.BoolAction,
+        help='Benchmark the ways of applying the localizer weights per shape and use the '
+        'fastest, see nlf/pt/models/weight_application.py',
+    )
 
     # Data
     parser.add_argument('--image-barecat-path', type=str)
@@ -1,4 +1,4 @@
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import simplepyutils as spu
@@ -8,14 +8,19 @@ import torch.nn.functional as F
 
 from nlf.paths import PROJDIR
 from nlf.pt import ptu, ptu3d
-from nlf.pt.models import util as model_util
+from nlf.pt.models import util as model_util, weight_application
 from simplepyutils import FLAGS
 
 
 class NLFModel(nn.Module):
-    def __init__(self, backbone, weight_field, normalizer, backbone_channels=1280):
+    def __init__(
+        self, backbone, weight_field, normalizer, backbone_channels=1280, compute_dtype='float16'
+    ):
         super().__init__()
         self.backbone = backbone
+        # The dtype of the weights returned by get_weights_for_canonical_points, which should
+        # match the dtype of the backbone and the heatmap head at inference time
+        self.compute_dtype = compute_dtype
         self.heatmap_head = LocalizerHead(weight_field, normalizer, in_channels=backbone_channels)
         self.input_resolution = FLAGS.proc_side
 
@@ -89,23 +94,82 @@ class NLFModel(nn.Module):
         intrinsic_matrix: torch.Tensor,
         weights: Dict[str, torch.Tensor],
         flip_canonicals_per_image: torch.Tensor,
+        point_splits: Optional[List[int]] = None,
     ):
-        features_processed = self.get_features(image)
-        coords2d, coords3d, uncertainties = self.heatmap_head.decode_features_multi_same_weights(
-            features_processed, weights, flip_canonicals_per_image
+        handle = self.get_feature_handle(image, intrinsic_matrix, flip_canonicals_per_image)
+        return self.decode_feature_handle(handle, weights, point_splits)
+
+    @torch.jit.export
+    def get_feature_handle(
+        self,
+        image: torch.Tensor,
+        intrinsic_matrix: torch.Tensor,
+        flip_canonicals_per_image: torch.Tensor,
+    ) -> Dict[str, torch.Tensor]:
+        """Runs the backbone on the crops, to decode any number of point sets with
+        decode_feature_handle, without running the backbone again for each."""
+        with torch.autograd.profiler.record_function('nlf.backbone'):
+            features_processed = self.get_features(image)
+        return dict(
+            features=features_processed,
+            intrinsic_matrix=intrinsic_matrix,
+            flip_canonicals_per_image=flip_canonicals_per_image,
         )
 
-        with torch.amp.autocast('cuda', enabled=False):
-            return self.heatmap_head.reconstruct_absolute(
-                coords2d.float(), coords3d.float(), uncertainties.float(), intrinsic_matrix.float()
+    @torch.jit.export
+    def decode_feature_handle(
+        self,
+        handle: Dict[str, torch.Tensor],
+        weights: Dict[str, torch.Tensor],
+        point_splits: Optional[List[int]] = None,
+    ):
+        """Predicts the points of the weights (see get_weights_for_canonical_points) on crops
+        encoded with get_feature_handle.
+
+        Several point sets can be decoded at once by concatenating their weights along the
+        points, then point_splits gives the number of points in each set. Each set is then
+        reconstructed in 3D on its own, so the result is the same as decoding them one by one,
+        but with a single, larger localizer head convolution.
+        """
+        with torch.autograd.profiler.record_function('nlf.localizer_head'):
+            coords2d, coords3d, uncertainties = (
+                self.heatmap_head.decode_features_multi_same_weights(
+                    handle['features'], weights, handle['flip_canonicals_per_image']
+                )
             )
 
+        with torch.autograd.profiler.record_function('nlf.reconstruct_absolute'):
+            with torch.amp.autocast('cuda', enabled=False):
+                intrinsic_matrix = handle['intrinsic_matrix'].float()
+                if point_splits is None:
+                    return self.heatmap_head.reconstruct_absolute(
+                        coords2d.float(), coords3d.float(), uncertainties.float(), intrinsic_matrix
+                    )
+
+                poses3d_list = []
+                uncertainties_list = []
+                for coords2d_, coords3d_, uncert_ in zip(
+                    torch.split(coords2d, point_splits, dim=1),
+                    torch.split(coords3d, point_splits, dim=1),
+                    torch.split(uncertainties, point_splits, dim=1),
+                ):
+                    poses3d_, uncert_abs_ = self.heatmap_head.reconstruct_absolute(
+                        coords2d_.float(), coords3d_.float(), uncert_.float(), intrinsic_matrix
+                    )
+                    poses3d_list.append(poses3d_)
+                    uncertainties_list.append(uncert_abs_)
+                return torch.cat(poses3d_list, dim=1), torch.cat(uncertainties_list, dim=1)
+
     @torch.jit.export
     def get_weights_for_canonical_points(self, canonical_points: torch.Tensor):
-        return self.heatmap_head.get_weights_for_canonical_points(canonical_points)
+        return self.heatmap_head.get_weights_for_canonical_points(
+            canonical_points, ptu.dtype_from_name(self.compute_dtype)
+        )
 
 
 class LocalizerHead(nn.Module):
+    weight_application_methods: Dict[str, str]
+
     def __init__(self, weight_field, normalizer, in_channels=1280):
         super().__init__()
         self.uncert_bias = FLAGS.uncert_bias
@@ -120,6 +184,40 @@ class LocalizerHead(nn.Module):
         self.fix_uncert_factor = FLAGS.fix_uncert_factor
         self.mix_3d_inside_fov = FLAGS.mix_3d_inside_fov
         self.weak_perspective = FLAGS.weak_perspective
+        # The decoding of shared weights (apply_weights3d_same_canonicals_impl) is split into
+        # chunks of points, and of crops if needed, so that the intermediate heatmaps stay within
+        # this many megabytes. 0 means no limit. The point chunk size can also be set directly.
+        self.decode_memory_budget_mb = 0
+        self.decode_point_chunk_size = 0
+        # On the CPU, the heatmaps are decoded in blocks of about this many bytes, which stay in
+        # the cache while they are decoded, see model_util.decode_heatmaps_fused
+        self.decode_block_bytes_cpu = 4 * 2**20
+        # How decode_features_multi_same_weights handles the crops that use flipped weights:
+        # 'partition' decodes the flipped and unflipped crops separately, 'select' applies both
+        # weight sets to all crops in one conv and selects per crop, which avoids data-dependent
+        # shapes but does twice the conv work and memory. 'auto' uses 'select', except on the
+        # CPU, where the doubled conv work makes it slower at all sizes, and where the doubled
+        # memory would need more chunks under decode_memory_budget_mb. flip_select_max_items
+        # optionally limits 'select' to this many crop-points (0 means no limit), e.g., from
+        # measurements with benchmarks/flip_strategy.py.
+        self.flip_strategy = 'auto'
+        self.flip_select_max_items = 0
+        # The fastest way to apply the weights to the features, by shape signature, see
+        # weight_application.py. In eager mode, missing entries are tuned if enabled.
+        self.weight_application_methods = {}
+        # The device name for the signatures in the scripted model, which cannot query it, see
+        # weight_application.set_device_name. Empty means unknown, so the defaults are used.
+        self.device_name = ''
+        self.autotune_weight_application = FLAGS.autotune_weight_application
+        # The coordinates of the heatmap cells at the test stride, for the fused decoding
+        self.heatmap_side = self.proc_side // self.stride_test
+        self.heatmap_coords25d = nn.Buffer(
+            model_util.heatmap_coords([self.depth, self.heatmap_side, self.heatmap_side]),
+            persistent=False,
+        )
+        self.heatmap_coords2d = nn.Buffer(
+            model_util.heatmap_coords([self.heatmap_side, self.heatmap_side]), persistent=False
+        )
         self.layer = nn.Sequential(
             nn.Conv2d(in_channels, self.backbone_link_dim, kernel_size=1, bias=False),
             normalizer(self.backbone_link_dim),
@@ -178,23 +276,14 @@ class LocalizerHead(nn.Module):
         weights_resh = torch.unflatten(
             weights, -1, (features.shape[1] + 1, n_out_channels)
         )  # NPC(c+1)
-        w_tensor = weights_resh[..., :-1, :]  # NPCc
+        w_tensor = weights_resh[..., :-1, :]  # NPcC
         b_tensor = weights_resh[..., -1, :]  # NPC
-        # TODO: check if a different einsum order would be faster
-        logits = (
-            torch.einsum('nchw,npcC->npChw', features, w_tensor)
-            + b_tensor[:, :, :, torch.newaxis, torch.newaxis]
+        method = self.weight_application_method(
+            True, features, w_tensor.shape[1], w_tensor, b_tensor
+        )
+        logits = weight_application.apply_per_example_weights(
+            method, features, w_tensor, b_tensor
         ).float()
-        # This is an alternative to the einsum above (perhaps faster, perhaps not; because
-        # the addition is done in the same call)
-        # features_ = features.flatten(2, 3)
-        # w_tensor_ = w_tensor.mT.flatten(1, 2)
-        # b_tensor_ = b_tensor.flatten(1, 2).unsqueeze(-1)
-        # logits = (
-        #     torch.baddbmm(b_tensor_, w_tensor_, features_)
-        #     .unflatten(1, (-1, n_out_channels))
-        #     .unflatten(-1, (features.shape[2], features.shape[3]))
-        # )
 
         uncertainty_map = logits[:, :, 0]
         coords_metric_xy = ptu.soft_argmax(logits[:, :, 1], dim=[3, 2])
@@ -209,6 +298,43 @@ class LocalizerHead(nn.Module):
         coords3d = torch.cat([coords_metric_xy, coords25d[..., 2:]], dim=-1)
         return coords2d, coords3d, uncertainties
 
+    @torch.jit.export
+    def weight_application_method(
+        self,
+        per_example: bool,
+        features: torch.Tensor,
+        n_points: int,
+        w_tensor: torch.Tensor,
+        b_tensor: torch.Tensor,
+    ) -> str:
+        device_name = self.device_name
+        if not torch.jit.is_scripting():
+            device_name = weight_application.get_device_name(features.device)
+        signature = weight_application.shape_signature(
+            per_example, features, n_points, 2 + self.depth, device_name
+        )
+        if signature in self.weight_application_methods:
+            return self.weight_application_methods[signature]
+        if not torch.jit.is_scripting() and self.autotune_weight_application:
+            method = self.autotune(signature, per_example, features, w_tensor, b_tensor)
+            self.weight_application_methods[signature] = method
+            return method
+        # The defaults before autotuning was added
+        return 'einsum' if per_example else 'conv2d'
+
+    @torch.jit.unused
+    def autotune(
+        self,
+        signature: str,
+        per_example: bool,
+        features: torch.Tensor,
+        w_tensor: torch.Tensor,
+        b_tensor: torch.Tensor,
+    ) -> str:
+        return weight_application.get_autotuner().choose(
+            signature, per_example, features, w_tensor, b_tensor
+        )
+
     @torch.jit.export
     def transpose_weights(self, weights: torch.Tensor, n_in_channels: int):
         n_out_channels = 2 + self.depth
@@ -228,45 +354,156 @@ class LocalizerHead(nn.Module):
 
     @torch.jit.export
     def apply_weights3d_same_canonicals_impl(
-        self, features: torch.Tensor, w_tensor: torch.Tensor, b_tensor: torch.Tensor
+        self,
+        features: torch.Tensor,
+        w_tensor: torch.Tensor,
+        b_tensor: torch.Tensor,
+        w_tensor_flipped: Optional[torch.Tensor] = None,
+        b_tensor_flipped: Optional[torch.Tensor] = None,
+        flip: Optional[torch.Tensor] = None,
     ):
         # features: nchw 128,1280,8,8
-        # w_tensor: cpC 1280,768,10
+        # w_tensor: PCc 768,10,1280
+        # If flip is given, the crops where it is True are decoded with the flipped weights
+        n_crops = features.shape[0]
+        n_points = w_tensor.shape[0]
+        crop_chunk_size, point_chunk_size = self.decode_chunk_sizes(
+            n_crops,
+            n_points,
+            features.shape[2] * features.shape[3],
+            features.element_size(),
+            n_weight_sets=1 if flip is None else 2,
+        )
+        if crop_chunk_size >= n_crops and point_chunk_size >= n_points:
+            return self.apply_weights3d_same_canonicals_chunk(
+                features, w_tensor, b_tensor, w_tensor_flipped, b_tensor_flipped, flip
+            )
+
+        # Decode chunk by chunk into preallocated outputs, so the heatmaps of only one chunk
+        # exist at a time
+        device = features.device
+        coords2d = torch.empty((n_crops, n_points, 2), dtype=torch.float32, device=device)
+        coords3d = torch.empty((n_crops, n_points, 3), dtype=torch.float32, device=device)
+        uncertainties = torch.empty((n_crops, n_points), dtype=torch.float32, device=device)
+        for i_crop in range(0, n_crops, crop_chunk_size):
+            crop_end = min(i_crop + crop_chunk_size, n_crops)
+            flip_chunk: Optional[torch.Tensor] = None
+            if flip is not None:
+                flip_chunk = flip[i_crop:crop_end]
+            for i_point in range(0, n_points, point_chunk_size):
+                point_end = min(i_point + point_chunk_size, n_points)
+                w_tensor_flipped_chunk: Optional[torch.Tensor] = None
+                b_tensor_flipped_chunk: Optional[torch.Tensor] = None
+                if w_tensor_flipped is not None and b_tensor_flipped is not None:
+                    w_tensor_flipped_chunk = w_tensor_flipped[i_point:point_end]
+                    b_tensor_flipped_chunk = b_tensor_flipped[i_point:point_end]
+                coords2d_, coords3d_, uncertainties_ = self.apply_weights3d_same_canonicals_chunk(
+                    features[i_crop:crop_end],
+                    w_tensor[i_point:point_end],
+                    b_tensor[i_point:point_end],
+                    w_tensor_flipped_chunk,
+                    b_tensor_flipped_chunk,
+                    flip_chunk,
+                )
+                coords2d[i_crop:crop_end, i_point:point_end] = coords2d_
+                coords3d[i_crop:crop_end, i_point:point_end] = coords3d_
+                uncertainties[i_crop:crop_end, i_point:point_end] = uncertainties_
+        return coords2d, coords3d, uncertainties
+
+    @torch.jit.export
+    def decode_chunk_sizes(
+        self,
+        n_crops: int,
+        n_points: int,
+        n_pixels: int,
+        element_size: int,
+        n_weight_sets: int = 1,
+    ) -> Tuple[int, int]:
+        # Returns the number of crops and points to decode at once
+        point_chunk_size = n_points
+        if self.decode_point_chunk_size > 0:
+            point_chunk_size = min(self.decode_point_chunk_size, n_points)
+        if self.decode_memory_budget_mb <= 0:
+            return n_crops, point_chunk_size
+
+        # Approximate size of the intermediate results per crop and point: the logits in the
+        # compute dtype and in float32 (exponentiated in place) and the 2D marginal heatmap.
+        # With flip selection, the logits of both weight sets are computed before selecting.
         n_out_channels = 2 + self.depth
-        # old:
-        # w_tensor = torch.flatten(w_tensor, start_dim=-2, end_dim=-1).mT.unsqueeze(-1).unsqueeze(-1)
-        # w_tensor = w_tensor.contiguous()  # (pC)c11
+        bytes_per_item = n_pixels * (n_out_channels * (element_size + 4) * n_weight_sets + 4)
+        max_items = max(1, self.decode_memory_budget_mb * 1024 * 1024 // bytes_per_item)
+        if self.decode_point_chunk_size <= 0:
+            # Prefer chunking the points, as long as the chunks are not too small for the conv
+            point_chunk_size = min(n_points, max(max_items // max(n_crops, 1), 64))
+        crop_chunk_size = max(1, min(n_crops, max_items // point_chunk_size))
+        return crop_chunk_size, point_chunk_size
 
-        # new:
-        w_tensor = torch.flatten(w_tensor, start_dim=0, end_dim=1).unsqueeze(-1).unsqueeze(-1)
+    @torch.jit.export
+    def apply_weights3d_same_canonicals_chunk(
+        self,
+        features: torch.Tensor,
+        w_tensor: torch.Tensor,
+        b_tensor: torch.Tensor,
+        w_tensor_flipped: Optional[torch.Tensor] = None,
+        b_tensor_flipped: Optional[torch.Tensor] = None,
+        flip: Optional[torch.Tensor] = None,
+    ):
+        n_out_channels = 2 + self.depth
+        flip_select: Optional[torch.Tensor] = None
+        if flip is not None and w_tensor_flipped is not None and b_tensor_flipped is not None:
+            # Both weight sets are applied at once, the logits of each crop are selected after
+            w_tensor = torch.cat([w_tensor, w_tensor_flipped], dim=0)
+            b_tensor = torch.cat([b_tensor, b_tensor_flipped], dim=0)
+            flip_select = flip
+        n_points = w_tensor.shape[0]
+        w_tensor = torch.flatten(w_tensor, start_dim=0, end_dim=1)  # (PC)c
         b_tensor = b_tensor.reshape(-1)
-        #
-
-        logits = F.conv2d(features, w_tensor, bias=b_tensor).float()
+        method = self.weight_application_method(False, features, n_points, w_tensor, b_tensor)
+        logits = weight_application.apply_shared_weights(
+            method, features, w_tensor, b_tensor
+        ).float()
         logits = torch.unflatten(logits, 1, (-1, n_out_channels))  # npChw
-        uncertainty_map = logits[:, :, 0]
-
-        coords_metric_xy = ptu.soft_argmax(logits[:, :, 1], dim=[3, 2])
-        heatmap25d = ptu.softmax(logits[:, :, 2:], dim=[4, 3, 2])
-        heatmap2d = torch.sum(heatmap25d, dim=2)
-
-        # old slower: uncertainties = torch.sum(uncertainty_map * heatmap2d.detach(), dim=[3, 2])
-        uncertainties = torch.einsum('nphw,nphw->np', uncertainty_map, heatmap2d.detach())
+        if flip_select is not None:
+            logits = torch.unflatten(logits, 1, (2, -1))  # n2pChw
+            crop_indices = torch.arange(logits.shape[0], device=logits.device)
+            logits = logits[crop_indices, flip_select.to(torch.int64)]
+
+        # The softmax, the expected coordinates and the uncertainty are computed in one pass
+        height, width = logits.shape[3], logits.shape[4]
+        cell_coords25d, cell_coords2d = self.get_heatmap_coords(height, width, logits.device)
+        block_size = 0
+        if logits.device.type == 'cpu':
+            bytes_per_heatmap = n_out_channels * height * width * 4
+            block_size = max(1, self.decode_block_bytes_cpu // bytes_per_heatmap)
+        coords2d, coords3d, uncertainties = model_util.decode_heatmaps_fused(
+            logits, cell_coords25d, cell_coords2d, block_size
+        )
         uncertainties = F.softplus(uncertainties + self.uncert_bias) + self.uncert_bias2
-        coords25d = ptu.decode_heatmap(heatmap25d, dim=[4, 3, 2])
-        coords2d = coords25d[..., :2]
-        coords3d = torch.cat([coords_metric_xy, coords25d[..., 2:]], dim=-1)
         return coords2d, coords3d, uncertainties
 
     @torch.jit.export
-    def get_weights_for_canonical_points(self, canonical_points: torch.Tensor):
+    def get_heatmap_coords(self, height: int, width: int, device: torch.device):
+        if height == self.heatmap_side and width == self.heatmap_side:
+            return self.heatmap_coords25d, self.heatmap_coords2d
+        # The input resolution differs from the one the model was built for
+        return (
+            model_util.heatmap_coords([self.depth, height, width], device),
+            model_util.heatmap_coords([height, width], device),
+        )
+
+    @torch.jit.export
+    def get_weights_for_canonical_points(
+        self, canonical_points: torch.Tensor, dtype: torch.dtype = torch.float16
+    ):
         weights = self.weight_field(canonical_points)
-        w_tensor, b_tensor = self.transpose_weights(weights.half(), self.backbone_link_dim)
+        w_tensor, b_tensor = self.transpose_weights(weights.to(dtype), self.backbone_link_dim)
         weights_fl = self.weight_field(
             canonical_points
             * torch.tensor([-1, 1, 1], dtype=torch.float32, device=canonical_points.device)
         )
-        w_tensor_fl, b_tensor_fl = self.transpose_weights(weights_fl.half(), self.backbone_link_dim)
+        w_tensor_fl, b_tensor_fl = self.transpose_weights(
+            weights_fl.to(dtype), self.backbone_link_dim
+        )
         return dict(
             w_tensor=w_tensor,
             b_tensor=b_tensor,
@@ -280,6 +517,74 @@ class LocalizerHead(nn.Module):
         features: torch.Tensor,
         weights: Dict[str, torch.Tensor],
         flip_canonicals_per_image: torch.Tensor,
+    ):
+        if self.use_flip_select(
+            features.device,
+            features.shape[0],
+            weights['w_tensor'].shape[0],
+            features.shape[2] * features.shape[3],
+            features.element_size(),
+        ):
+            coords2d, coords3d, uncertainties = self.apply_weights3d_same_canonicals_impl(
+                features,
+                weights['w_tensor'].to(features.dtype),
+                weights['b_tensor'].to(features.dtype),
+                weights['w_tensor_flipped'].to(features.dtype),
+                weights['b_tensor_flipped'].to(features.dtype),
+                flip_canonicals_per_image,
+            )
+        else:
+            coords2d, coords3d, uncertainties = self.decode_flip_partitioned(
+                features, weights, flip_canonicals_per_image
+            )
+
+        coords2d = model_util.heatmap_to_image(
+            coords2d, self.proc_side, self.stride_test, self.centered_stride
+        )
+        coords3d = model_util.heatmap_to_metric(
+            coords3d,
+            self.proc_side,
+            self.stride_test,
+            self.centered_stride,
+            self.box_size_m,
+        )
+        return coords2d, coords3d, uncertainties
+
+    @torch.jit.export
+    def use_flip_select(
+        self, device: torch.device, n_crops: int, n_points: int, n_pixels: int, element_size: int
+    ) -> bool:
+        if self.flip_strategy != 'auto':
+            return self.flip_strategy == 'select'
+        if device.type == 'cpu':
+            return False
+        if self.flip_select_max_items > 0 and n_crops * n_points > self.flip_select_max_items:
+            return False
+        if self.decode_memory_budget_mb <= 0:
+            return True
+        # The single conv is only worth it if the doubled memory does not make the budget split
+        # the decoding into more chunks than with one weight set
+        n_chunks_select = self.num_decode_chunks(n_crops, n_points, n_pixels, element_size, 2)
+        n_chunks_partition = self.num_decode_chunks(n_crops, n_points, n_pixels, element_size, 1)
+        return n_chunks_select <= n_chunks_partition
+
+    @torch.jit.export
+    def num_decode_chunks(
+        self, n_crops: int, n_points: int, n_pixels: int, element_size: int, n_weight_sets: int
+    ) -> int:
+        crop_chunk_size, point_chunk_size = self.decode_chunk_sizes(
+            n_crops, n_points, n_pixels, element_size, n_weight_sets
+        )
+        n_crop_chunks = (n_crops + crop_chunk_size - 1) // crop_chunk_size
+        n_point_chunks = (n_points + point_chunk_size - 1) // point_chunk_size
+        return n_crop_chunks * n_point_chunks
+
+    @torch.jit.export
+    def decode_flip_partitioned(
+        self,
+        features: torch.Tensor,
+        weights: Dict[str, torch.Tensor],
+        flip_canonicals_per_image: torch.Tensor,
     ):
         features_processed = features
         flip_canonicals_per_image_ind = flip_canonicals_per_image.to(torch.int32)
@@ -293,27 +598,20 @@ class LocalizerHead(nn.Module):
             2,
         )
         nfl_coords2d, nfl_coords3d, nfl_uncertainties = self.apply_weights3d_same_canonicals_impl(
-            nfl_features_processed, weights['w_tensor'], weights['b_tensor']
+            nfl_features_processed,
+            weights['w_tensor'].to(features.dtype),
+            weights['b_tensor'].to(features.dtype),
         )
         fl_coords2d, fl_coords3d, fl_uncertainties = self.apply_weights3d_same_canonicals_impl(
-            fl_features_processed, weights['w_tensor_flipped'], weights['b_tensor_flipped']
+            fl_features_processed,
+            weights['w_tensor_flipped'].to(features.dtype),
+            weights['b_tensor_flipped'].to(features.dtype),
         )
         coords2d = ptu.dynamic_stitch(partitioned_indices, [nfl_coords2d, fl_coords2d])
         coords3d = ptu.dynamic_stitch(partitioned_indices, [nfl_coords3d, fl_coords3d])
         uncertainties = ptu.dynamic_stitch(
             partitioned_indices, [nfl_uncertainties, fl_uncertainties]
         )
-
-        coords2d = model_util.heatmap_to_image(
-            coords2d, self.proc_side, self.stride_test, self.centered_stride
-        )
-        coords3d = model_util.heatmap_to_metric(
-            coords3d,
-            self.proc_side,
-            self.stride_test,
-            self.centered_stride,
-            self.box_size_m,
-        )
         return coords2d, coords3d, uncertainties
 
     @torch.jit.export
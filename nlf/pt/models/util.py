@@ -1,5 +1,7 @@
 import torch
-from typing import Optional
+from typing import List, Optional
+
+from nlf.pt import ptu
 
 
 def heatmap_to_image(coords: torch.Tensor, proc_side: int, stride: int, centered_stride: bool):
@@ -33,3 +35,96 @@ def heatmap_to_metric(
     coords2d = heatmap_to_image(xy, proc_side, stride, centered_stride) * box_size_m / proc_side
 
     return torch.cat([coords2d, coords[..., 2:] * box_size_m], dim=-1)
+
+
+def heatmap_coords(shape: List[int], device: Optional[torch.device] = None):
+    """Returns the coordinates of the cells of a heatmap of the given shape (e.g., [depth, height,
+    width]) as rows [1, x, y, ...], where x is along the last axis, y along the one before it,
+    etc., each in [0, 1] like in ptu.decode_heatmap. The leading 1 gives the normalizer when
+    multiplying exponentiated logits with these rows, see decode_heatmaps_fused."""
+    axes = [ptu.linspace(0.0, 1.0, n, dtype=torch.float32, device=device) for n in shape]
+    grids = torch.meshgrid(axes, indexing='ij')
+    columns = [torch.ones_like(grids[0])]
+    for i_axis in range(len(shape) - 1, -1, -1):
+        columns.append(grids[i_axis])
+    return torch.stack([c.reshape(-1) for c in columns], dim=-1)
+
+
+def decode_heatmaps_fused(
+    logits: torch.Tensor, coords25d: torch.Tensor, coords2d: torch.Tensor, block_size: int = 0
+):
+    """Decodes the logits of the localizer head, of shape [N, P, 2 + depth, H, W], which hold
+    the uncertainty map, the metric xy heatmap and the 2.5D heatmap of each point.
+
+    Gives the same result as softmaxing the heatmaps, taking the expected coordinates
+    (ptu.soft_argmax, ptu.decode_heatmap) and weighting the uncertainty map with the 2D marginal
+    of the 2.5D heatmap, but the normalized heatmaps are never materialized. The normalizer and
+    the expectations along all axes are obtained with one product of the exponentiated logits
+    with the cell coordinates (coords25d and coords2d, see heatmap_coords).
+
+    Without gradient tracking, the logits are exponentiated in place. With block_size > 0, the
+    N * P heatmaps are processed in blocks of this many, so that on the CPU a block stays in the
+    cache across the passes over it.
+
+    Returns the 2D coordinates [N, P, 2], the 3D coordinates (metric xy and depth) [N, P, 3],
+    and the uncertainties before the softplus [N, P].
+    """
+    n, p = logits.shape[0], logits.shape[1]
+    logits = logits.flatten(0, 1).flatten(2)  # [NP, C, HW]
+    n_rows = logits.shape[0]
+    if block_size <= 0 or block_size >= n_rows:
+        coords2d_out, coords3d_out, uncertainties = _decode_heatmaps_block(
+            logits, coords25d, coords2d
+        )
+    else:
+        coords2d_out = torch.empty((n_rows, 2), dtype=logits.dtype, device=logits.device)
+        coords3d_out = torch.empty((n_rows, 3), dtype=logits.dtype, device=logits.device)
+        uncertainties = torch.empty((n_rows,), dtype=logits.dtype, device=logits.device)
+        for start in range(0, n_rows, block_size):
+            end = min(start + block_size, n_rows)
+            coords2d_block, coords3d_block, uncertainties_block = _decode_heatmaps_block(
+                logits[start:end], coords25d, coords2d
+            )
+            coords2d_out[start:end] = coords2d_block
+            coords3d_out[start:end] = coords3d_block
+            uncertainties[start:end] = uncertainties_block
+
+    return (
+        coords2d_out.reshape(n, p, 2),
+        coords3d_out.reshape(n, p, 3),
+        uncertainties.reshape(n, p),
+    )
+
+
+def _decode_heatmaps_block(logits: torch.Tensor, coords25d: torch.Tensor, coords2d: torch.Tensor):
+    # logits: [M, 2 + depth, HW]
+    inplace = not torch.is_grad_enabled()
+    depth = logits.shape[1] - 2
+    n_pixels = logits.shape[2]
+    uncertainty_map = logits[:, 0]
+
+    exp_xy = _exp_shifted(logits[:, 1], inplace)
+    sums_xy = exp_xy @ coords2d.to(logits.dtype)  # [M, 3]: normalizer, x, y
+    coords_metric_xy = sums_xy[:, 1:] / sums_xy[:, :1]
+
+    exp25d = _exp_shifted(logits[:, 2:].flatten(1), inplace)
+    sums25d = exp25d @ coords25d.to(logits.dtype)  # [M, 4]: normalizer, x, y, depth
+    normalizer25d = sums25d[:, :1]
+    coords25d_out = sums25d[:, 1:] / normalizer25d
+
+    # As in the unfused version, no gradient flows to the heatmap through the uncertainty
+    heatmap2d_unnormalized = torch.sum(exp25d.detach().unflatten(1, (depth, n_pixels)), dim=1)
+    uncertainties = torch.einsum('mk,mk->m', uncertainty_map, heatmap2d_unnormalized)
+    uncertainties = uncertainties / normalizer25d.detach().squeeze(1)
+
+    coords2d_out = coords25d_out[:, :2]
+    coords3d_out = torch.cat([coords_metric_xy, coords25d_out[:, 2:]], dim=-1)
+    return coords2d_out, coords3d_out, uncertainties
+
+
+def _exp_shifted(x: torch.Tensor, inplace: bool):
+    # exp(x - max(x)) along the last axis, the unnormalized softmax
+    x_max = torch.amax(x, dim=-1, keepdim=True)
+    if inplace:
+        return x.sub_(x_max).exp_()
+    return torch.exp(x - x_max)
@@ -0,0 +1,209 @@
+"""Implementations of applying the localizer field weights to the backbone features, and an
+autotuner that picks the fastest one per shape, dtype and device.
+
+There are two cases: the same weights for all crops (inference, see
+LocalizerHead.apply_weights3d_same_canonicals_impl) and different weights per crop (training,
+see LocalizerHead.apply_weights3d). Each can be computed as an einsum, a batched matrix product
+with the bias added in the same call (baddbmm), a matrix product with the spatial dimensions
+flattened, or a 1x1 convolution (grouped by crop in the per-crop case). Which is fastest depends
+on the shapes, the dtype and the device.
+
+The choice is stored in LocalizerHead.weight_application_methods by shape_signature, so it is
+also available to the scripted model. In eager mode, signatures that are not there yet are
+tuned by benchmarking all methods, if the head has autotune_weight_application enabled
+(--autotune-weight-application). The signature includes the device name, so choices tuned on
+one GPU are not used on another. The scripted model cannot query the device name, so it uses
+LocalizerHead.device_name, which the inference scripts set after loading with set_device_name.
+Without that, it is empty and the scripted model uses the default methods.
+"""
+
+import functools
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+SHARED_METHODS = ('conv2d', 'einsum', 'matmul', 'baddbmm')
+PER_EXAMPLE_METHODS = ('einsum', 'baddbmm', 'matmul', 'conv2d')
+
+
+def apply_shared_weights(
+    method: str, features: torch.Tensor, w_tensor: torch.Tensor, b_tensor: torch.Tensor
+):
+    """Applies the same weights to all crops.
+
+    Args:
+        features: [N, c, H, W]
+        w_tensor: [K, c], where K is the number of points times the output channels per point
+        b_tensor: [K]
+
+    Returns:
+        [N, K, H, W]
+    """
+    if method == 'conv2d':
+        return F.conv2d(features, w_tensor.unsqueeze(-1).unsqueeze(-1), bias=b_tensor)
+    if method == 'einsum':
+        return torch.einsum('nchw,kc->nkhw', features, w_tensor) + b_tensor[:, None, None]
+
+    n, _, h, w = features.shape
+    features_flat = features.flatten(2)  # ncX
+    if method == 'matmul':
+        logits = w_tensor @ features_flat + b_tensor[:, None]
+    elif method == 'baddbmm':
+        logits = torch.baddbmm(
+            b_tensor[None, :, None].expand(n, -1, features_flat.shape[2]),
+            w_tensor.expand(n, -1, -1),
+            features_flat,
+        )
+    else:
+        raise ValueError(f'Unknown weight application method {method}')
+    return logits.unflatten(2, (h, w))
+
+
+def apply_per_example_weights(
+    method: str, features: torch.Tensor, w_tensor: torch.Tensor, b_tensor: torch.Tensor
+):
+    """Applies different weights to each crop.
+
+    Args:
+        features: [N, c, H, W]
+        w_tensor: [N, P, c, C]
+        b_tensor: [N, P, C]
+
+    Returns:
+        [N, P, C, H, W]
+    """
+    if method == 'einsum':
+        return (
+            torch.einsum('nchw,npcC->npChw', features, w_tensor)
+            + b_tensor[:, :, :, torch.newaxis, torch.newaxis]
+        )
+
+    n, c, h, w = features.shape
+    n_points, n_out_channels = w_tensor.shape[1], w_tensor.shape[3]
+    w_tensor_flat = w_tensor.mT.flatten(1, 2)  # N(PC)c
+    if method == 'conv2d':
+        # A convolution grouped by crop, with the crops stacked along the channels
+        logits = F.conv2d(
+            features.reshape(1, n * c, h, w),
+            w_tensor_flat.reshape(-1, c, 1, 1),
+            bias=b_tensor.reshape(-1),
+            groups=n,
+        )
+        return logits.reshape(n, n_points, n_out_channels, h, w)
+
+    features_flat = features.flatten(2)  # ncX
+    b_tensor_flat = b_tensor.flatten(1, 2).unsqueeze(-1)  # N(PC)1
+    if method == 'baddbmm':
+        logits = torch.baddbmm(b_tensor_flat, w_tensor_flat, features_flat)
+    elif method == 'matmul':
+        logits = w_tensor_flat @ features_flat + b_tensor_flat
+    else:
+        raise ValueError(f'Unknown weight application method {method}')
+    return logits.unflatten(1, (n_points, n_out_channels)).unflatten(-1, (h, w))
+
+
+def shape_signature(
+    per_example: bool,
+    features: torch.Tensor,
+    n_points: int,
+    n_out_channels: int,
+    device_name: str,
+):
+    """Identifies the shape, dtype and device of a weight application. The number of crops is
+    rounded up to a power of two, so that varying batch sizes do not each need tuning."""
+    n, c, h, w = features.shape
+    n_bucket = 1
+    while n_bucket < n:
+        n_bucket *= 2
+    if features.dtype == torch.bfloat16:
+        dtype_name = 'bf16'
+    else:
+        dtype_name = f'f{features.element_size() * 8}'
+    kind = 'per_example' if per_example else 'shared'
+    return f'{kind}:{device_name}:{dtype_name}:{n_bucket}x{c}x{h}x{w}:{n_points}x{n_out_channels}'
+
+
+class Autotuner:
+    """Benchmarks the weight application methods and remembers the fastest per signature."""
+
+    def __init__(self, n_warmup=2, n_repeat=5):
+        self.n_warmup = n_warmup
+        self.n_repeat = n_repeat
+        self.choices = {}
+
+    def choose(self, signature, per_example, features, w_tensor, b_tensor):
+        if signature in self.choices:
+            return self.choices[signature]
+
+        times = {}
+        candidates = PER_EXAMPLE_METHODS if per_example else SHARED_METHODS
+        for method in candidates:
+            try:
+                times[method] = self._measure(per_example, method, features, w_tensor, b_tensor)
+            except RuntimeError:
+                # E.g., out of memory, or not implemented for the dtype on the device
+                continue
+        method = min(times, key=times.get)
+        self.choices[signature] = method
+        return method
+
+    def _measure(self, per_example, method, features, w_tensor, b_tensor):
+        apply_fn = apply_per_example_weights if per_example else apply_shared_weights
+        # In training, the backward pass is part of the cost as well
+        with_backward = torch.is_grad_enabled() and (
+            features.requires_grad or w_tensor.requires_grad
+        )
+        if with_backward:
+            features = features.detach().requires_grad_(features.requires_grad)
+            w_tensor = w_tensor.detach().requires_grad_(w_tensor.requires_grad)
+            b_tensor = b_tensor.detach().requires_grad_(b_tensor.requires_grad)
+
+        def run():
+            logits = apply_fn(method, features, w_tensor, b_tensor)
+            if with_backward:
+                logits.float().sum().backward()
+
+        for _ in range(self.n_warmup):
+            run()
+        synchronize(features.device)
+        times = []
+        for _ in range(self.n_repeat):
+            start = time.perf_counter()
+            run()
+            synchronize(features.device)
+            times.append(time.perf_counter() - start)
+        return float(np.median(times))
+
+
+_autotuner = None
+
+
+def get_autotuner():
+    global _autotuner
+    if _autotuner is None:
+        _autotuner = Autotuner()
+    return _autotuner
+
+
+def set_device_name(model, device):
+    """Lets a loaded scripted MultipersonNLF use the weight application methods that were tuned
+    for this device, if any, see the module docstring."""
+    head = model.crop_model.heatmap_head
+    # Models saved before the tuning was keyed on the device have no device name
+    if hasattr(head, 'device_name'):
+        head.device_name = get_device_name(torch.device(device))
+
+
+@functools.lru_cache()
+def get_device_name(device):
+    # Cached, as this is looked up for every weight application in eager mode
+    if device.type == 'cuda':
+        return torch.cuda.get_device_name(device)
+    return device.type
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
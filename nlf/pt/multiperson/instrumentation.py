@@ -0,0 +1,164 @@
+import bisect
+
+import torch
+from torch.autograd import DeviceType
+
+# The stages of MultipersonNLF are marked with record_function ranges whose names start with this
+STAGE_PREFIX = 'nlf.'
+
+
+class StageProfiler:
+    """Measures the time and memory use of the named stages of a MultipersonNLF call.
+
+    The model marks its stages (detection, resize and pad, crop warping, backbone, localizer head,
+    reconstruct_absolute, augmentation merging, pose filtering, body fitting, projection, ...)
+    with record_function ranges, which also work in the scripted model and cost next to nothing
+    when no profiler is active. Calling the model through a StageProfiler runs it under
+    torch.profiler and summarizes these ranges per call, as a dict from stage name (without the
+    'nlf.' prefix) to:
+        calls: how many times the stage ran
+        wall_ms: the time spent in the stage on the host
+        device_ms: the time of the device kernels launched in the stage
+        peak_memory_mb: the most memory allocated at once in the stage, beyond what was allocated
+            when it started (on the device of the kernels, or on the CPU if there is none)
+    Stages nest, e.g., the backbone is part of crop_model, so the times are inclusive. The
+    'total' entry covers the whole call. With CUDA, the host times of the stages mostly show
+    the launch overhead, as the kernels run asynchronously, see device_ms for their run time.
+
+    Example:
+        profiler = StageProfiler(callback=print, trace_path='/tmp/trace_{call}.json')
+        pred = profiler(model.detect_poses_batched, frames, skeleton='smpl_24')
+        print(profiler.stats['crop_model']['device_ms'])
+
+    Args:
+        callback: called with the stats after each call
+        trace_path: if given, the profile of each call is exported as a Chrome trace to this
+            path, formatted with call=the index of the call
+        profile_memory: whether to record the allocations, needed for peak_memory_mb
+    """
+
+    def __init__(self, callback=None, trace_path=None, profile_memory=True):
+        self.callback = callback
+        self.trace_path = trace_path
+        self.profile_memory = profile_memory
+        self.stats = None
+        self.n_calls = 0
+
+    def __call__(self, fn, *args, **kwargs):
+        use_cuda = torch.cuda.is_available()
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if use_cuda:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+        with torch.profiler.profile(
+            activities=activities, profile_memory=self.profile_memory
+        ) as prof:
+            with torch.autograd.profiler.record_function(STAGE_PREFIX + 'total'):
+                result = fn(*args, **kwargs)
+                if use_cuda:
+                    torch.cuda.synchronize()
+
+        self.stats = stage_stats(prof.events(), memory_records(prof))
+        if self.trace_path is not None:
+            prof.export_chrome_trace(self.trace_path.format(call=self.n_calls))
+        self.n_calls += 1
+        if self.callback is not None:
+            self.callback(self.stats)
+        return result
+
+
+def stage_stats(events, memory_records=None):
+    """Summarizes the stage ranges of a profile (a list of FunctionEvents), see StageProfiler.
+    The memory records are as returned by memory_records, by default they are taken from the
+    '[memory]' events in the list."""
+    stage_events = [
+        e for e in events if e.name.startswith(STAGE_PREFIX) and e.device_type == DeviceType.CPU
+    ]
+    if memory_records is None:
+        memory_records = [
+            (e.time_range.start, e.cpu_memory_usage, _device_memory_usage(e))
+            for e in events
+            if e.name == '[memory]'
+        ]
+    memory_times, memory_totals = _memory_timeline(memory_records)
+
+    stats = {}
+    for e in sorted(stage_events, key=lambda e: e.time_range.start):
+        name = e.name[len(STAGE_PREFIX) :]
+        s = stats.setdefault(name, dict(calls=0, wall_ms=0.0, device_ms=0.0, peak_memory_mb=0.0))
+        s['calls'] += 1
+        s['wall_ms'] += e.time_range.elapsed_us() / 1000
+        s['device_ms'] += _device_time_total(e) / 1000
+
+        # The peak of the allocated memory within the range, relative to where it started
+        i_start = bisect.bisect_left(memory_times, e.time_range.start)
+        i_end = bisect.bisect_right(memory_times, e.time_range.end)
+        if i_end > i_start:
+            base = memory_totals[i_start - 1] if i_start > 0 else 0
+            peak = max(memory_totals[i_start:i_end]) - base
+            s['peak_memory_mb'] = max(s['peak_memory_mb'], peak / 2**20)
+    return stats
+
+
+def format_stats(stats):
+    """Formats the stats of StageProfiler as a table, one stage per line."""
+    lines = [f'{"stage":<28}{"calls":>7}{"wall ms":>11}{"device ms":>11}{"peak MB":>11}']
+    for name, s in stats.items():
+        lines.append(
+            f'{name:<28}{s["calls"]:>7}{s["wall_ms"]:>11.2f}{s["device_ms"]:>11.2f}'
+            f'{s["peak_memory_mb"]:>11.1f}'
+        )
+    return '\n'.join(lines)
+
+
+def memory_records(prof):
+    """Returns the allocations and frees of a profile as (time in us, CPU bytes, device bytes),
+    with negative sizes for frees.
+
+    Recent PyTorch versions leave the '[memory]' events of allocations within an op out of
+    prof.events(), so they are read from the raw results of the profiler here."""
+    results = prof.profiler.kineto_results
+    if not hasattr(results, 'trace_start_ns'):
+        return None
+
+    trace_start_ns = results.trace_start_ns()
+    records = []
+    for e in results.events():
+        if e.name() != '[memory]':
+            continue
+        time = (e.start_ns() - trace_start_ns) / 1000
+        if e.device_type() == DeviceType.CPU:
+            records.append((time, e.nbytes(), 0))
+        else:
+            records.append((time, 0, e.nbytes()))
+    return records
+
+
+def _memory_timeline(memory_records):
+    # Device memory is tracked if there is any, otherwise CPU memory.
+    memory_records = sorted(memory_records)
+    if any(device_size for _, _, device_size in memory_records):
+        sizes = [device_size for _, _, device_size in memory_records]
+    else:
+        sizes = [cpu_size for _, cpu_size, _ in memory_records]
+
+    times = [time for time, _, _ in memory_records]
+    totals = []
+    total = 0
+    for size in sizes:
+        total += size
+        totals.append(total)
+    return times, totals
+
+
+def _device_time_total(event):
+    # Called cuda_time_total in older PyTorch versions
+    if hasattr(event, 'device_time_total'):
+        return event.device_time_total
+    return event.cuda_time_total
+
+
+def _device_memory_usage(event):
+    if hasattr(event, 'device_memory_usage'):
+        return event.device_memory_usage
+    return event.cuda_memory_usage
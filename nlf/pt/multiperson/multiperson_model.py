@@ -1,5 +1,5 @@
 import math
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import smplfitter.pt
@@ -18,8 +18,27 @@ DEFAULT_WORLD_UP = (0, -1, 0)
 
 
 class MultipersonNLF(torch.nn.Module):
-    def __init__(self, crop_model, detector, skeleton_infos, pad_white_pixels=True):
+    grid_templates: Dict[str, torch.Tensor]
+    per_skeleton_weights: Dict[str, Dict[str, torch.Tensor]]
+    skeleton_weights_lru: List[str]
+
+    def __init__(
+        self,
+        crop_model,
+        detector,
+        skeleton_infos,
+        pad_white_pixels=True,
+        roi_pyramid=False,
+        roi_pyramid_max_area_fraction=0.5,
+        detect_on_gamma_frames=False,
+        num_nms_points=64,
+        skeleton_weights_max_bytes=256 * 2**20,
+        geometry_precision='float64',
+        compute_dtype=None,
+    ):
         super().__init__()
+        if geometry_precision not in ('float64', 'float32'):
+            raise ValueError(f'Unknown geometry precision: {geometry_precision}')
 
         self.crop_model = crop_model
         self.detector = detector
@@ -52,6 +71,16 @@ class MultipersonNLF(torch.nn.Module):
             )
             for k in self.body_models
         }
+        # The pose NMS only compares a fixed subset of the predicted points, spread over the body,
+        # so its cost does not grow with the number of queried points.
+        self.nms_point_indices = {
+            k: torch.tensor(
+                farthest_point_indices(v.cpu().numpy(), num_nms_points),
+                dtype=torch.int64,
+                device=device,
+            )
+            for k, v in self.cano_all.items()
+        }
         nothing = torch.zeros([], device=device, dtype=torch.float32)
 
         # This is not initialized here to save disk space. It will be computed on first use.
@@ -80,6 +109,80 @@ class MultipersonNLF(torch.nn.Module):
         }
         self.skeleton_joint_indices_table = {k: v['indices'] for k, v in skeleton_infos.items()}
         self.pad_white_pixels = pad_white_pixels
+        # Homogeneous pixel lattices for the crop sampling grids, see warping.grid_template
+        self.grid_templates = {}
+        # Whether to build the crop pyramid only around the people instead of the full frame,
+        # which saves time and memory when people cover a small part of a high resolution image
+        self.roi_pyramid = roi_pyramid
+        self.roi_pyramid_max_area_fraction = roi_pyramid_max_area_fraction
+        # Whether the detect_* APIs give the detector the gamma-encoded frame and pass the original
+        # frame on, see _detector_input. This is faster but changes the detections and crops, so
+        # it is off by default.
+        self.detect_on_gamma_frames = detect_on_gamma_frames
+        # Weights for the canonical points of named skeletons, see get_weights_for_skeleton
+        self.per_skeleton_weights = {}
+        self.skeleton_weights_lru = []
+        self.skeleton_weights_max_bytes = skeleton_weights_max_bytes
+        # All outputs of the parametric API, the default for its requested_keys argument
+        self.parametric_result_keys = [
+            'boxes',
+            'pose',
+            'betas',
+            'trans',
+            'vertices3d',
+            'joints3d',
+            'vertices2d',
+            'joints2d',
+            'vertices3d_nonparam',
+            'joints3d_nonparam',
+            'vertices2d_nonparam',
+            'joints2d_nonparam',
+            'vertex_uncertainties',
+            'joint_uncertainties',
+        ]
+        # Whether the rotations of the predicted poses into the original camera and world frames
+        # are done in float64. With 'float32', the poses are centered before each rotation, so
+        # that the rounding errors scale with the size of a person rather than with the distance
+        # from the origin, see rotate_centered.
+        self.geometry_float64 = geometry_precision == 'float64'
+        # The dtype of the images and the crop model computations, by default the one the crop
+        # model was set up with, see ptu.default_compute_dtype
+        self.compute_dtype = (
+            compute_dtype if compute_dtype is not None else crop_model.compute_dtype
+        )
+
+    def precompute_weights(self, model_names=None, skeletons=None, cache=None):
+        """Computes the weights for body models and skeletons ahead of time, so that they are
+        stored with the model (e.g. when saving the TorchScript version) instead of being
+        computed on first use.
+
+        Args:
+            model_names: body model names (e.g. 'smpl'), by default all of them
+            skeletons: skeleton names (keys of per_skeleton_indices), by default none
+            cache: optional weights_cache.WeightsCache to load the weights from, or to store
+                them in if they are not cached yet
+        """
+        if model_names is None:
+            model_names = list(self.body_models.keys())
+        if skeletons is None:
+            skeletons = []
+
+        def get_weights(canonical_points):
+            if cache is None:
+                return self.get_weights_for_canonical_points(canonical_points)
+            return cache.get(
+                canonical_points,
+                self.get_weights_for_canonical_points,
+                dtype=ptu.dtype_from_name(self.compute_dtype),
+            )
+
+        with torch.inference_mode():
+            for model_name in model_names:
+                self.weights[model_name] = get_weights(self.cano_all[model_name])
+            for skeleton in skeletons:
+                self.per_skeleton_weights[skeleton] = get_weights(
+                    self._get_skeleton_canonical_points(skeleton)
+                )
 
     @torch.jit.export
     def detect_parametric_batched(
@@ -104,20 +207,26 @@ class MultipersonNLF(torch.nn.Module):
         beta_regularizer2: float = 0.0,
         model_name: str = 'smpl',
         extra_boxes: Optional[List[torch.Tensor]] = None,
+        adaptive_aug: bool = False,
+        adaptive_aug_max_uncertainty: float = 0.25,
+        requested_keys: Optional[List[str]] = None,
+        packed: bool = False,
+        fit_num_iter: int = 3,
     ):
-        images = im_to_linear(images)
-
-        boxes = self.detector(
-            images=images,
-            threshold=detector_threshold,
-            nms_iou_threshold=detector_nms_iou_threshold,
-            max_detections=max_detections,
-            extrinsic_matrix=extrinsic_matrix,
-            world_up_vector=world_up_vector,
-            flip_aug=detector_flip_aug,
-            bothflip_aug=detector_both_flip_aug,
-            extra_boxes=extra_boxes,
-        )
+        images, detector_images = self._detector_input(images)
+        with torch.autograd.profiler.record_function('nlf.detect'):
+            boxes = self.detector(
+                images=detector_images,
+                threshold=detector_threshold,
+                nms_iou_threshold=detector_nms_iou_threshold,
+                max_detections=max_detections,
+                extrinsic_matrix=extrinsic_matrix,
+                world_up_vector=world_up_vector,
+                flip_aug=detector_flip_aug,
+                bothflip_aug=detector_both_flip_aug,
+                extra_boxes=extra_boxes,
+                linear_input=not self.detect_on_gamma_frames,
+            )
         return self._estimate_parametric_batched(
             images,
             boxes,
@@ -134,6 +243,11 @@ class MultipersonNLF(torch.nn.Module):
             beta_regularizer,
             beta_regularizer2,
             model_name,
+            adaptive_aug=adaptive_aug,
+            adaptive_aug_max_uncertainty=adaptive_aug_max_uncertainty,
+            requested_keys=requested_keys,
+            packed=packed,
+            fit_num_iter=fit_num_iter,
         )
 
     @torch.jit.export
@@ -153,7 +267,23 @@ class MultipersonNLF(torch.nn.Module):
         beta_regularizer: float = 10.0,
         beta_regularizer2: float = 0.0,
         model_name: str = 'smpl',
+        adaptive_aug: bool = False,
+        adaptive_aug_max_uncertainty: float = 0.25,
+        requested_keys: Optional[List[str]] = None,
+        packed: bool = False,
+        fit_num_iter: int = 3,
+        initial_pose: Optional[List[torch.Tensor]] = None,
+        known_betas: Optional[List[torch.Tensor]] = None,
     ):
+        """Estimates the body model parameters and meshes of the people in the given boxes.
+
+        As each box gets one result, in the same order, results from an earlier call (e.g., the
+        previous video frame) can be used to speed up the body model fitting:
+        initial_pose warm-starts the fitting (typically with a lower fit_num_iter), and the boxes
+        whose row in known_betas is finite are fitted with that fixed shape, only solving for
+        pose and translation. Rows of NaNs in known_betas mark boxes whose shape is unknown.
+        Like boxes, these are lists of per-image tensors.
+        """
         return self._estimate_parametric_batched(
             images,
             boxes,
@@ -170,6 +300,13 @@ class MultipersonNLF(torch.nn.Module):
             beta_regularizer=beta_regularizer,
             beta_regularizer2=beta_regularizer2,
             model_name=model_name,
+            adaptive_aug=adaptive_aug,
+            adaptive_aug_max_uncertainty=adaptive_aug_max_uncertainty,
+            requested_keys=requested_keys,
+            packed=packed,
+            fit_num_iter=fit_num_iter,
+            initial_pose=initial_pose,
+            known_betas=known_betas,
         )
 
     detect_smpl_batched = detect_parametric_batched
@@ -192,6 +329,13 @@ class MultipersonNLF(torch.nn.Module):
         beta_regularizer: float = 10.0,
         beta_regularizer2: float = 0.0,
         model_name: str = 'smpl',
+        adaptive_aug: bool = False,
+        adaptive_aug_max_uncertainty: float = 0.25,
+        requested_keys: Optional[List[str]] = None,
+        packed: bool = False,
+        fit_num_iter: int = 3,
+        initial_pose: Optional[List[torch.Tensor]] = None,
+        known_betas: Optional[List[torch.Tensor]] = None,
     ):
         if model_name not in self.body_models:
             raise ValueError(
@@ -203,6 +347,7 @@ class MultipersonNLF(torch.nn.Module):
                 self.cano_all[model_name]
             )
 
+        # The intermediate result is packed, so that it need not be concatenated here
         result = self._estimate_poses_batched(
             images,
             boxes,
@@ -217,107 +362,142 @@ class MultipersonNLF(torch.nn.Module):
             num_aug,
             rot_aug_max_degrees,
             suppress_implausible_poses=suppress_implausible_poses,
+            nms_point_indices=self.nms_point_indices[model_name],
+            adaptive_aug=adaptive_aug,
+            adaptive_aug_max_uncertainty=adaptive_aug_max_uncertainty,
+            packed=True,
+        )
+        if requested_keys is None:
+            requested_keys = self.parametric_result_keys
+
+        boxes_flat = result['boxes'][0]
+        num_crops = result['num_crops'][0] if 'num_crops' in result else None
+        if boxes_flat.shape[0] == 0:
+            empty_result = self._predict_empty_parametric(images, model_name)
+            if num_crops is not None:
+                empty_result['num_crops'] = list(torch.unbind(num_crops))
+            if packed:
+                empty_result = pack_ragged(empty_result, images.device)
+            return select_keys(empty_result, requested_keys)
+
+        # Only the outputs in requested_keys are computed. Notably, the body model forward pass
+        # and the projections are skipped if no fitted vertices or joints are requested, and the
+        # fitting itself if no fitted parameters are requested either.
+        want_vertices = 'vertices3d' in requested_keys or 'vertices2d' in requested_keys
+        want_joints = 'joints3d' in requested_keys or 'joints2d' in requested_keys
+        want_fit = (
+            want_vertices
+            or want_joints
+            or 'pose' in requested_keys
+            or 'betas' in requested_keys
+            or 'trans' in requested_keys
         )
-        boxes = result['boxes']
-        n_pose_per_image_list = [len(b) for b in boxes]
-        if sum(n_pose_per_image_list) == 0:
-            return self._predict_empty_parametric(images, model_name)
 
-        poses3d_flat = torch.cat(result['poses3d'], dim=0)
+        offsets = result['offsets'][0]
+        n_pose_per_image = offsets[1:] - offsets[:-1]
+        poses3d_flat = result['poses3d'][0]
         mean_poses = torch.mean(poses3d_flat, dim=-2, keepdim=True)
         poses3d_flat = poses3d_flat - mean_poses
-        poses2d_flat = torch.cat(result['poses2d'], dim=0)
-        uncertainties_flat = torch.cat(result['uncertainties'], dim=0)
+        uncertainties_flat = result['uncertainties'][0]
 
         fitter = self.fitters['smpl'] if model_name == 'smpl' else self.fitters['smplx']
-        vertices_flat, joints_flat = torch.split(
-            poses3d_flat, [fitter.body_model.num_vertices, fitter.body_model.num_joints], dim=-2
-        )
+        n_verts = fitter.body_model.num_vertices
+        n_joints = fitter.body_model.num_joints
+        vertices_flat, joints_flat = torch.split(poses3d_flat, [n_verts, n_joints], dim=-2)
         vertex_uncertainties_flat, joint_uncertainties_flat = torch.split(
-            uncertainties_flat,
-            [fitter.body_model.num_vertices, fitter.body_model.num_joints],
-            dim=-1,
-        )
-
-        vertex_weights = vertex_uncertainties_flat**-1.5
-        vertex_weights = vertex_weights / torch.mean(vertex_weights, dim=-1, keepdim=True)
-        joint_weights = joint_uncertainties_flat**-1.5
-        joint_weights = joint_weights / torch.mean(joint_weights, dim=-1, keepdim=True)
-
-        fit = fitter.fit(
-            vertices_flat / 1000,
-            joints_flat / 1000,
-            vertex_weights=vertex_weights,
-            joint_weights=joint_weights,
-            num_iter=3,
-            beta_regularizer=beta_regularizer,
-            beta_regularizer2=beta_regularizer2,
-            final_adjust_rots=True,
-            requested_keys=['pose_rotvecs', 'shape_betas', 'trans'],
-        )
-
-        result['pose'] = torch.split(fit['pose_rotvecs'], n_pose_per_image_list)
-        result['betas'] = torch.split(fit['shape_betas'], n_pose_per_image_list)
-        result['trans'] = torch.split(
-            fit['trans'] + mean_poses.squeeze(-2) / 1000, n_pose_per_image_list
-        )
-
-        body_model: smplfitter.pt.BodyModel = (
-            self.body_models['smpl'] if model_name == 'smpl' else self.body_models['smplx']
-        )
-        fit_res = body_model.forward(
-            fit['pose_rotvecs'], fit['shape_betas'], fit['trans'] + mean_poses.squeeze(-2) / 1000
-        )
-        fit_vertices_flat = fit_res['vertices'] * 1000
-        fit_joints_flat = fit_res['joints'] * 1000
-        result['vertices3d'] = torch.split(fit_vertices_flat, n_pose_per_image_list)
-        result['joints3d'] = torch.split(fit_joints_flat, n_pose_per_image_list)
-
-        result['vertices2d'] = project_ragged(
-            images,
-            [x for x in result['vertices3d']],
-            extrinsic_matrix,
-            intrinsic_matrix,
-            distortion_coeffs,
-            default_fov_degrees,
-        )
-        result['joints2d'] = project_ragged(
-            images,
-            [x for x in result['joints3d']],
-            extrinsic_matrix,
-            intrinsic_matrix,
-            distortion_coeffs,
-            default_fov_degrees,
-        )
-
-        result['vertices3d_nonparam'] = torch.split(
-            vertices_flat + mean_poses, n_pose_per_image_list
-        )
-        result['joints3d_nonparam'] = torch.split(joints_flat + mean_poses, n_pose_per_image_list)
-        vertices2d, joints2d = torch.split(
-            poses2d_flat, [fitter.body_model.num_vertices, fitter.body_model.num_joints], dim=-2
+            uncertainties_flat, [n_verts, n_joints], dim=-1
         )
 
-        result['vertices2d_nonparam'] = torch.split(vertices2d, n_pose_per_image_list)
-        result['joints2d_nonparam'] = torch.split(joints2d, n_pose_per_image_list)
-
-        result['vertex_uncertainties'] = torch.split(
-            vertex_uncertainties_flat * 1000, n_pose_per_image_list
-        )
-        result['joint_uncertainties'] = torch.split(
-            joint_uncertainties_flat * 1000, n_pose_per_image_list
+        out: Dict[str, torch.Tensor] = dict(boxes=boxes_flat)
+        if want_fit:
+            vertex_weights = vertex_uncertainties_flat**-1.5
+            vertex_weights = vertex_weights / torch.mean(vertex_weights, dim=-1, keepdim=True)
+            joint_weights = joint_uncertainties_flat**-1.5
+            joint_weights = joint_weights / torch.mean(joint_weights, dim=-1, keepdim=True)
+
+            device = vertices_flat.device
+            with torch.autograd.profiler.record_function('nlf.body_fit'):
+                fit = fit_body_model(
+                    fitter,
+                    vertices_flat / 1000,
+                    joints_flat / 1000,
+                    vertex_weights,
+                    joint_weights,
+                    fit_num_iter,
+                    beta_regularizer,
+                    beta_regularizer2,
+                    initial_pose=cat_optional(initial_pose, device),
+                    known_betas=cat_optional(known_betas, device),
+                )
+            trans = fit['trans'] + mean_poses.squeeze(-2) / 1000
+            out['pose'] = fit['pose_rotvecs']
+            out['betas'] = fit['shape_betas']
+            out['trans'] = trans
+
+            if want_vertices or want_joints:
+                body_model: smplfitter.pt.BodyModel = (
+                    self.body_models['smpl'] if model_name == 'smpl' else self.body_models['smplx']
+                )
+                with torch.autograd.profiler.record_function('nlf.body_model'):
+                    fit_res = body_model.forward(
+                        fit['pose_rotvecs'],
+                        fit['shape_betas'],
+                        trans,
+                        return_vertices=want_vertices,
+                    )
+                if want_vertices:
+                    # Vertices and joints are projected together, in one pass
+                    fit_points_flat = (
+                        torch.cat([fit_res['vertices'], fit_res['joints']], dim=-2) * 1000
+                    )
+                else:
+                    fit_points_flat = fit_res['joints'] * 1000
+
+                if 'vertices2d' in requested_keys or 'joints2d' in requested_keys:
+                    with torch.autograd.profiler.record_function('nlf.projection'):
+                        fit_points2d_flat = project_packed(
+                            images,
+                            fit_points_flat,
+                            n_pose_per_image,
+                            extrinsic_matrix,
+                            intrinsic_matrix,
+                            distortion_coeffs,
+                            default_fov_degrees,
+                        )
+                    if want_vertices:
+                        out['vertices2d'] = fit_points2d_flat[:, :n_verts]
+                        out['joints2d'] = fit_points2d_flat[:, n_verts:]
+                    else:
+                        out['joints2d'] = fit_points2d_flat
+
+                if want_vertices:
+                    out['vertices3d'] = fit_points_flat[:, :n_verts]
+                    out['joints3d'] = fit_points_flat[:, n_verts:]
+                else:
+                    out['joints3d'] = fit_points_flat
+
+        if 'vertices3d_nonparam' in requested_keys:
+            out['vertices3d_nonparam'] = vertices_flat + mean_poses
+        if 'joints3d_nonparam' in requested_keys:
+            out['joints3d_nonparam'] = joints_flat + mean_poses
+        if 'vertices2d_nonparam' in requested_keys or 'joints2d_nonparam' in requested_keys:
+            vertices2d, joints2d = torch.split(result['poses2d'][0], [n_verts, n_joints], dim=-2)
+            out['vertices2d_nonparam'] = vertices2d
+            out['joints2d_nonparam'] = joints2d
+        if 'vertex_uncertainties' in requested_keys:
+            out['vertex_uncertainties'] = vertex_uncertainties_flat * 1000
+        if 'joint_uncertainties' in requested_keys:
+            out['joint_uncertainties'] = joint_uncertainties_flat * 1000
+
+        return select_keys(
+            arrange_results(out, n_pose_per_image, num_crops, packed), requested_keys
         )
 
-        del result['poses3d']
-        del result['poses2d']
-        del result['uncertainties']
-        return result
-
     @torch.jit.export
     def detect_poses_batched(
         self,
         images: torch.Tensor,
-        weights: Dict[str, torch.Tensor],
+        weights: Optional[Dict[str, torch.Tensor]] = None,
         intrinsic_matrix: Optional[torch.Tensor] = None,
         distortion_coeffs: Optional[torch.Tensor] = None,
         extrinsic_matrix: Optional[torch.Tensor] = None,
@@ -334,21 +514,27 @@ class MultipersonNLF(torch.nn.Module):
         detector_both_flip_aug: bool = False,
         suppress_implausible_poses: bool = True,
         extra_boxes: Optional[List[torch.Tensor]] = None,
+        skeleton: Optional[str] = None,
+        adaptive_aug: bool = False,
+        adaptive_aug_max_uncertainty: float = 0.25,
+        packed: bool = False,
     ):
-
-        images = im_to_linear(images)
-
-        boxes = self.detector(
-            images=images,
-            threshold=detector_threshold,
-            nms_iou_threshold=detector_nms_iou_threshold,
-            max_detections=max_detections,
-            extrinsic_matrix=extrinsic_matrix,
-            world_up_vector=world_up_vector,
-            flip_aug=detector_flip_aug,
-            bothflip_aug=detector_both_flip_aug,
-            extra_boxes=extra_boxes,
-        )
+        weights = self._resolve_weights(weights, skeleton)
+
+        images, detector_images = self._detector_input(images)
+        with torch.autograd.profiler.record_function('nlf.detect'):
+            boxes = self.detector(
+                images=detector_images,
+                threshold=detector_threshold,
+                nms_iou_threshold=detector_nms_iou_threshold,
+                max_detections=max_detections,
+                extrinsic_matrix=extrinsic_matrix,
+                world_up_vector=world_up_vector,
+                flip_aug=detector_flip_aug,
+                bothflip_aug=detector_both_flip_aug,
+                extra_boxes=extra_boxes,
+                linear_input=not self.detect_on_gamma_frames,
+            )
 
         return self._estimate_poses_batched(
             images,
@@ -364,6 +550,9 @@ class MultipersonNLF(torch.nn.Module):
             num_aug,
             rot_aug_max_degrees,
             suppress_implausible_poses,
+            adaptive_aug=adaptive_aug,
+            adaptive_aug_max_uncertainty=adaptive_aug_max_uncertainty,
+            packed=packed,
         )
 
     @torch.jit.export
@@ -371,7 +560,7 @@ class MultipersonNLF(torch.nn.Module):
         self,
         images: torch.Tensor,
         boxes: List[torch.Tensor],
-        weights: Dict[str, torch.Tensor],
+        weights: Optional[Dict[str, torch.Tensor]] = None,
         intrinsic_matrix: Optional[torch.Tensor] = None,
         distortion_coeffs: Optional[torch.Tensor] = None,
         extrinsic_matrix: Optional[torch.Tensor] = None,
@@ -381,7 +570,12 @@ class MultipersonNLF(torch.nn.Module):
         antialias_factor: int = 1,
         num_aug: int = 5,
         rot_aug_max_degrees: float = 25.0,
+        skeleton: Optional[str] = None,
+        adaptive_aug: bool = False,
+        adaptive_aug_max_uncertainty: float = 0.25,
+        packed: bool = False,
     ):
+        weights = self._resolve_weights(weights, skeleton)
         boxes = [torch.cat([b, torch.ones_like(b[..., :1])], dim=-1) for b in boxes]
         pred = self._estimate_poses_batched(
             images,
@@ -397,10 +591,77 @@ class MultipersonNLF(torch.nn.Module):
             num_aug,
             rot_aug_max_degrees,
             suppress_implausible_poses=False,
+            adaptive_aug=adaptive_aug,
+            adaptive_aug_max_uncertainty=adaptive_aug_max_uncertainty,
+            packed=packed,
         )
         del pred['boxes']
         return pred
 
+    @torch.jit.export
+    def estimate_multi_batched(
+        self,
+        images: torch.Tensor,
+        boxes: List[torch.Tensor],
+        weights_by_name: Optional[Dict[str, Dict[str, torch.Tensor]]] = None,
+        skeletons: Optional[List[str]] = None,
+        intrinsic_matrix: Optional[torch.Tensor] = None,
+        distortion_coeffs: Optional[torch.Tensor] = None,
+        extrinsic_matrix: Optional[torch.Tensor] = None,
+        world_up_vector: Optional[torch.Tensor] = None,
+        default_fov_degrees: float = 55.0,
+        internal_batch_size: int = 64,
+        antialias_factor: int = 1,
+        num_aug: int = 5,
+        rot_aug_max_degrees: float = 25.0,
+        adaptive_aug: bool = False,
+        adaptive_aug_max_uncertainty: float = 0.25,
+        packed: bool = False,
+    ):
+        """Like estimate_poses_batched, but for several point sets at once, e.g., the SMPL
+        vertices, a skeleton and custom markers. The crops go through the backbone only once,
+        and all point sets are decoded from the same features.
+
+        The point sets are given as weights (see get_weights_for_canonical_points) by name, and as
+        skeleton names. The result is a dict from these names to the usual result dicts.
+        """
+        names: List[str] = []
+        weights_list: List[Dict[str, torch.Tensor]] = []
+        if weights_by_name is not None:
+            for name, weights in weights_by_name.items():
+                names.append(name)
+                weights_list.append(weights)
+        if skeletons is not None:
+            for skeleton in skeletons:
+                names.append(skeleton)
+                weights_list.append(self.get_weights_for_skeleton(skeleton))
+        if len(names) == 0:
+            raise ValueError('Either weights_by_name or skeletons must be given')
+
+        point_splits = [w['w_tensor'].shape[0] for w in weights_list]
+        boxes = [torch.cat([b, torch.ones_like(b[..., :1])], dim=-1) for b in boxes]
+        pred = self._estimate_poses_batched(
+            images,
+            boxes,
+            concat_weights(weights_list),
+            intrinsic_matrix,
+            distortion_coeffs,
+            extrinsic_matrix,
+            world_up_vector,
+            default_fov_degrees,
+            internal_batch_size,
+            antialias_factor,
+            num_aug,
+            rot_aug_max_degrees,
+            suppress_implausible_poses=False,
+            adaptive_aug=adaptive_aug,
+            adaptive_aug_max_uncertainty=adaptive_aug_max_uncertainty,
+            packed=packed,
+            point_splits=point_splits,
+        )
+        del pred['boxes']
+        return split_point_sets(pred, names, point_splits)
+
     def _estimate_poses_batched(
         self,
         images: torch.Tensor,
@@ -416,11 +677,25 @@ class MultipersonNLF(torch.nn.Module):
         num_aug: int,
         rot_aug_max_degrees: float,
         suppress_implausible_poses: bool,
+        nms_point_indices: Optional[torch.Tensor] = None,
+        adaptive_aug: bool = False,
+        adaptive_aug_max_uncertainty: float = 0.25,
+        packed: bool = False,
+        point_splits: Optional[List[int]] = None,
     ):
+        # The number of crops per image is only returned with adaptive augmentation, where it
+        # varies. Otherwise it is always num_aug times the number of boxes.
+        is_adaptive = adaptive_aug and num_aug > 1
         if sum(len(b) for b in boxes) == 0:
-            return self._predict_empty(images, weights)
+            num_crops_empty = (
+                torch.zeros(len(images), dtype=torch.int64, device=images.device)
+                if is_adaptive
+                else None
+            )
+            return self._predict_empty(images, weights, packed, num_crops_empty)
 
-        images = im_to_linear(images)
+        with torch.autograd.profiler.record_function('nlf.linearize'):
+            images = im_to_linear(images, self._image_dtype())
 
         n_images = len(images)
         device = images.device
@@ -446,6 +721,8 @@ class MultipersonNLF(torch.nn.Module):
         if len(extrinsic_matrix) == 1:
             extrinsic_matrix = torch.repeat_interleave(extrinsic_matrix, n_images, dim=0)
 
+        intrinsic_matrix_per_image = intrinsic_matrix
+
         # Now repeat these camera params for each box
         n_box_per_image_list = [len(b) for b in boxes]
         n_box_per_image = torch.tensor([len(b) for b in boxes], device=device)
@@ -494,118 +771,324 @@ class MultipersonNLF(torch.nn.Module):
         aug_rotmat = ptu3d.rotation_mat(-aug_angles, rot_axis='z')
         aug_rotflipmat = aug_maybe_flipmat @ aug_rotmat
 
-        # crops_flat, poses3d_flat = self._predict_in_batches(
-        poses3d_flat, uncert_flat = self._predict_in_batches(
-            images,
+        # The image pyramid is built only once and shared by all internal batches of crops.
+        with torch.autograd.profiler.record_function('nlf.crop_source'):
+            crop_source = self._get_crop_source(
+                images,
+                intrinsic_matrix_per_image,
+                intrinsic_matrix,
+                distortion_coeffs,
+                camspace_up,
+                boxes,
+                aug_rotflipmat,
+                aug_scales,
+                antialias_factor,
+            )
+
+        boxes_flat = torch.cat(boxes, dim=0)
+        image_id_per_box = torch.repeat_interleave(
+            torch.arange(n_images, device=device), n_box_per_image, dim=0
+        )
+        num_crops: Optional[torch.Tensor] = None
+        if is_adaptive:
+            poses3d_flat, uncert_flat, num_crops_per_box = self._predict_adaptive_aug(
+                crop_source,
+                weights,
+                intrinsic_matrix,
+                distortion_coeffs,
+                camspace_up,
+                boxes_flat,
+                image_id_per_box,
+                internal_batch_size,
+                aug_should_flip,
+                aug_rotflipmat,
+                aug_gammas,
+                aug_scales,
+                antialias_factor,
+                adaptive_aug_max_uncertainty,
+                point_splits,
+            )
+            # The number of crops that went through the crop model, per image
+            num_crops = torch.zeros(n_images, dtype=torch.int64, device=device).index_add_(
+                0, image_id_per_box, num_crops_per_box
+            )
+        else:
+            # crops_flat, poses3d_flat = self._predict_in_batches(
+            poses3d_flat, uncert_flat = self._predict_in_batches(
+                crop_source,
+                weights,
+                intrinsic_matrix,
+                distortion_coeffs,
+                camspace_up,
+                boxes_flat,
+                image_id_per_box,
+                internal_batch_size,
+                aug_should_flip,
+                aug_rotflipmat,
+                aug_gammas,
+                aug_scales,
+                antialias_factor,
+                point_splits,
+            )
+            poses3d_flat, uncert_flat = self._merge_augmentations(poses3d_flat, uncert_flat)
+
+        # Project the 3D poses to get the 2D poses
+        with torch.autograd.profiler.record_function('nlf.projection'):
+            poses2d_flat_normalized = ptu3d.to_homogeneous(
+                warping.distort_points(ptu3d.project(poses3d_flat.float()), distortion_coeffs)
+            )
+            poses2d_flat = torch.einsum(
+                'bnk,bjk->bnj', poses2d_flat_normalized, intrinsic_matrix[:, :2, :]
+            )
+
+        if suppress_implausible_poses:
+            # Filter the resulting poses for individual plausibility to reduce false positives
+            with torch.autograd.profiler.record_function('nlf.filter_poses'):
+                filtered = self._filter_poses(
+                    boxes_flat,
+                    poses3d_flat,
+                    poses2d_flat,
+                    uncert_flat,
+                    image_id_per_box,
+                    n_images,
+                    nms_point_indices,
+                )
+            boxes_flat, poses3d_flat, poses2d_flat, uncert_flat, image_id_per_box = filtered
+            n_box_per_image = torch.bincount(image_id_per_box, minlength=n_images)
+            n_box_per_image_list = torch.jit.annotate(List[int], n_box_per_image.tolist())
+
+        if sum(n_box_per_image_list) == 0:
+            return self._predict_empty(images, weights, packed, num_crops)
+
+        # Convert to world coordinates
+        with torch.autograd.profiler.record_function('nlf.to_world'):
+            inv_extrinsic_matrix = torch.repeat_interleave(
+                torch.linalg.inv(extrinsic_matrix.double()), n_box_per_image, dim=0
+            )
+            if self.geometry_float64:
+                poses3d_flat = torch.einsum(
+                    'bnk,bjk->bnj',
+                    ptu3d.to_homogeneous(poses3d_flat.double()),
+                    inv_extrinsic_matrix[:, :3, :],
+                )
+            else:
+                poses3d_flat = rotate_centered(
+                    poses3d_flat,
+                    inv_extrinsic_matrix[:, :3, :3].mT,
+                    inv_extrinsic_matrix[:, :3, 3].unsqueeze(-2),
+                )
+
+        # Arrange the results back into ragged tensors, or pack them
+        flat = dict(
+            boxes=boxes_flat,
+            poses3d=poses3d_flat.float(),
+            poses2d=poses2d_flat,
+            uncertainties=uncert_flat,
+        )
+        return arrange_results(flat, n_box_per_image, num_crops, packed, n_box_per_image_list)
+
+    def _merge_augmentations(self, poses3d: torch.Tensor, uncert: torch.Tensor):
+        # Combines the predictions of the augmented crops [n_boxes, num_aug, ...] of each box
+        with torch.autograd.profiler.record_function('nlf.merge_augmentations'):
+            poses3d = plausib.scale_align(poses3d)
+            mean = torch.mean(poses3d, dim=(-3, -2), keepdim=True)
+            poses3d_submean = (poses3d - mean).float()
+            poses3d_submean, final_weights = weighted_geometric_median(
+                poses3d_submean, uncert**-1.5, dim=-3, n_iter=10, eps=50.0, tol=0.1
+            )
+            poses3d = poses3d_submean.to(mean.dtype) + mean.squeeze(1)
+            uncert = weighted_mean(uncert, final_weights, dim=-2)
+        return poses3d, uncert
+
+    def _predict_adaptive_aug(
+        self,
+        crop_source: warping.CropSource,
+        weights: Dict[str, torch.Tensor],
+        intrinsic_matrix: torch.Tensor,
+        distortion_coeffs: torch.Tensor,
+        camspace_up: torch.Tensor,
+        boxes_flat: torch.Tensor,
+        image_id_per_box: torch.Tensor,
+        internal_batch_size: int,
+        aug_should_flip: torch.Tensor,
+        aug_rotflipmat: torch.Tensor,
+        aug_gammas: torch.Tensor,
+        aug_scales: torch.Tensor,
+        antialias_factor: int,
+        max_uncertainty: float,
+        point_splits: Optional[List[int]] = None,
+    ):
+        # First, all boxes are predicted with only the middle augmentation, which is unflipped,
+        # unscaled and (for odd num_aug) unrotated. The rest of the augmentations are only used
+        # for the boxes where this prediction is uncertain.
+        num_aug = aug_gammas.shape[0]
+        i_first = num_aug // 2
+        poses3d_first, uncert_first = self._predict_in_batches(
+            crop_source,
             weights,
             intrinsic_matrix,
             distortion_coeffs,
             camspace_up,
-            boxes,
+            boxes_flat,
+            image_id_per_box,
             internal_batch_size,
-            aug_should_flip,
-            aug_rotflipmat,
-            aug_gammas,
-            aug_scales,
+            aug_should_flip[i_first : i_first + 1],
+            aug_rotflipmat[i_first : i_first + 1],
+            aug_gammas[i_first : i_first + 1],
+            aug_scales[i_first : i_first + 1],
             antialias_factor,
+            point_splits,
         )
-        poses3d_flat = plausib.scale_align(poses3d_flat)
-        mean = torch.mean(poses3d_flat, dim=(-3, -2), keepdim=True)
-        poses3d_flat_submean = (poses3d_flat - mean).float()
-        poses3d_flat_submean, final_weights = weighted_geometric_median(
-            poses3d_flat_submean, uncert_flat**-1.5, dim=-3, n_iter=10, eps=50.0
+        poses3d, uncert = self._merge_augmentations(poses3d_first, uncert_first)
+        num_crops_per_box = torch.ones(
+            boxes_flat.shape[0], dtype=torch.int64, device=boxes_flat.device
         )
-        poses3d_flat = poses3d_flat_submean.double() + mean.squeeze(1)
 
-        uncert_flat = weighted_mean(uncert_flat, final_weights, dim=-2)
+        is_uncertain = torch.logical_or(
+            torch.logical_not(plausib.is_uncertainty_low(uncert)),
+            torch.mean(uncert, dim=-1) > max_uncertainty,
+        )
+        i_uncertain = torch.nonzero(is_uncertain).squeeze(1)
+        if i_uncertain.shape[0] == 0:
+            return poses3d, uncert, num_crops_per_box
 
-        # Project the 3D poses to get the 2D poses
-        poses2d_flat_normalized = ptu3d.to_homogeneous(
-            warping.distort_points(ptu3d.project(poses3d_flat.float()), distortion_coeffs)
+        i_rest = torch.cat(
+            [
+                torch.arange(0, i_first, device=aug_gammas.device),
+                torch.arange(i_first + 1, num_aug, device=aug_gammas.device),
+            ]
         )
-        poses2d_flat = torch.einsum(
-            'bnk,bjk->bnj', poses2d_flat_normalized, intrinsic_matrix[:, :2, :]
+        poses3d_rest, uncert_rest = self._predict_in_batches(
+            crop_source,
+            weights,
+            intrinsic_matrix[i_uncertain],
+            distortion_coeffs[i_uncertain],
+            camspace_up[i_uncertain],
+            boxes_flat[i_uncertain],
+            image_id_per_box[i_uncertain],
+            internal_batch_size,
+            aug_should_flip[i_rest],
+            aug_rotflipmat[i_rest],
+            aug_gammas[i_rest],
+            aug_scales[i_rest],
+            antialias_factor,
+            point_splits,
         )
+        # The order of the augmentations does not matter for the merging
+        poses3d_uncertain, uncert_uncertain = self._merge_augmentations(
+            torch.cat([poses3d_first[i_uncertain], poses3d_rest], dim=1),
+            torch.cat([uncert_first[i_uncertain], uncert_rest], dim=1),
+        )
+        poses3d[i_uncertain] = poses3d_uncertain
+        uncert[i_uncertain] = uncert_uncertain
+        num_crops_per_box[i_uncertain] = num_aug
+        return poses3d, uncert, num_crops_per_box
 
-        # Arrange the results back into ragged tensors
-        poses3d = torch.split(poses3d_flat, n_box_per_image_list)
-        poses2d = torch.split(poses2d_flat, n_box_per_image_list)
-        uncert = torch.split(uncert_flat, n_box_per_image_list)
-
-        if suppress_implausible_poses:
-            # Filter the resulting poses for individual plausibility to reduce false positives
-            boxes, poses3d, poses2d, uncert = self._filter_poses(boxes, poses3d, poses2d, uncert)
-
-        n_box_per_image_list = [len(b) for b in boxes]
-
-        if sum(n_box_per_image_list) == 0:
-            return self._predict_empty(images, weights)
-
-        n_box_per_image = torch.tensor(n_box_per_image_list, device=device)
-        # Convert to world coordinates
-        inv_extrinsic_matrix = torch.repeat_interleave(
-            torch.linalg.inv(extrinsic_matrix.double()), n_box_per_image, dim=0
+    def _filter_poses(
+        self,
+        boxes: torch.Tensor,
+        poses3d: torch.Tensor,
+        poses2d: torch.Tensor,
+        uncert: torch.Tensor,
+        image_ids: torch.Tensor,
+        n_images: int,
+        point_indices: Optional[torch.Tensor] = None,
+    ):
+        # All images are processed together, image_ids tells which image each pose belongs to.
+        # If point_indices is given, the pose similarity of the NMS only uses those points.
+        # The plausibility checks and the scores always use all points, their thresholds were
+        # set that way.
+        is_uncert_low = plausib.is_uncertainty_low(uncert)
+        is_pose_consi = plausib.is_pose_consistent_with_box(poses2d, boxes)
+        plausible_mask = torch.logical_and(is_uncert_low, is_pose_consi)
+        scores = boxes[..., 4] / torch.mean(uncert, dim=-1)
+        poses3d_nms = poses3d[:, point_indices] if point_indices is not None else poses3d
+        nms_indices = plausib.pose_non_max_suppression_batched(
+            poses3d_nms, scores, plausible_mask, image_ids, n_images
         )
-        poses3d_flat = torch.einsum(
-            'bnk,bjk->bnj',
-            ptu3d.to_homogeneous(torch.cat(poses3d)),
-            inv_extrinsic_matrix[:, :3, :],
+        return (
+            boxes[nms_indices],
+            poses3d[nms_indices],
+            poses2d[nms_indices],
+            uncert[nms_indices],
+            image_ids[nms_indices],
         )
-        poses3d = torch.split(poses3d_flat.float(), n_box_per_image_list)
-
-        result = dict(boxes=boxes, poses3d=poses3d, poses2d=poses2d, uncertainties=uncert)
-        return result
 
-    def _filter_poses(
+    def _get_crop_source(
         self,
+        images: torch.Tensor,
+        intrinsic_matrix_per_image: torch.Tensor,
+        intrinsic_matrix: torch.Tensor,
+        distortion_coeffs: torch.Tensor,
+        camspace_up: torch.Tensor,
         boxes: List[torch.Tensor],
-        poses3d: List[torch.Tensor],
-        poses2d: List[torch.Tensor],
-        uncert: List[torch.Tensor],
+        aug_rotflipmat: torch.Tensor,
+        aug_scales: torch.Tensor,
+        antialias_factor: int,
     ):
-        boxes_out = []
-        poses3d_out = []
-        poses2d_out = []
-        uncert_out = []
-        for boxes_, poses3d_, poses2d_, uncert_ in zip(boxes, poses3d, poses2d, uncert):
-            is_uncert_low = plausib.is_uncertainty_low(uncert_)
-            is_pose_consi = plausib.is_pose_consistent_with_box(poses2d_, boxes_)
-            plausible_mask = torch.logical_and(is_uncert_low, is_pose_consi)
-            nms_indices = plausib.pose_non_max_suppression(
-                poses3d_, boxes_[..., 4] / torch.mean(uncert_, dim=-1), plausible_mask
+        # The 1-x inversion is done because torch's warping pads with 0, but we want to pad with 1
+        # because empirically it performs better on the trained model
+        # (dependent on training config). Not needed for latest recipe.
+        if not self.roi_pyramid:
+            return warping.build_crop_source(
+                images, intrinsic_matrix_per_image, invert=self.pad_white_pixels
             )
-            boxes_out.append(boxes_[nms_indices])
-            poses3d_out.append(poses3d_[nms_indices])
-            poses2d_out.append(poses2d_[nms_indices])
-            uncert_out.append(uncert_[nms_indices])
-        return boxes_out, poses3d_out, poses2d_out, uncert_out
+
+        # Restrict the pyramid to where the crops (of all augmentations) take their pixels from
+        boxes_flat = torch.cat(boxes, dim=0)
+        image_id_per_box = torch.repeat_interleave(
+            torch.arange(len(boxes), device=boxes_flat.device),
+            torch.tensor([len(b) for b in boxes], device=boxes_flat.device),
+        )
+        _, _, new_invprojmat, _ = self._get_crop_transforms(
+            intrinsic_matrix,
+            distortion_coeffs,
+            camspace_up,
+            boxes_flat,
+            aug_rotflipmat,
+            aug_scales,
+        )
+        num_aug = aug_scales.shape[0]
+        res = self.crop_model.input_resolution
+        footprints = warping.crop_footprints(
+            torch.tile(intrinsic_matrix, [num_aug, 1, 1]),
+            torch.reshape(new_invprojmat, [-1, 3, 3]),
+            torch.tile(distortion_coeffs, [num_aug, 1]),
+            (res, res),
+        )
+        return warping.build_roi_crop_source(
+            images,
+            intrinsic_matrix_per_image,
+            footprints,
+            torch.tile(image_id_per_box, [num_aug]),
+            invert=self.pad_white_pixels,
+            max_area_fraction=self.roi_pyramid_max_area_fraction,
+        )
 
     def _predict_in_batches(
         self,
-        images: torch.Tensor,
+        crop_source: warping.CropSource,
         weights: Dict[str, torch.Tensor],
         intrinsic_matrix: torch.Tensor,
         distortion_coeffs: torch.Tensor,
         camspace_up: torch.Tensor,
-        boxes: List[torch.Tensor],
+        boxes_flat: torch.Tensor,
+        image_id_per_box: torch.Tensor,
         internal_batch_size: int,
         aug_should_flip: torch.Tensor,
         aug_rotflipmat: torch.Tensor,
         aug_gammas: torch.Tensor,
         aug_scales: torch.Tensor,
         antialias_factor: int,
+        point_splits: Optional[List[int]] = None,
     ):
         num_aug = len(aug_gammas)
         boxes_per_batch = internal_batch_size // num_aug
-        boxes_flat = torch.cat(boxes, dim=0)
-        image_id_per_box = torch.repeat_interleave(
-            torch.arange(len(boxes)), torch.tensor([len(b) for b in boxes])
-        )
 
         if boxes_per_batch == 0:
             # Run all as a single batch
             return self._predict_single_batch(
-                images,
+                crop_source,
                 weights,
                 intrinsic_matrix,
                 distortion_coeffs,
@@ -617,6 +1100,7 @@ class MultipersonNLF(torch.nn.Module):
                 aug_scales,
                 aug_gammas,
                 antialias_factor,
+                point_splits,
             )
         else:
             # Chunk the image crops into batches and predict them one by one
@@ -630,7 +1114,7 @@ class MultipersonNLF(torch.nn.Module):
                 batch_slice = slice(i * boxes_per_batch, (i + 1) * boxes_per_batch)
                 # CROP
                 poses3d, uncert = self._predict_single_batch(
-                    images,
+                    crop_source,
                     weights,
                     intrinsic_matrix[batch_slice],
                     distortion_coeffs[batch_slice],
@@ -642,6 +1126,7 @@ class MultipersonNLF(torch.nn.Module):
                     aug_scales,
                     aug_gammas,
                     antialias_factor,
+                    point_splits,
                 )
                 poses3d_batches.append(poses3d)
                 uncert_batches.append(uncert)
@@ -649,7 +1134,7 @@ class MultipersonNLF(torch.nn.Module):
 
     def _predict_single_batch(
         self,
-        images: torch.Tensor,
+        crop_source: warping.CropSource,
         weights: Dict[str, torch.Tensor],
         intrinsic_matrix: torch.Tensor,
         distortion_coeffs: torch.Tensor,
@@ -661,39 +1146,46 @@ class MultipersonNLF(torch.nn.Module):
         aug_scales: torch.Tensor,
         aug_gammas: torch.Tensor,
         antialias_factor: int,
+        point_splits: Optional[List[int]] = None,
     ):
         # Get crops and info about the transformation used to create them
         # Each has shape [num_aug, n_boxes, ...]
-        crops, new_intrinsic_matrix, R = self._get_crops(
-            images,
-            intrinsic_matrix,
-            distortion_coeffs,
-            camspace_up,
-            boxes,
-            image_ids,
-            aug_rotflipmat,
-            aug_scales,
-            aug_gammas,
-            antialias_factor,
-        )
+        with torch.autograd.profiler.record_function('nlf.warp_crops'):
+            crops, new_intrinsic_matrix, R = self._get_crops(
+                crop_source,
+                intrinsic_matrix,
+                distortion_coeffs,
+                camspace_up,
+                boxes,
+                image_ids,
+                aug_rotflipmat,
+                aug_scales,
+                aug_gammas,
+                antialias_factor,
+            )
 
         # Flatten each and predict the pose with the crop model
         new_intrinsic_matrix_flat = torch.reshape(new_intrinsic_matrix, (-1, 3, 3))
         res = self.crop_model.input_resolution
-        crops_flat = torch.reshape(crops, (-1, 3, res, res))
+        crops_flat = torch.reshape(crops, (-1, 3, res, res)).to(
+            ptu.dtype_from_name(self.compute_dtype)
+        )
 
         n_cases = crops.shape[1]
         aug_should_flip_flat = torch.repeat_interleave(aug_should_flip, n_cases, dim=0)
 
-        poses_flat, uncert_flat = self.crop_model.predict_multi_same_weights(
-            crops_flat, new_intrinsic_matrix_flat, weights, aug_should_flip_flat
-        )
-        poses_flat = poses_flat.double()
+        with torch.autograd.profiler.record_function('nlf.crop_model'):
+            poses_flat, uncert_flat = self.crop_model.predict_multi_same_weights(
+                crops_flat, new_intrinsic_matrix_flat, weights, aug_should_flip_flat, point_splits
+            )
         n_joints = poses_flat.shape[-2]
 
         poses = torch.reshape(poses_flat, [-1, n_cases, n_joints, 3])
         uncert = torch.reshape(uncert_flat, [-1, n_cases, n_joints])
-        poses_orig_camspace = poses @ R.double()
+        if self.geometry_float64:
+            poses_orig_camspace = poses.double() @ R.double()
+        else:
+            poses_orig_camspace = rotate_centered(poses.float(), R)
 
         # Transpose to [n_boxes, num_aug, ...]
         return poses_orig_camspace.transpose(0, 1), uncert.transpose(0, 1)
@@ -703,7 +1195,7 @@ class MultipersonNLF(torch.nn.Module):
 
     def _get_crops(
         self,
-        images: torch.Tensor,
+        crop_source: warping.CropSource,
         intrinsic_matrix: torch.Tensor,
         distortion_coeffs: torch.Tensor,
         camspace_up: torch.Tensor,
@@ -714,17 +1206,71 @@ class MultipersonNLF(torch.nn.Module):
         aug_gammas: torch.Tensor,
         antialias_factor: int,
     ):
+        new_intrinsic_matrix, R, new_invprojmat, crop_scales = self._get_crop_transforms(
+            intrinsic_matrix, distortion_coeffs, camspace_up, boxes, aug_rotflipmat, aug_scales
+        )
+        num_box = boxes.shape[0]
+        num_aug = aug_scales.shape[0]
+        res = self.crop_model.input_resolution
+
+        # If we perform antialiasing through output scaling, we render a larger image first and then
+        # shrink it. So we scale the homography first.
+        if antialias_factor > 1:
+            scaling_mat = warping.corner_aligned_scale_mat(1 / antialias_factor)
+            new_invprojmat = new_invprojmat @ scaling_mat.to(new_invprojmat.device)
+
+        # The crop source holds 1-x if self.pad_white_pixels, so we need to invert the crops back
+        crops = warping.warp_crops(
+            crop_source,
+            new_invprojmats=torch.reshape(new_invprojmat, [-1, 3, 3]),
+            distortion_coeffs=torch.tile(distortion_coeffs, [num_aug, 1]),
+            crop_scales=torch.reshape(crop_scales, [-1]) * antialias_factor,
+            output_shape=(res * antialias_factor, res * antialias_factor),
+            image_ids=torch.tile(image_ids, [num_aug]),
+            grid_cache=self.grid_templates,
+        )
+        if self.pad_white_pixels:
+            crops.neg_().add_(1).clamp_(0, 1)
+
+        # Downscale the result if we do antialiasing through output scaling
+        if antialias_factor == 2:
+            crops = torch.nn.functional.avg_pool2d(crops, 2, 2)
+        elif antialias_factor == 4:
+            crops = torch.nn.functional.avg_pool2d(crops, 4, 4)
+        elif antialias_factor > 4:
+            crops = torchvision.transforms.v2.functional.resize(
+                crops,
+                (res, res),
+                torchvision.transforms.v2.functional.InterpolationMode.BILINEAR,
+                antialias=True,
+            )
+        crops = torch.reshape(crops, [num_aug, num_box, 3, res, res])
+        # The division by 2.2 cancels the original gamma decoding from earlier
+        crops **= torch.reshape(aug_gammas.to(crops.dtype) / 2.2, [-1, 1, 1, 1, 1])
+        return crops, new_intrinsic_matrix, R
+
+    def _get_crop_transforms(
+        self,
+        intrinsic_matrix: torch.Tensor,
+        distortion_coeffs: torch.Tensor,
+        camspace_up: torch.Tensor,
+        boxes: torch.Tensor,
+        aug_rotflipmat: torch.Tensor,
+        aug_scales: torch.Tensor,
+    ):
+        # Returns the new intrinsics, the rotation, the inverse projection and the zoom factor
+        # of each crop, each with shape [num_aug, n_boxes, ...]
         R_noaug, box_scales = self._get_new_rotation_and_scale(
             intrinsic_matrix, distortion_coeffs, camspace_up, boxes
         )
 
-        device = images.device
+        device = intrinsic_matrix.device
         # How much we need to scale overall, taking scale augmentation into account
         # From here on, we introduce the dimension of augmentations
         crop_scales = aug_scales[:, torch.newaxis] * box_scales[torch.newaxis, :]
         # Build the new intrinsic matrix
         num_box = boxes.shape[0]
-        num_aug = aug_gammas.shape[0]
+        num_aug = aug_scales.shape[0]
         res = self.crop_model.input_resolution
         new_intrinsic_matrix = torch.cat(
             [
@@ -753,49 +1299,7 @@ class MultipersonNLF(torch.nn.Module):
         )
         R = aug_rotflipmat[:, torch.newaxis] @ R_noaug
         new_invprojmat = torch.linalg.inv(new_intrinsic_matrix @ R)
-
-        # If we perform antialiasing through output scaling, we render a larger image first and then
-        # shrink it. So we scale the homography first.
-        if antialias_factor > 1:
-            scaling_mat = warping.corner_aligned_scale_mat(1 / antialias_factor)
-            new_invprojmat = new_invprojmat @ scaling_mat.to(new_invprojmat.device)
-
-        # Note that x.neg_().add_(1) is equivalent to 1 - x, but it's done in-place
-        # The 1-x is done because torch's warping pads with 0, but we want to pad with 1
-        # because empirically it performs better on the trained model
-        # (dependent on training config). Not needed for latest recipe.
-
-        if self.pad_white_pixels:
-            images.neg_().add_(1)
-
-        crops = warping.warp_images_with_pyramid(
-            images,
-            intrinsic_matrix=torch.tile(intrinsic_matrix, [num_aug, 1, 1]),
-            new_invprojmats=torch.reshape(new_invprojmat, [-1, 3, 3]),
-            distortion_coeffs=torch.tile(distortion_coeffs, [num_aug, 1]),
-            crop_scales=torch.reshape(crop_scales, [-1]) * antialias_factor,
-            output_shape=(res * antialias_factor, res * antialias_factor),
-            image_ids=torch.tile(image_ids, [num_aug]),
-        )
-        if self.pad_white_pixels:
-            crops.neg_().add_(1).clamp_(0, 1)
-
-        # Downscale the result if we do antialiasing through output scaling
-        if antialias_factor == 2:
-            crops = torch.nn.functional.avg_pool2d(crops, 2, 2)
-        elif antialias_factor == 4:
-            crops = torch.nn.functional.avg_pool2d(crops, 4, 4)
-        elif antialias_factor > 4:
-            crops = torchvision.transforms.v2.functional.resize(
-                crops,
-                (res, res),
-                torchvision.transforms.v2.functional.InterpolationMode.BILINEAR,
-                antialias=True,
-            )
-        crops = torch.reshape(crops, [num_aug, num_box, 3, res, res])
-        # The division by 2.2 cancels the original gamma decoding from earlier
-        crops **= torch.reshape(aug_gammas.to(crops.dtype) / 2.2, [-1, 1, 1, 1, 1])
-        return crops, new_intrinsic_matrix, R
+        return new_intrinsic_matrix, R, new_invprojmat, crop_scales
 
     def _get_new_rotation_and_scale(self, intrinsic_matrix, distortion_coeffs, camspace_up, boxes):
         # Transform five points on each box: the center and the midpoints of the four sides
@@ -841,7 +1345,13 @@ class MultipersonNLF(torch.nn.Module):
         )
         return R_noaug, box_scales
 
-    def _predict_empty(self, image: torch.Tensor, weights: Dict[str, torch.Tensor]):
+    def _predict_empty(
+        self,
+        image: torch.Tensor,
+        weights: Dict[str, torch.Tensor],
+        packed: bool = False,
+        num_crops: Optional[torch.Tensor] = None,
+    ):
         device = image.device
         n_joints = weights['w_tensor'].shape[0]
         poses3d = torch.zeros((0, n_joints, 3), dtype=torch.float32, device=device)
@@ -856,6 +1366,10 @@ class MultipersonNLF(torch.nn.Module):
             poses2d=[poses2d] * n_images,
             uncertainties=[uncert] * n_images,
         )
+        if num_crops is not None:
+            result['num_crops'] = list(torch.unbind(num_crops))
+        if packed:
+            return pack_ragged(result, device)
         return result
 
     def _predict_empty_parametric(self, image: torch.Tensor, model_name: str):
@@ -898,7 +1412,7 @@ class MultipersonNLF(torch.nn.Module):
     def detect_poses(
         self,
         image: torch.Tensor,
-        weights: Dict[str, torch.Tensor],
+        weights: Optional[Dict[str, torch.Tensor]] = None,
         intrinsic_matrix: Optional[torch.Tensor] = None,
         distortion_coeffs: Optional[torch.Tensor] = None,
         extrinsic_matrix: Optional[torch.Tensor] = None,
@@ -915,6 +1429,7 @@ class MultipersonNLF(torch.nn.Module):
         detector_both_flip_aug: bool = False,
         suppress_implausible_poses: bool = True,
         extra_boxes: Optional[torch.Tensor] = None,
+        skeleton: Optional[str] = None,
     ):
 
         images = image[torch.newaxis]
@@ -948,6 +1463,7 @@ class MultipersonNLF(torch.nn.Module):
             detector_both_flip_aug,
             suppress_implausible_poses,
             extra_boxes,
+            skeleton,
         )
         return {k: v[0] for k, v in result.items()}
 
@@ -956,7 +1472,7 @@ class MultipersonNLF(torch.nn.Module):
         self,
         image: torch.Tensor,
         boxes: torch.Tensor,
-        weights: Dict[str, torch.Tensor],
+        weights: Optional[Dict[str, torch.Tensor]] = None,
         intrinsic_matrix: Optional[torch.Tensor] = None,
         distortion_coeffs: Optional[torch.Tensor] = None,
         extrinsic_matrix: Optional[torch.Tensor] = None,
@@ -966,6 +1482,7 @@ class MultipersonNLF(torch.nn.Module):
         antialias_factor: int = 1,
         num_aug: int = 1,
         rot_aug_max_degrees: float = 25.0,
+        skeleton: Optional[str] = None,
     ):
 
         images = image[torch.newaxis]
@@ -993,6 +1510,7 @@ class MultipersonNLF(torch.nn.Module):
             antialias_factor,
             num_aug,
             rot_aug_max_degrees,
+            skeleton,
         )
         return {k: v[0] for k, v in result.items()}
 
@@ -1000,17 +1518,308 @@ class MultipersonNLF(torch.nn.Module):
     def get_weights_for_canonical_points(self, canonical_points: torch.Tensor):
         return self.crop_model.get_weights_for_canonical_points(canonical_points)
 
+    @torch.jit.export
+    def get_weights_for_skeleton(self, skeleton: str):
+        # Computed on first use, unless they were precomputed with precompute_weights.
+        # The ones computed on demand are kept in a least-recently-used cache with a byte budget,
+        # the precomputed ones are never evicted.
+        if skeleton in self.per_skeleton_weights:
+            if skeleton in self.skeleton_weights_lru:
+                self.skeleton_weights_lru.remove(skeleton)
+                self.skeleton_weights_lru.append(skeleton)
+            return self.per_skeleton_weights[skeleton]
+
+        weights = self.get_weights_for_canonical_points(
+            self._get_skeleton_canonical_points(skeleton)
+        )
+        self.per_skeleton_weights[skeleton] = weights
+        self.skeleton_weights_lru.append(skeleton)
+        self._evict_skeleton_weights()
+        return weights
+
+    def _evict_skeleton_weights(self):
+        sizes: List[int] = []
+        for skeleton in self.skeleton_weights_lru:
+            size = 0
+            for w in self.per_skeleton_weights[skeleton].values():
+                size += w.numel() * w.element_size()
+            sizes.append(size)
+
+        # The most recent entry is always kept, even if it is over the budget alone
+        total_size = sum(sizes)
+        i_oldest = 0
+        while total_size > self.skeleton_weights_max_bytes and len(self.skeleton_weights_lru) > 1:
+            del self.per_skeleton_weights[self.skeleton_weights_lru.pop(0)]
+            total_size -= sizes[i_oldest]
+            i_oldest += 1
+
+    def _image_dtype(self) -> torch.dtype:
+        # The crops are sampled with a grid in the dtype of the image, and bfloat16 is too coarse
+        # for that, so in that case the images are kept in float32 and only the crops are cast.
+        dtype = ptu.dtype_from_name(self.compute_dtype)
+        return torch.float32 if dtype == torch.bfloat16 else dtype
+
+    def _detector_input(self, images: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns the images to pass on for cropping and the images for the detector."""
+        if self.detect_on_gamma_frames:
+            # The detector resizes the gamma-encoded frame, and the crops are linearized once
+            return images, im_to_gamma(images, self._image_dtype())
+        # The detector gets the linearized frame, which it converts back to gamma after resizing.
+        # The linearized frame is passed on, and _estimate_poses_batched linearizes it again.
+        images = im_to_linear(images, self._image_dtype())
+        return images, images
+
+    def _resolve_weights(
+        self, weights: Optional[Dict[str, torch.Tensor]], skeleton: Optional[str]
+    ) -> Dict[str, torch.Tensor]:
+        if weights is not None:
+            return weights
+        if skeleton is not None:
+            return self.get_weights_for_skeleton(skeleton)
+        raise ValueError('Either weights or skeleton must be given')
+
+    def _get_skeleton_canonical_points(self, skeleton: str):
+        if skeleton not in self.per_skeleton_indices:
+            raise ValueError(f'Unknown skeleton {skeleton}')
+        canonical_locs = self.crop_model.canonical_locs()
+        indices = self.per_skeleton_indices[skeleton].to(canonical_locs.device).long()
+        return canonical_locs[indices]
+
+
+def rotate_centered(
+    points: torch.Tensor, rot: torch.Tensor, translation: Optional[torch.Tensor] = None
+):
+    """Computes points @ rot + translation in float32, with the accuracy of float64 up to the
+    rounding of the result.
+
+    The points are centered before the rotation and only their (small) mean is transformed in
+    float64, so the error does not grow with the distance of the points from the origin.
+
+    Args:
+        points: [..., n_points, 3] float32
+        rot: [..., 3, 3], multiplied from the right
+        translation: optional [..., 1, 3], may be float64 for large offsets
+    """
+    center = torch.mean(points, dim=-2, keepdim=True)
+    center_transformed = center.double() @ rot.double()
+    if translation is not None:
+        center_transformed = center_transformed + translation.double()
+    return (points - center) @ rot.float() + center_transformed.float()
+
+
+def im_to_linear(im: torch.Tensor, dtype: torch.dtype = torch.float16):
+    if im.dtype == torch.uint8 or im.dtype == torch.uint16:
+        # Integer images have few distinct values, so instead of evaluating the power function at
+        # every pixel, the linearized values are looked up in a table
+        table = linearization_table(im.dtype, im.device, dtype)
+        return table.index_select(0, im.reshape(-1).to(torch.int32)).reshape(im.shape)
+    elif im.dtype == dtype:
+        return im**2.2
+    else:
+        return im.to(dtype=dtype).pow_(2.2)
 
-def im_to_linear(im: torch.Tensor):
+
+def linearization_table(
+    im_dtype: torch.dtype, device: torch.device, dtype: torch.dtype = torch.float16
+):
+    """Returns the linear value of each possible value of a uint8 or uint16 image."""
+    if im_dtype == torch.uint8:
+        values = torch.arange(256, dtype=torch.int32, device=device)
+        return values.to(dtype=dtype).mul_(1.0 / 255.0).pow_(2.2)
+    else:
+        # Values above 65504 (the float16 maximum) are saturated to 1
+        values = torch.arange(65536, dtype=torch.int32, device=device)
+        return values.to(dtype=dtype).mul_(1.0 / 65504.0).clamp_(max=1.0).pow_(2.2)
+
+
+def im_to_gamma(im: torch.Tensor, dtype: torch.dtype = torch.float16):
+    """Converts an image to the same range and dtype as im_to_linear, but without linearizing
+    it, i.e., the values stay gamma-encoded."""
     if im.dtype == torch.uint8:
-        return im.to(dtype=torch.float16).mul_(1.0 / 255.0).pow_(2.2)
+        return im.to(dtype=dtype).mul_(1.0 / 255.0)
     elif im.dtype == torch.uint16:
-        return im.to(dtype=torch.float16).mul_(1.0 / 65504.0).nan_to_num_(posinf=1.0).pow_(2.2)
-        # return im.to(dtype=torch.float16).nan_to_num_(posinf=65504.0).div_(65504.0).pow_(2.2)
-    elif im.dtype == torch.float16:
-        return im**2.2
+        return im.to(dtype=dtype).mul_(1.0 / 65504.0).clamp_(max=1.0)
     else:
-        return im.to(dtype=torch.float16).pow_(2.2)
+        return im.to(dtype=dtype)
+
+
+def fit_body_model(
+    fitter: smplfitter.pt.BodyFitter,
+    vertices: torch.Tensor,
+    joints: torch.Tensor,
+    vertex_weights: torch.Tensor,
+    joint_weights: torch.Tensor,
+    num_iter: int,
+    beta_regularizer: float,
+    beta_regularizer2: float,
+    initial_pose: Optional[torch.Tensor] = None,
+    known_betas: Optional[torch.Tensor] = None,
+) -> Dict[str, torch.Tensor]:
+    """Fits the body model to the predicted points, optionally warm-started from initial_pose,
+    and with a known shape for the rows of known_betas that are finite.
+
+    No initial shape is passed to the fitter, as it would also become the reference that the
+    beta regularizer pulls toward, instead of zero."""
+    i_known = torch.zeros(0, dtype=torch.int64, device=vertices.device)
+    i_unknown = torch.arange(vertices.shape[0], device=vertices.device)
+    if known_betas is not None:
+        is_known = torch.all(torch.isfinite(known_betas), dim=-1)
+        i_known = torch.nonzero(is_known).squeeze(1)
+        i_unknown = torch.nonzero(torch.logical_not(is_known)).squeeze(1)
+
+    results: List[Dict[str, torch.Tensor]] = []
+    indices: List[torch.Tensor] = []
+    if i_unknown.shape[0] > 0:
+        results.append(
+            fitter.fit(
+                vertices[i_unknown],
+                joints[i_unknown],
+                vertex_weights=vertex_weights[i_unknown],
+                joint_weights=joint_weights[i_unknown],
+                num_iter=num_iter,
+                beta_regularizer=beta_regularizer,
+                beta_regularizer2=beta_regularizer2,
+                final_adjust_rots=True,
+                initial_pose_rotvecs=(
+                    initial_pose[i_unknown] if initial_pose is not None else None
+                ),
+                requested_keys=['pose_rotvecs', 'shape_betas', 'trans'],
+            )
+        )
+        indices.append(i_unknown)
+
+    if known_betas is not None and i_known.shape[0] > 0:
+        shape_betas = known_betas[i_known]
+        result = fitter.fit_with_known_shape(
+            shape_betas,
+            vertices[i_known],
+            joints[i_known],
+            vertex_weights=vertex_weights[i_known],
+            joint_weights=joint_weights[i_known],
+            num_iter=num_iter,
+            final_adjust_rots=True,
+            initial_pose_rotvecs=initial_pose[i_known] if initial_pose is not None else None,
+            requested_keys=['pose_rotvecs', 'trans'],
+        )
+        result['shape_betas'] = shape_betas
+        results.append(result)
+        indices.append(i_known)
+
+    if len(results) == 1:
+        return results[0]
+
+    # Put the rows of the two groups back into the original order
+    index = torch.cat(indices)
+    merged: Dict[str, torch.Tensor] = {}
+    for key in ['pose_rotvecs', 'shape_betas', 'trans']:
+        values = torch.cat([r[key].to(results[0][key].dtype) for r in results])
+        merged[key] = torch.empty_like(values).index_copy_(0, index, values)
+    return merged
+
+
+def cat_optional(
+    tensors: Optional[List[torch.Tensor]], device: torch.device
+) -> Optional[torch.Tensor]:
+    if tensors is None:
+        return None
+    return torch.cat(tensors, dim=0).to(device=device, dtype=torch.float32)
+
+
+def concat_weights(weights_list: List[Dict[str, torch.Tensor]]) -> Dict[str, torch.Tensor]:
+    # Concatenates the weights of several point sets along the points, to decode them together
+    result: Dict[str, torch.Tensor] = {}
+    for key in weights_list[0].keys():
+        result[key] = torch.cat([w[key] for w in weights_list], dim=0)
+    return result
+
+
+def split_point_sets(
+    result: Dict[str, List[torch.Tensor]], names: List[str], point_splits: List[int]
+) -> Dict[str, Dict[str, List[torch.Tensor]]]:
+    # Splits a result of concatenated point sets into one result per set. The entries without a
+    # point dimension (like num_crops or the packing offsets) are shared by all sets.
+    results: Dict[str, Dict[str, List[torch.Tensor]]] = {}
+    for name in names:
+        results[name] = {}
+    for key, values in result.items():
+        if key in ('poses3d', 'poses2d', 'uncertainties'):
+            parts = [torch.split(v, point_splits, dim=1) for v in values]
+            for i_set, name in enumerate(names):
+                results[name][key] = [p[i_set] for p in parts]
+        else:
+            for name in names:
+                results[name][key] = values
+    return results
+
+
+def select_keys(
+    result: Dict[str, List[torch.Tensor]], requested_keys: List[str]
+) -> Dict[str, List[torch.Tensor]]:
+    # The boxes are always kept, as they identify the detections, and so is num_crops, which is
+    # only there with adaptive augmentation
+    return {
+        k: v for k, v in result.items() if k == 'boxes' or k == 'num_crops' or k in requested_keys
+    }
+
+
+def arrange_results(
+    flat: Dict[str, torch.Tensor],
+    n_per_image: torch.Tensor,
+    num_crops: Optional[torch.Tensor],
+    packed: bool,
+    n_per_image_list: Optional[List[int]] = None,
+) -> Dict[str, List[torch.Tensor]]:
+    """Splits the per-detection results of all images into per-image lists, or packs them.
+
+    In the packed format, each value is a one-element list holding the tensor of all images
+    concatenated, and the 'offsets' ([n_images + 1]) and 'image_ids' ([n_detections]) entries
+    tell which rows belong to which image. 'num_crops' (only given with adaptive augmentation)
+    is then a single [n_images] tensor.
+    The packed format avoids the many small tensors of the ragged format, see packed.py.
+    """
+    if packed:
+        result = {k: [v] for k, v in flat.items()}
+        offsets, image_ids = packed_index(n_per_image)
+        result['offsets'] = [offsets]
+        result['image_ids'] = [image_ids]
+        if num_crops is not None:
+            result['num_crops'] = [num_crops]
+        return result
+
+    if n_per_image_list is None:
+        n_per_image_list = torch.jit.annotate(List[int], n_per_image.tolist())
+    result = {k: list(torch.split(v, n_per_image_list)) for k, v in flat.items()}
+    if num_crops is not None:
+        result['num_crops'] = list(torch.unbind(num_crops))
+    return result
+
+
+def pack_ragged(
+    result: Dict[str, List[torch.Tensor]], device: torch.device
+) -> Dict[str, List[torch.Tensor]]:
+    """Converts a result from the ragged format to the packed one, see arrange_results."""
+    packed: Dict[str, List[torch.Tensor]] = {}
+    n_per_image_list: List[int] = []
+    for k, v in result.items():
+        if k == 'num_crops':
+            packed[k] = [torch.stack(v)]
+        else:
+            packed[k] = [torch.cat(v, dim=0)]
+            n_per_image_list = [len(x) for x in v]
+    offsets, image_ids = packed_index(
+        torch.tensor(n_per_image_list, dtype=torch.int64, device=device)
+    )
+    packed['offsets'] = [offsets]
+    packed['image_ids'] = [image_ids]
+    return packed
+
+
+def packed_index(n_per_image: torch.Tensor):
+    offsets = torch.cat([n_per_image.new_zeros(1), torch.cumsum(n_per_image, dim=0)])
+    image_ids = torch.repeat_interleave(
+        torch.arange(n_per_image.shape[0], device=n_per_image.device), n_per_image
+    )
+    return offsets, image_ids
 
 
 def project_ragged(
@@ -1021,10 +1830,31 @@ def project_ragged(
     distortion_coeffs: Optional[torch.Tensor],
     default_fov_degrees: float = 55.0,
 ):
-    device = images.device
     n_box_per_image_list = [len(b) for b in poses3d]
-    n_box_per_image = torch.tensor([len(b) for b in poses3d], device=device)
+    n_box_per_image = torch.tensor(n_box_per_image_list, device=images.device)
+    poses2d_flat = project_packed(
+        images,
+        torch.cat(poses3d, dim=0),
+        n_box_per_image,
+        extrinsic_matrix,
+        intrinsic_matrix,
+        distortion_coeffs,
+        default_fov_degrees,
+    )
+    return torch.split(poses2d_flat, n_box_per_image_list)
 
+
+def project_packed(
+    images: torch.Tensor,
+    poses3d_flat: torch.Tensor,
+    n_box_per_image: torch.Tensor,
+    extrinsic_matrix: Optional[torch.Tensor],
+    intrinsic_matrix: Optional[torch.Tensor],
+    distortion_coeffs: Optional[torch.Tensor],
+    default_fov_degrees: float = 55.0,
+):
+    """Projects the world-space poses of all images, concatenated, to the image planes."""
+    device = images.device
     n_images = images.shape[0]
 
     if intrinsic_matrix is None:
@@ -1052,7 +1882,6 @@ def project_ragged(
     distortion_coeffs_rep = torch.repeat_interleave(distortion_coeffs, n_box_per_image, dim=0)
     extrinsic_matrix_rep = torch.repeat_interleave(extrinsic_matrix, n_box_per_image, dim=0)
 
-    poses3d_flat = torch.cat(poses3d, dim=0)
     poses3d_flat = torch.einsum(
         'bnk,bjk->bnj', ptu3d.to_homogeneous(poses3d_flat), extrinsic_matrix_rep[:, :3, :]
     )
@@ -1060,11 +1889,23 @@ def project_ragged(
     poses2d_flat_normalized = ptu3d.to_homogeneous(
         warping.distort_points(ptu3d.project(poses3d_flat), distortion_coeffs_rep)
     )
-    poses2d_flat = torch.einsum(
-        'bnk,bjk->bnj', poses2d_flat_normalized, intrinsic_matrix_rep[:, :2, :]
-    )
-    poses2d = torch.split(poses2d_flat, n_box_per_image_list)
-    return poses2d
+    return torch.einsum('bnk,bjk->bnj', poses2d_flat_normalized, intrinsic_matrix_rep[:, :2, :])
+
+
+def farthest_point_indices(points: np.ndarray, n_points: int):
+    """Greedy farthest point sampling, starting from the point closest to the centroid.
+    Returns the sorted indices of the selected points, or all indices if n_points <= 0."""
+    if n_points <= 0 or n_points >= len(points):
+        return np.arange(len(points))
+
+    i_first = np.argmin(np.linalg.norm(points - np.mean(points, axis=0), axis=-1))
+    indices = [i_first]
+    dists = np.linalg.norm(points - points[i_first], axis=-1)
+    for _ in range(1, n_points):
+        i_next = np.argmax(dists)
+        indices.append(i_next)
+        dists = np.minimum(dists, np.linalg.norm(points - points[i_next], axis=-1))
+    return np.sort(np.array(indices))
 
 
 def weighted_geometric_median(
@@ -1074,21 +1915,44 @@ def weighted_geometric_median(
     dim: int = -2,
     eps: float = 1e-1,
     keepdim: bool = False,
+    tol: float = 0.0,
 ):
+    """Weighted geometric median of the vectors (last axis) of x along dim, computed with
+    Weiszfeld iterations. Returns the median and the final weights of the items.
+
+    With tol > 0 (and dim not being the first axis), the iterations stop separately for each
+    index along the first axis, once its median moves by at most tol in every coordinate in an
+    iteration. Converged indices are dropped from the further iterations.
+    """
     if dim < 0:
         dim = len(x.shape) + dim
 
     if w is None:
         w = torch.ones_like(x[..., :1])
     else:
-        w = w.unsqueeze(-1)
-
-    new_weights = w
-    y = weighted_mean(x, new_weights, dim=dim, keepdim=True)
-    for _ in range(n_iter):
-        dist = torch.norm(x - y, dim=-1, keepdim=True)
-        new_weights = w / (dist + eps)
-        y = weighted_mean(x, new_weights, dim=dim, keepdim=True)
+        w = w.unsqueeze(-1).to(x.dtype)
+
+    if x.shape[dim] == 1:
+        # The median of a single item is the item itself, and the weights are what an iteration
+        # would give with zero distance to the median.
+        y = x if keepdim else x.squeeze(dim)
+        return y, (w / eps).squeeze(-1)
+
+    y = weighted_mean(x, w, dim=dim, keepdim=True)
+    if n_iter <= 0:
+        if not keepdim:
+            y = y.squeeze(dim)
+        return y, w.squeeze(-1)
+
+    if tol > 0.0 and dim > 0:
+        y, new_weights = _weighted_geometric_median_early_stop(x, w, y, n_iter, dim, eps, tol)
+    else:
+        # The same buffers are used in all iterations
+        diff_buffer = torch.empty_like(x)
+        weights_buffer = torch.empty_like(x[..., :1])
+        for _ in range(n_iter):
+            y = _weiszfeld_step(x, w, y, dim, eps, diff_buffer, weights_buffer)
+        new_weights = weights_buffer
 
     if not keepdim:
         y = y.squeeze(dim)
@@ -1096,5 +1960,68 @@ def weighted_geometric_median(
     return y, new_weights.squeeze(-1)
 
 
+def _weighted_geometric_median_early_stop(
+    x: torch.Tensor,
+    w: torch.Tensor,
+    y: torch.Tensor,
+    n_iter: int,
+    dim: int,
+    eps: float,
+    tol: float,
+):
+    final_weights = torch.empty_like(x[..., :1])
+    active_indices = torch.arange(x.shape[0], device=x.device)
+    x_active = x
+    w_active = w
+    y_active = y
+    diff_buffer = torch.empty_like(x)
+    weights_buffer = torch.empty_like(x[..., :1])
+
+    for i_iter in range(n_iter):
+        y_new = _weiszfeld_step(
+            x_active, w_active, y_active, dim, eps, diff_buffer, weights_buffer
+        )
+        shift = torch.amax(torch.abs(y_new - y_active).reshape(y_new.shape[0], -1), dim=1)
+        y[active_indices] = y_new
+        final_weights[active_indices] = weights_buffer
+        if i_iter == n_iter - 1:
+            break
+
+        is_converged = shift <= tol
+        if bool(torch.all(is_converged)):
+            break
+        elif bool(torch.any(is_converged)):
+            # Continue only with the indices that have not converged, in smaller buffers
+            is_active = torch.logical_not(is_converged)
+            active_indices = active_indices[is_active]
+            x_active = x_active[is_active]
+            w_active = w_active[is_active]
+            y_active = y_new[is_active]
+            diff_buffer = torch.empty_like(x_active)
+            weights_buffer = torch.empty_like(x_active[..., :1])
+        else:
+            y_active = y_new
+
+    return y, final_weights
+
+
+def _weiszfeld_step(
+    x: torch.Tensor,
+    w: torch.Tensor,
+    y: torch.Tensor,
+    dim: int,
+    eps: float,
+    diff_buffer: torch.Tensor,
+    weights_buffer: torch.Tensor,
+):
+    # Computes the weights into weights_buffer and returns the new median, which is the same as
+    # weighted_mean(x, w / (norm(x - y) + eps)), but with fewer allocations
+    torch.sub(x, y, out=diff_buffer)
+    torch.linalg.vector_norm(diff_buffer, dim=-1, keepdim=True, out=weights_buffer)
+    torch.div(w, weights_buffer.add_(eps), out=weights_buffer)
+    weighted_sum = torch.mul(x, weights_buffer, out=diff_buffer).sum(dim=dim, keepdim=True)
+    return weighted_sum.div_(weights_buffer.sum(dim=dim, keepdim=True))
+
+
 def weighted_mean(x: torch.Tensor, w: torch.Tensor, dim: int = -2, keepdim: bool = False):
     return (x * w).sum(dim=dim, keepdim=keepdim) / w.sum(dim=dim, keepdim=keepdim)
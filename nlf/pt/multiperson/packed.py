@@ -0,0 +1,93 @@
+import numpy as np
+import torch
+
+# Entries of a packed result that index the rows instead of holding per-detection data
+INDEX_KEYS = ('offsets', 'image_ids', 'num_crops')
+
+
+class PackedResult:
+    """Results of a MultipersonNLF API called with packed=True.
+
+    Each entry is a single tensor holding the rows of all images, concatenated. The rows of
+    image i are offsets[i]:offsets[i + 1], and image_ids tells the image of each row. Unlike the
+    default ragged format (lists of per-image tensors), this can be moved to the host with a
+    single copy, see to_numpy, and per-image views are only created when asked for.
+
+    Example:
+        pred = PackedResult(model.detect_poses_batched(frames, skeleton='smpl_24', packed=True))
+        pred = pred.to_numpy()
+        for i_image in range(len(pred)):
+            poses3d = pred.image(i_image)['poses3d']
+    """
+
+    def __init__(self, result):
+        self.data = {k: v[0] for k, v in result.items() if k not in INDEX_KEYS}
+        self.offsets = result['offsets'][0]
+        self.image_ids = result['image_ids'][0]
+        self.num_crops = result['num_crops'][0] if 'num_crops' in result else None
+        self._offsets_list = None
+
+    def __len__(self):
+        """The number of images."""
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+        """The values of all detections of all images, concatenated."""
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def keys(self):
+        return self.data.keys()
+
+    def image(self, i_image):
+        """The results of one image, as views into the packed arrays."""
+        if self._offsets_list is None:
+            self._offsets_list = self.offsets.tolist()
+        start, end = self._offsets_list[i_image], self._offsets_list[i_image + 1]
+        return {k: v[start:end] for k, v in self.data.items()}
+
+    def ragged(self):
+        """The results in the default ragged format, as lists of per-image views."""
+        images = [self.image(i) for i in range(len(self))]
+        return {k: [im[k] for im in images] for k in self.data}
+
+    def to_numpy(self):
+        """Returns a PackedResult holding NumPy arrays, copied from the device in one transfer.
+
+        All tensors are reinterpreted as bytes and concatenated on the device, so that
+        there is a single device-to-host copy no matter how many entries there are.
+        """
+        tensors = dict(self.data, offsets=self.offsets, image_ids=self.image_ids)
+        if self.num_crops is not None:
+            tensors['num_crops'] = self.num_crops
+        # NumPy has no bfloat16
+        tensors = {
+            k: (v.float() if v.dtype == torch.bfloat16 else v).detach().contiguous()
+            for k, v in tensors.items()
+        }
+
+        chunks = []
+        layout = {}
+        n_bytes_total = 0
+        for k, v in tensors.items():
+            n_bytes = v.numel() * v.element_size()
+            # Each entry starts at a multiple of 8 bytes, so the NumPy views are aligned
+            n_padding = -n_bytes % 8
+            chunks.append(v.reshape(-1).view(torch.uint8))
+            if n_padding:
+                chunks.append(v.new_zeros(n_padding, dtype=torch.uint8))
+            layout[k] = (n_bytes_total, n_bytes, v.shape, v.dtype)
+            n_bytes_total += n_bytes + n_padding
+
+        buffer = torch.cat(chunks).cpu().numpy() if chunks else np.zeros(0, np.uint8)
+        arrays = {
+            k: buffer[start : start + n_bytes].view(numpy_dtype(dtype)).reshape(shape)
+            for k, (start, n_bytes, shape, dtype) in layout.items()
+        }
+        return PackedResult({k: [v] for k, v in arrays.items()})
+
+
+def numpy_dtype(dtype):
+    return torch.empty(0, dtype=dtype).numpy().dtype
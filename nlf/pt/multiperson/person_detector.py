@@ -5,12 +5,19 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.ops
 
+from nlf.pt import ptu
+
 
 class PersonDetector(nn.Module):
-    def __init__(self, model_path):
+    def __init__(self, model_path, compute_dtype='float16'):
         super().__init__()
         self.input_size = 640
-        self.model = torch.jit.load(model_path).half()
+        self.compute_dtype = compute_dtype
+        # Loaded to the CPU first, so that it also loads on machines without a GPU. It is moved
+        # to the device of the enclosing model like any other submodule.
+        self.model = torch.jit.load(model_path, map_location='cpu').to(
+            ptu.dtype_from_name(compute_dtype)
+        )
         self.person_class_id = '0'
 
     def forward(
@@ -24,7 +31,12 @@ class PersonDetector(nn.Module):
         flip_aug: bool = False,
         bothflip_aug: bool = False,
         extra_boxes: Optional[List[torch.Tensor]] = None,
+        linear_input: bool = True,
     ):
+        """Detects people in images with values in [0, 1].
+
+        If linear_input is False, the images are taken to be gamma-encoded, as the detector
+        expects, otherwise they are converted to gamma encoding after resizing."""
         if max_detections == -1:
             max_detections = 150
         device = images.device
@@ -35,21 +47,23 @@ class PersonDetector(nn.Module):
         if world_up_vector is None:
             world_up_vector = torch.tensor([0, -1, 0], device=device, dtype=torch.float32)
 
-        images, x_factor, y_factor, half_pad_h_float, half_pad_w_float = resize_and_pad(
-            images, self.input_size
-        )
+        with torch.autograd.profiler.record_function('nlf.detector.resize_and_pad'):
+            images, x_factor, y_factor, half_pad_h_float, half_pad_w_float = resize_and_pad(
+                images, self.input_size, linear_input
+            )
 
         cam_up_vector = matvec(extrinsic_matrix[:, :3, :3], world_up_vector)
         angle = torch.atan2(cam_up_vector[:, 1], cam_up_vector[:, 0])
         k = (torch.round(angle / (torch.pi / 2)) + 1).to(torch.int32) % 4
         images = batched_rot90(images, k)
 
-        if bothflip_aug:
-            boxes, scores = self.call_model_bothflip_aug(images)
-        elif flip_aug:
-            boxes, scores = self.call_model_flip_aug(images)
-        else:
-            boxes, scores = self.call_model(images)
+        with torch.autograd.profiler.record_function('nlf.detector.model'):
+            if bothflip_aug:
+                boxes, scores = self.call_model_bothflip_aug(images)
+            elif flip_aug:
+                boxes, scores = self.call_model_flip_aug(images)
+            else:
+                boxes, scores = self.call_model(images)
 
         # Convert from cxcywh to xyxy (top-left-bottom-right)
         boxes = torch.stack(
@@ -71,34 +85,35 @@ class PersonDetector(nn.Module):
             )
             scores = scores[:, class_ids].sum(dim=-1)
 
-        if extra_boxes is not None:
-            # we need to apply the same transformations to the extra boxes
-            unscaled_extra_boxes = [
-                inv_scale_boxes(
-                    extra_boxes_,
-                    half_pad_w_float,
-                    half_pad_h_float,
-                    x_factor,
-                    y_factor,
-                    k_,
-                    self.input_size,
+        with torch.autograd.profiler.record_function('nlf.detector.nms'):
+            if extra_boxes is not None:
+                # we need to apply the same transformations to the extra boxes
+                unscaled_extra_boxes = [
+                    inv_scale_boxes(
+                        extra_boxes_,
+                        half_pad_w_float,
+                        half_pad_h_float,
+                        x_factor,
+                        y_factor,
+                        k_,
+                        self.input_size,
+                    )
+                    for extra_boxes_, k_ in zip(extra_boxes, k)
+                ]
+                extra_scores = [extra_boxes_[..., 4] for extra_boxes_ in extra_boxes]
+                boxes_nms, scores_nms = nms_with_extra(
+                    boxes,
+                    scores,
+                    unscaled_extra_boxes,
+                    extra_scores,
+                    threshold,
+                    nms_iou_threshold,
+                    max_detections,
+                )
+            else:
+                boxes_nms, scores_nms = nms(
+                    boxes, scores, threshold, nms_iou_threshold, max_detections
                 )
-                for extra_boxes_, k_ in zip(extra_boxes, k)
-            ]
-            extra_scores = [extra_boxes_[..., 4] for extra_boxes_ in extra_boxes]
-            boxes_nms, scores_nms = nms_with_extra(
-                boxes,
-                scores,
-                unscaled_extra_boxes,
-                extra_scores,
-                threshold,
-                nms_iou_threshold,
-                max_detections,
-            )
-        else:
-            boxes_nms, scores_nms = nms(
-                boxes, scores, threshold, nms_iou_threshold, max_detections
-            )
 
         return [
             scale_boxes(
@@ -158,7 +173,7 @@ class PersonDetector(nn.Module):
         return boxes, scores
 
     def call_model(self, images):
-        preds = self.model(images.to(dtype=torch.float16))
+        preds = self.model(images.to(dtype=ptu.dtype_from_name(self.compute_dtype)))
         preds = torch.permute(preds, [0, 2, 1])  # [batch, n_boxes, 84]
         boxes = preds[..., :4]
         scores = preds[..., 4:]
@@ -172,18 +187,20 @@ def nms(
     nms_iou_threshold: float,
     max_detections: int,
 ):
-    selected_boxes = []
-    selected_scores = []
-    for boxes_now, scores_now in zip(boxes, scores):
-        is_above_threshold = scores_now > threshold
-        boxes_now = boxes_now[is_above_threshold]
-        scores_now = scores_now[is_above_threshold]
-        nms_indices = torchvision.ops.nms(boxes_now, scores_now, nms_iou_threshold)[
-            :max_detections
-        ]
-        selected_boxes.append(boxes_now[nms_indices])
-        selected_scores.append(scores_now[nms_indices])
-    return selected_boxes, selected_scores
+    n_images = boxes.shape[0]
+    n_candidates = boxes.shape[1]
+    image_ids = torch.repeat_interleave(
+        torch.arange(n_images, device=boxes.device), n_candidates, dim=0
+    )
+    return batched_nms_per_image(
+        torch.reshape(boxes, [-1, 4]),
+        torch.reshape(scores, [-1]),
+        image_ids,
+        n_images,
+        threshold,
+        nms_iou_threshold,
+        max_detections,
+    )
 
 
 def nms_with_extra(
@@ -195,31 +212,103 @@ def nms_with_extra(
     nms_iou_threshold: float,
     max_detections: int,
 ):
-    selected_boxes = []
-    selected_scores = []
-    for boxes_now_, scores_now_, extra_boxes_now, extra_scores_now in zip(
-        boxes, scores, extra_boxes, extra_scores
-    ):
-        boxes_now = torch.cat([boxes_now_, extra_boxes_now], dim=0)
-        scores_now = torch.cat([scores_now_, extra_scores_now], dim=0)
-        is_above_threshold = scores_now > threshold
-        boxes_now = boxes_now[is_above_threshold]
-        scores_now = scores_now[is_above_threshold]
-        nms_indices = torchvision.ops.nms(boxes_now, scores_now, nms_iou_threshold)[
-            :max_detections
-        ]
-        selected_boxes.append(boxes_now[nms_indices])
-        selected_scores.append(scores_now[nms_indices])
-    boxes = selected_boxes
-    scores = selected_scores
-    return boxes, scores
+    n_images = boxes.shape[0]
+    n_candidates = boxes.shape[1]
+    device = boxes.device
+    image_ids = torch.repeat_interleave(torch.arange(n_images, device=device), n_candidates, dim=0)
+    extra_image_ids = torch.repeat_interleave(
+        torch.arange(n_images, device=device),
+        torch.tensor([len(b) for b in extra_boxes], device=device),
+        dim=0,
+    )
+    return batched_nms_per_image(
+        torch.cat([torch.reshape(boxes, [-1, 4]), torch.cat(extra_boxes, dim=0)], dim=0),
+        torch.cat([torch.reshape(scores, [-1]), torch.cat(extra_scores, dim=0)], dim=0),
+        torch.cat([image_ids, extra_image_ids], dim=0),
+        n_images,
+        threshold,
+        nms_iou_threshold,
+        max_detections,
+    )
+
+
+def batched_nms_per_image(
+    boxes: torch.Tensor,
+    scores: torch.Tensor,
+    image_ids: torch.Tensor,
+    n_images: int,
+    threshold: float,
+    nms_iou_threshold: float,
+    max_detections: int,
+):
+    """Thresholding and non-maximum suppression for the candidates of all images at once.
+
+    The boxes of each image are shifted by an image-dependent offset so that boxes of different
+    images never overlap, then a single NMS call is made. The result is the same as calling
+    torchvision.ops.nms per image, with at most max_detections boxes per image, sorted by score.
+
+    Args:
+        boxes: the candidate boxes of all images, in xyxy format, shape [N, 4]
+        scores: the scores of the candidates, shape [N]
+        image_ids: the index of the image of each candidate, shape [N]
+        n_images: number of images
+        threshold: candidates with a score not above this are discarded
+        nms_iou_threshold: IoU threshold for the suppression
+        max_detections: the maximum number of boxes kept per image
+
+    Returns:
+        The lists of selected boxes and scores per image.
+    """
+    is_above_threshold = scores > threshold
+    boxes = boxes[is_above_threshold]
+    scores = scores[is_above_threshold]
+    image_ids = image_ids[is_above_threshold]
+
+    if boxes.shape[0] == 0:
+        sizes = [0] * n_images
+        return list(torch.split(boxes, sizes)), list(torch.split(scores, sizes))
+
+    # The offsets are computed in float32, float16 cannot represent them precisely enough.
+    boxes_float = boxes.float()
+    offsets = image_ids.to(torch.float32) * (torch.max(boxes_float) + 1)
+    nms_indices = torchvision.ops.nms(
+        boxes_float + offsets.unsqueeze(1), scores.float(), nms_iou_threshold
+    )
+
+    # Group the kept boxes by image, keeping the order by decreasing score within each image
+    n_kept = nms_indices.shape[0]
+    kept_image_ids = image_ids[nms_indices]
+    order = torch.argsort(kept_image_ids * n_kept + torch.arange(n_kept, device=boxes.device))
+    nms_indices = nms_indices[order]
+    kept_image_ids = kept_image_ids[order]
+
+    # Limit the number of detections per image
+    counts = torch.bincount(kept_image_ids, minlength=n_images)
+    starts = torch.cumsum(counts, dim=0) - counts
+    rank_in_image = torch.arange(n_kept, device=boxes.device) - starts[kept_image_ids]
+    nms_indices = nms_indices[rank_in_image < max_detections]
+    sizes = torch.jit.annotate(List[int], torch.clamp(counts, max=max_detections).tolist())
+    return list(torch.split(boxes[nms_indices], sizes)), list(
+        torch.split(scores[nms_indices], sizes)
+    )
+
 
+def batched_rot90(images: torch.Tensor, k: torch.Tensor):
+    # Rotates each image [C, H, W] of the batch by k[i] * 90 degrees. The images must be square
+    # unless all k are equal. Since k usually comes from a fixed camera up-vector, it is typically
+    # the same for the whole batch, so we rotate all images with the same k in a single call.
+    if images.shape[0] == 0:
+        return images
+    k_values = torch.jit.annotate(List[int], torch.unique(k).tolist())
+    if len(k_values) == 1:
+        if k_values[0] % 4 == 0:
+            return images
+        return torch.rot90(images, k=k_values[0], dims=[2, 3])
 
-def batched_rot90(images, k):
-    batch_size = images.size(0)
     rotated_images = torch.empty_like(images)
-    for i in range(batch_size):
-        rotated_images[i] = torch.rot90(images[i], k=k[i], dims=[1, 2])
+    for k_value in k_values:
+        indices = torch.nonzero(k == k_value).squeeze(1)
+        rotated_images[indices] = torch.rot90(images[indices], k=k_value, dims=[2, 3])
     return rotated_images
 
 
@@ -227,7 +316,7 @@ def matvec(a, b):
     return (a @ b.unsqueeze(-1)).squeeze(-1)
 
 
-def resize_and_pad(images: torch.Tensor, input_size: int):
+def resize_and_pad(images: torch.Tensor, input_size: int, linear_input: bool = True):
     h = float(images.shape[2])
     w = float(images.shape[3])
     max_side = max(h, w)
@@ -251,7 +340,8 @@ def resize_and_pad(images: torch.Tensor, input_size: int):
     )
     # images = F.interpolate(
     #    images, (target_h, target_w), antialias=factor < 1)
-    images **= 1 / 2.2
+    if linear_input:
+        images **= 1 / 2.2
     images = F.pad(
         images, (half_pad_w, pad_w - half_pad_w, half_pad_h, pad_h - half_pad_h), value=0.5
     )
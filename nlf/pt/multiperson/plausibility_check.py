@@ -1,15 +1,127 @@
+from typing import List
+
 import torch
 
 
 def pose_non_max_suppression(poses, scores, is_pose_valid):
-    plausible_indices_single_frame = torch.squeeze(torch.argwhere(is_pose_valid), 1)
-    plausible_poses = poses[plausible_indices_single_frame]
-    plausible_scores = scores[plausible_indices_single_frame]
-    similarity_matrix = compute_pose_similarity(plausible_poses)
-    nms_indices = non_max_suppression_overlaps(
-        overlaps=similarity_matrix, scores=plausible_scores, overlap_threshold=0.4
+    image_ids = torch.zeros(poses.shape[0], dtype=torch.int64, device=poses.device)
+    return pose_non_max_suppression_batched(poses, scores, is_pose_valid, image_ids, 1)
+
+
+def pose_non_max_suppression_batched(
+    poses: torch.Tensor,
+    scores: torch.Tensor,
+    is_pose_valid: torch.Tensor,
+    image_ids: torch.Tensor,
+    n_images: int,
+    overlap_threshold: float = 0.4,
+    max_padding_factor: float = 2.0,
+):
+    """Pose NMS for the poses of several images at once.
+
+    The valid poses are laid out in a padded [images, slots] layout, so that the similarities
+    of all images are computed in one call. With M valid poses in the most crowded image, this
+    compares B * M^2 pairs instead of the sum of N_i^2 needed ones. If that is more than
+    max_padding_factor times as many (e.g., one crowded frame among many sparse ones), the
+    images are grouped by their number of poses rounded up to a power of two and each group
+    is handled separately, which compares at most 4 times the needed pairs.
+
+    Args:
+        poses: the poses of all images, shape [N, J, 3]
+        scores: the score of each pose, shape [N]
+        is_pose_valid: which poses take part in the NMS, the others are discarded, shape [N]
+        image_ids: the index of the image of each pose, shape [N]
+        n_images: number of images
+        overlap_threshold: poses more similar than this to a kept pose are suppressed
+        max_padding_factor: the largest allowed ratio of compared pairs to needed pairs
+
+    Returns:
+        The indices of the kept poses, grouped by image and sorted by decreasing score within
+        each image.
+    """
+    device = poses.device
+    indices = torch.nonzero(is_pose_valid).squeeze(1)
+    if indices.shape[0] == 0:
+        return indices
+
+    image_ids = image_ids[indices].long()
+    counts = torch.bincount(image_ids, minlength=n_images)
+    n_needed_pairs = int(torch.sum(torch.square(counts)))
+    max_count = int(torch.max(counts))
+    if n_images * max_count * max_count <= max_padding_factor * n_needed_pairs:
+        return _pose_nms_padded(
+            poses, scores, indices, image_ids, n_images, max_count, overlap_threshold
+        )
+
+    buckets = torch.ceil(torch.log2(counts.float()))
+    bucket_list = torch.jit.annotate(List[float], torch.unique(buckets[counts > 0]).tolist())
+    kept_parts = []
+    for bucket in bucket_list:
+        is_image_in_bucket = buckets == bucket
+        is_pose_in_bucket = is_image_in_bucket[image_ids]
+        # Renumber the images of the bucket from zero
+        bucket_image_ids = torch.cumsum(is_image_in_bucket.long(), dim=0) - 1
+        kept_parts.append(
+            _pose_nms_padded(
+                poses,
+                scores,
+                indices[is_pose_in_bucket],
+                bucket_image_ids[image_ids[is_pose_in_bucket]],
+                int(torch.sum(is_image_in_bucket)),
+                int(2**bucket),
+                overlap_threshold,
+            )
+        )
+    # Group the results by image again, the sort is stable so the score order is kept
+    kept = torch.cat(kept_parts)
+    kept_image_ids = torch.zeros(poses.shape[0], dtype=torch.int64, device=device)
+    kept_image_ids[indices] = image_ids
+    order = torch.sort(kept_image_ids[kept], stable=True)[1]
+    return kept[order]
+
+
+def _pose_nms_padded(
+    poses: torch.Tensor,
+    scores: torch.Tensor,
+    indices: torch.Tensor,
+    image_ids: torch.Tensor,
+    n_images: int,
+    n_slots: int,
+    overlap_threshold: float,
+):
+    # NMS of the poses poses[indices] of n_images images, each with at most n_slots poses.
+    # Lay out the poses in a padded [n_images, n_slots] layout, sorted by decreasing score
+    device = poses.device
+    slots = segment_slots(image_ids, n_images)
+    padded_scores = torch.full(
+        (n_images, n_slots), -float('inf'), dtype=scores.dtype, device=device
+    )
+    padded_scores[image_ids, slots] = scores[indices]
+    padded_indices = torch.full((n_images, n_slots), -1, dtype=torch.int64, device=device)
+    padded_indices[image_ids, slots] = indices
+
+    order = torch.argsort(padded_scores, dim=1, descending=True)
+    sorted_indices = torch.gather(padded_indices, 1, order)
+    sorted_valid = sorted_indices >= 0
+    # Padding slots take the first pose of the batch, they are masked out as invalid anyway
+    sorted_poses = poses[torch.clamp(sorted_indices, min=0)]
+
+    similarity = compute_pose_similarity(sorted_poses)
+    keep = greedy_suppression(similarity > overlap_threshold, sorted_valid)
+    return sorted_indices[keep]
+
+
+def segment_slots(segment_ids: torch.Tensor, n_segments: int):
+    """The position of each item among the items with the same segment id, in order."""
+    counts = torch.bincount(segment_ids, minlength=n_segments)
+    sorted_segment_ids, order = torch.sort(segment_ids, stable=True)
+    first_indices = torch.cumsum(counts, dim=0) - counts
+    slots = torch.empty_like(segment_ids)
+    slots[order] = (
+        torch.arange(segment_ids.shape[0], device=segment_ids.device)
+        - first_indices[sorted_segment_ids]
     )
-    return plausible_indices_single_frame[nms_indices]
+    return slots
 
 
 def are_augmentation_results_consistent(stdevs):
@@ -23,16 +135,17 @@ def is_uncertainty_low(uncerts):
 
 
 def compute_pose_similarity(poses):
+    # poses has shape [..., N, J, 3], the result has shape [..., N, N]
     # Pairwise scale align the poses before comparing them
     square_scales = torch.mean(torch.square(poses), dim=(-2, -1), keepdim=True)
-    square_scales1 = torch.unsqueeze(square_scales, 0)
-    square_scales2 = torch.unsqueeze(square_scales, 1)
+    square_scales1 = torch.unsqueeze(square_scales, -4)
+    square_scales2 = torch.unsqueeze(square_scales, -3)
     mean_square_scales = (square_scales1 + square_scales2) / 2
     scale_factor1 = torch.sqrt(mean_square_scales / square_scales1)
     scale_factor2 = torch.sqrt(mean_square_scales / square_scales2)
 
-    poses1 = torch.unsqueeze(poses, 0)
-    poses2 = torch.unsqueeze(poses, 1)
+    poses1 = torch.unsqueeze(poses, -4)
+    poses2 = torch.unsqueeze(poses, -3)
 
     dists = torch.linalg.norm(scale_factor1 * poses1 - scale_factor2 * poses2, dim=-1)
     best_dists = torch.topk(dists, k=poses.shape[-2] // 5, sorted=False).values
@@ -77,14 +190,43 @@ def non_max_suppression_overlaps(
 ):
     n_items = overlaps.shape[0]
     if n_items == 0:
-        return torch.zeros(0, dtype=torch.int32, device=overlaps.device)
+        return torch.zeros(0, dtype=torch.int64, device=overlaps.device)
+
+    order = torch.argsort(scores, dim=0, descending=True)
+    sorted_overlaps = overlaps[order][:, order]
+    is_valid = torch.ones((1, n_items), dtype=torch.bool, device=overlaps.device)
+    keep = greedy_suppression((sorted_overlaps > overlap_threshold).unsqueeze(0), is_valid)
+    return order[keep[0]]
 
-    order = torch.argsort(scores, dim=0, descending=True)  # stable=True
-    keep = []
-    while order.shape[0] > 0:
-        i = order[0]
-        keep.append(i)
-        inds = torch.where(overlaps[i, order[1:]] <= overlap_threshold)[0]
-        order = order[inds + 1]
 
-    return torch.stack(keep)
+def greedy_suppression(suppresses: torch.Tensor, is_valid: torch.Tensor):
+    """Greedy non-maximum suppression with whole-matrix operations.
+
+    The items are assumed to be sorted by decreasing score. An item is kept if it is valid
+    and no kept item before it suppresses it. The kept set is the unique fixed point of this
+    rule, which is reached by iterating it from the set of all valid items.
+
+    The cost is not fixed. Each iteration is one [B, N, N] reduction plus a host
+    synchronization to check convergence. The number of iterations is one more than the
+    longest chain of items that each suppress the next one. For poses this is usually 2 or 3,
+    but it can reach N, since after t iterations only the first t items are sure to be final.
+    The sequential NMS instead synchronizes once per kept item.
+
+    Args:
+        suppresses: whether item i would suppress item j, shape [B, N, N]
+        is_valid: which items take part at all, shape [B, N]
+
+    Returns:
+        The boolean mask of the kept items, shape [B, N].
+    """
+    n_items = suppresses.shape[-1]
+    earlier = torch.ones((n_items, n_items), dtype=torch.bool, device=suppresses.device)
+    earlier = earlier.triu_(diagonal=1)
+    suppresses = suppresses & earlier & is_valid.unsqueeze(-1)
+    keep = is_valid
+    for _ in range(n_items):
+        new_keep = is_valid & ~torch.any(keep.unsqueeze(-1) & suppresses, dim=-2)
+        if torch.equal(new_keep, keep):
+            break
+        keep = new_keep
+    return keep
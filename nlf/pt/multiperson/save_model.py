@@ -9,7 +9,8 @@ import nlf.pt.init as init
 import nlf.pt.models.field as pt_field
 import nlf.pt.models.nlf_model as pt_nlf_model
 from nlf.paths import DATA_ROOT
-from nlf.pt.multiperson import multiperson_model, person_detector
+from nlf.pt import ptu
+from nlf.pt.multiperson import multiperson_model, person_detector, weights_cache
 import simplepyutils.argparse as spu_argparse
 import florch.layers.lora
 
@@ -19,12 +20,44 @@ def main():
     parser.add_argument('--input-model-path', type=str)
     parser.add_argument('--output-model-path', type=str)
     parser.add_argument('--pad-white-pixels', action=spu_argparse.BoolAction)
+    parser.add_argument('--roi-pyramid', action=spu_argparse.BoolAction)
+    # Detect on the gamma-encoded frame, which changes the detections and crops slightly
+    parser.add_argument('--detect-on-gamma-frames', action=spu_argparse.BoolAction)
+    parser.add_argument('--num-nms-points', type=int, default=64)
+    parser.add_argument(
+        '--geometry-precision', type=str, default='float64', choices=('float64', 'float32')
+    )
+    parser.add_argument('--device', type=str, default='cuda')
+    # By default float16 on GPU and float32 on CPU, see ptu.default_compute_dtype
+    parser.add_argument(
+        '--compute-dtype', type=str, default=None, choices=('float16', 'bfloat16', 'float32')
+    )
+    # Limits the memory of the heatmaps when decoding many points, 0 means no limit
+    parser.add_argument('--decode-memory-budget-mb', type=int, default=0)
+    parser.add_argument(
+        '--flip-strategy', type=str, default='auto', choices=('auto', 'partition', 'select')
+    )
+    # The largest number of crop-points for which 'auto' uses 'select', 0 means no limit. See
+    # benchmarks/flip_strategy.py for measuring it on the target hardware.
+    parser.add_argument('--flip-select-max-items', type=int, default=0)
+    # Tunes the weight application of the localizer head for these skeletons and numbers of
+    # crops per batch on this device, and stores the choices in the saved model. They are used
+    # on the same kind of device, which the inference scripts set with
+    # weight_application.set_device_name after loading.
+    parser.add_argument('--autotune-skeletons', type=str, nargs='*', default=())
+    parser.add_argument('--autotune-crop-counts', type=int, nargs='*', default=(64,))
+    parser.add_argument('--precompute-weights', action=spu_argparse.BoolAction)
+    parser.add_argument('--precompute-skeletons', type=str, nargs='*', default=())
+    parser.add_argument('--weights-cache-dir', type=str)
     init.initialize(parent_parser=parser)
+    compute_dtype = FLAGS.compute_dtype or ptu.default_compute_dtype(FLAGS.device)
 
     backbone, normalizer, out_channels = backbone_builder.build_backbone()
     weight_field = pt_field.build_field()
-    model_pytorch = pt_nlf_model.NLFModel(backbone, weight_field, normalizer, out_channels)
-    state_dict = torch.load(FLAGS.input_model_path, weights_only=False)
+    model_pytorch = pt_nlf_model.NLFModel(
+        backbone, weight_field, normalizer, out_channels, compute_dtype=compute_dtype
+    )
+    state_dict = torch.load(FLAGS.input_model_path, map_location='cpu', weights_only=False)
     if 'model_state_dict' in state_dict:
         state_dict = state_dict['model_state_dict']
     missing, unexpected = model_pytorch.load_state_dict(state_dict, strict=False)
@@ -34,19 +67,70 @@ def main():
     if FLAGS.lora_rank > 0:
         florch.layers.lora.remove_lora(model_pytorch.backbone, merge=True)
 
-    model_pytorch = model_pytorch.cuda().eval()
-    model_pytorch.backbone.half()
-    model_pytorch.heatmap_head.layer.half()
+    model_pytorch = model_pytorch.to(FLAGS.device).eval()
+    model_pytorch.backbone.to(ptu.dtype_from_name(compute_dtype))
+    model_pytorch.heatmap_head.layer.to(ptu.dtype_from_name(compute_dtype))
+    model_pytorch.heatmap_head.decode_memory_budget_mb = FLAGS.decode_memory_budget_mb
+    model_pytorch.heatmap_head.flip_strategy = FLAGS.flip_strategy
+    model_pytorch.heatmap_head.flip_select_max_items = FLAGS.flip_select_max_items
 
-    detector = person_detector.PersonDetector(f'{DATA_ROOT}/yolov8x.torchscript')
+    detector = person_detector.PersonDetector(
+        f'{DATA_ROOT}/yolov8x.torchscript', compute_dtype=compute_dtype
+    )
 
     skeleton_infos = spu.load_pickle(f"{DATA_ROOT}/skeleton_conversion/skeleton_types_huge8.pkl")
     multimodel = multiperson_model.MultipersonNLF(
-        model_pytorch, detector, skeleton_infos, pad_white_pixels=FLAGS.pad_white_pixels
+        model_pytorch,
+        detector,
+        skeleton_infos,
+        pad_white_pixels=FLAGS.pad_white_pixels,
+        roi_pyramid=FLAGS.roi_pyramid,
+        detect_on_gamma_frames=FLAGS.detect_on_gamma_frames,
+        num_nms_points=FLAGS.num_nms_points,
+        geometry_precision=FLAGS.geometry_precision,
     )
-    multimodel = torch.jit.script(multimodel.cuda().eval())
+    multimodel = multimodel.to(FLAGS.device).eval()
+    if FLAGS.autotune_skeletons:
+        autotune_weight_application(
+            multimodel, FLAGS.autotune_skeletons, FLAGS.autotune_crop_counts, compute_dtype
+        )
+    if FLAGS.precompute_weights:
+        # Store the weights in the saved model, so they need not be computed on first use
+        cache = (
+            weights_cache.WeightsCache(FLAGS.input_model_path, FLAGS.weights_cache_dir)
+            if FLAGS.weights_cache_dir
+            else None
+        )
+        multimodel.precompute_weights(skeletons=list(FLAGS.precompute_skeletons), cache=cache)
+    multimodel = torch.jit.script(multimodel)
     torch.jit.save(multimodel, FLAGS.output_model_path)
 
 
+def autotune_weight_application(multimodel, skeletons, crop_counts, compute_dtype):
+    # Runs the crop model on random crops, the shapes are what matters for the tuning
+    crop_model = multimodel.crop_model
+    crop_model.heatmap_head.autotune_weight_application = True
+    res = crop_model.input_resolution
+    device = FLAGS.device
+    intrinsic_matrix = torch.tensor(
+        [[res, 0, res / 2], [0, res, res / 2], [0, 0, 1]], dtype=torch.float32, device=device
+    )
+    with torch.no_grad():
+        for skeleton in skeletons:
+            weights = crop_model.get_weights_for_canonical_points(
+                multimodel._get_skeleton_canonical_points(skeleton)
+            )
+            for n_crops in crop_counts:
+                crops = torch.rand(
+                    n_crops, 3, res, res, device=device, dtype=ptu.dtype_from_name(compute_dtype)
+                )
+                # As in test-time augmentation, where every other crop is flipped
+                flip = torch.arange(n_crops, device=device) % 2 == 1
+                crop_model.predict_multi_same_weights(
+                    crops, intrinsic_matrix.repeat(n_crops, 1, 1), weights, flip
+                )
+    crop_model.heatmap_head.autotune_weight_application = False
+
+
 if __name__ == '__main__':
     main()
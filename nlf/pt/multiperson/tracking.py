@@ -0,0 +1,293 @@
+import torch
+import torchvision.ops
+
+# Arguments that the detect_* and estimate_* APIs have in common
+SHARED_KWARGS = (
+    'default_fov_degrees',
+    'internal_batch_size',
+    'antialias_factor',
+    'num_aug',
+    'rot_aug_max_degrees',
+    'beta_regularizer',
+    'beta_regularizer2',
+    'adaptive_aug',
+    'adaptive_aug_max_uncertainty',
+    'requested_keys',
+)
+
+# Outputs of the parametric API that the tracker itself needs
+TRACKING_KEYS = ('joints2d', 'joint_uncertainties', 'pose', 'betas')
+
+
+class KeyframeTracker:
+    """Streaming pose estimation for video that runs the person detector only on keyframes.
+
+    On the other frames, each person's box is derived from the 2D pose predicted in the
+    previous frame, and the poses are predicted with the estimate_* API of the model, which
+    skips the detector. A frame becomes a keyframe every keyframe_interval frames, and also
+    whenever the tracking becomes unreliable: when there are no tracked people, when a
+    prediction has high uncertainty or when a person mostly leaves the image. At keyframes, the
+    new detections are matched to the existing tracks by IoU, so that track ids persist.
+
+    People entering the scene are only picked up at the next keyframe.
+
+    With the parametric API, the body model fit of each track is also carried over: on the
+    frames between keyframes, the fitting starts from the track's previous pose, with
+    warm_start_num_iter iterations instead of the full fit. Once a track has been fitted on
+    freeze_shape_after frames, its shape is fixed to the mean of those fits, and only the pose
+    and translation are fitted from then on. This skips the shape solve, but the body model
+    still applies the shape to the template on every fit.
+
+    Example:
+        tracker = KeyframeTracker(model, skeleton='smpl_24')
+        for frame in frames:  # each frame is a [3, H, W] tensor
+            pred = tracker(frame, intrinsic_matrix=intrinsics)
+            ... pred['poses3d'], pred['track_ids'] ...
+
+    Args:
+        model: a (scripted) MultipersonNLF
+        weights: field weights for the non-parametric API, see MultipersonNLF.detect_poses
+        skeleton: skeleton name for the non-parametric API, used if weights is not given
+        model_name: if given, the parametric API is used with this body model (e.g. 'smpl')
+        keyframe_interval: the detector runs at least once every this many frames
+        box_margin: the box around the previous 2D pose is enlarged by this fraction of its
+            size on each side, to match the looser boxes of the detector
+        max_uncertainty: a person whose mean predicted uncertainty (in meters) is above this
+            value makes the next frame a keyframe
+        min_visible_fraction: a person whose propagated box has less than this fraction of
+            its area inside the image makes the next frame a keyframe
+        match_iou_threshold: minimum IoU between a detection and a track for them to be matched
+        detect_kwargs: extra keyword arguments for the detect_* call
+        estimate_kwargs: extra keyword arguments for the estimate_* call
+        warm_start_num_iter: number of body model fitting iterations on frames between
+            keyframes, starting from the previous fit of the track. None disables warm-starting.
+        freeze_shape_after: number of frames after which the shape of a track is fixed. None
+            means the shape is fitted on every frame.
+    """
+
+    def __init__(
+        self,
+        model,
+        weights=None,
+        skeleton=None,
+        model_name=None,
+        keyframe_interval=8,
+        box_margin=0.1,
+        max_uncertainty=0.3,
+        min_visible_fraction=0.5,
+        match_iou_threshold=0.3,
+        detect_kwargs=None,
+        estimate_kwargs=None,
+        warm_start_num_iter=1,
+        freeze_shape_after=None,
+    ):
+        self.model = model
+        self.model_name = model_name
+        self.keyframe_interval = keyframe_interval
+        self.box_margin = box_margin
+        self.max_uncertainty = max_uncertainty
+        self.min_visible_fraction = min_visible_fraction
+        self.match_iou_threshold = match_iou_threshold
+        self.warm_start_num_iter = warm_start_num_iter
+        self.freeze_shape_after = freeze_shape_after
+        self.detect_kwargs = dict(detect_kwargs or {})
+        self.estimate_kwargs = dict(estimate_kwargs or {})
+        # Unless specified otherwise, keyframes and propagated frames use the same settings
+        for key in SHARED_KWARGS:
+            if key in self.detect_kwargs:
+                self.estimate_kwargs.setdefault(key, self.detect_kwargs[key])
+
+        if model_name is not None:
+            for kwargs in (self.detect_kwargs, self.estimate_kwargs):
+                kwargs['model_name'] = model_name
+                if kwargs.get('requested_keys') is not None:
+                    kwargs['requested_keys'] = list(
+                        dict.fromkeys([*kwargs['requested_keys'], *TRACKING_KEYS])
+                    )
+        else:
+            if weights is None and skeleton is None:
+                raise ValueError('Either weights, skeleton or model_name must be given')
+            for kwargs in (self.detect_kwargs, self.estimate_kwargs):
+                kwargs['weights'] = weights
+                kwargs['skeleton'] = skeleton
+        self.reset()
+
+    def reset(self):
+        """Forgets all tracks, for starting a new video."""
+        self.boxes = None  # Boxes propagated to the next frame, [N, 5] (x, y, w, h, score)
+        self.track_ids = None
+        self.next_track_id = 0
+        self.frames_since_keyframe = 0
+        self.force_keyframe = True
+        # Per track id: the last fitted pose and betas, and the sum and count of the betas over
+        # the frames so far, for the parametric API
+        self.fit_states = {}
+
+    def __call__(self, frame, **camera_kwargs):
+        """Predicts the poses for the next frame of the video.
+
+        Args:
+            frame: the image, shape [3, H, W]
+            **camera_kwargs: intrinsic_matrix, distortion_coeffs, extrinsic_matrix and
+                world_up_vector as in the batched model APIs (with a batch dimension of 1)
+
+        Returns:
+            The prediction dict of the model for this frame (without the batch dimension),
+            with an additional 'track_ids' entry and a bool 'is_keyframe' entry.
+        """
+        images = frame.unsqueeze(0)
+        is_keyframe = (
+            self.force_keyframe
+            or self.boxes is None
+            or len(self.boxes) == 0
+            or self.frames_since_keyframe >= self.keyframe_interval
+        )
+
+        if is_keyframe:
+            pred = self._detect(images, camera_kwargs)
+            boxes = pred['boxes']
+            self.track_ids = self._match_tracks(boxes)
+            self.frames_since_keyframe = 0
+        else:
+            pred = self._estimate(images, self.boxes, camera_kwargs)
+            pred['boxes'] = self.boxes
+            self.frames_since_keyframe += 1
+
+        pred['track_ids'] = self.track_ids
+        pred['is_keyframe'] = is_keyframe
+        self._update_tracks(pred, frame.shape[1], frame.shape[2])
+        if self.model_name is not None:
+            self._update_fit_states(pred)
+        return pred
+
+    def _detect(self, images, camera_kwargs):
+        if self.model_name is not None:
+            pred = self.model.detect_parametric_batched(
+                images, **camera_kwargs, **self.detect_kwargs
+            )
+        else:
+            pred = self.model.detect_poses_batched(images, **camera_kwargs, **self.detect_kwargs)
+        return {k: v[0] for k, v in pred.items()}
+
+    def _estimate(self, images, boxes, camera_kwargs):
+        if self.model_name is not None:
+            kwargs = dict(self.estimate_kwargs, **self._fit_kwargs())
+            pred = self.model.estimate_parametric_batched(
+                images, [boxes], **camera_kwargs, **kwargs
+            )
+        else:
+            pred = self.model.estimate_poses_batched(
+                images, [boxes[:, :4]], **camera_kwargs, **self.estimate_kwargs
+            )
+        return {k: v[0] for k, v in pred.items()}
+
+    def _fit_kwargs(self):
+        # The boxes of the frames between keyframes are in the order of self.track_ids, so the
+        # previous fits can be passed per box
+        if self.warm_start_num_iter is None and self.freeze_shape_after is None:
+            return {}
+
+        states = [self.fit_states[track_id] for track_id in self.track_ids.tolist()]
+        kwargs = {}
+        if self.warm_start_num_iter is not None:
+            kwargs['fit_num_iter'] = self.warm_start_num_iter
+            kwargs['initial_pose'] = [torch.stack([s['pose'] for s in states])]
+        if self.freeze_shape_after is not None:
+            kwargs['known_betas'] = [
+                torch.stack(
+                    [
+                        (
+                            s['betas_sum'] / s['n_frames']
+                            if s['n_frames'] >= self.freeze_shape_after
+                            else torch.full_like(s['betas'], torch.nan)
+                        )
+                        for s in states
+                    ]
+                )
+            ]
+        return kwargs
+
+    def _update_fit_states(self, pred):
+        new_states = {}
+        for i, track_id in enumerate(self.track_ids.tolist()):
+            pose = pred['pose'][i]
+            betas = pred['betas'][i]
+            state = self.fit_states.get(track_id)
+            if state is None:
+                state = dict(betas_sum=torch.zeros_like(betas), n_frames=0)
+            # Once the shape is frozen, the mean is not updated anymore
+            if self.freeze_shape_after is None or state['n_frames'] < self.freeze_shape_after:
+                state['betas_sum'] = state['betas_sum'] + betas
+                state['n_frames'] += 1
+            state['pose'] = pose
+            state['betas'] = betas
+            new_states[track_id] = state
+        # Tracks that were not matched at a keyframe are forgotten
+        self.fit_states = new_states
+
+    def _match_tracks(self, boxes):
+        # Greedily match the detections to the existing tracks in decreasing order of IoU
+        n_boxes = len(boxes)
+        track_ids = torch.full((n_boxes,), -1, dtype=torch.int64)
+        if self.boxes is not None and len(self.boxes) > 0 and n_boxes > 0:
+            ious = torchvision.ops.box_iou(
+                xywh_to_xyxy(boxes[:, :4].float()), xywh_to_xyxy(self.boxes[:, :4].float())
+            ).cpu()
+            order = torch.argsort(ious.flatten(), descending=True)
+            is_box_free = torch.ones(n_boxes, dtype=torch.bool)
+            is_track_free = torch.ones(len(self.boxes), dtype=torch.bool)
+            for flat_index in order.tolist():
+                i_box, i_track = divmod(flat_index, len(self.boxes))
+                if ious[i_box, i_track] < self.match_iou_threshold:
+                    break
+                if is_box_free[i_box] and is_track_free[i_track]:
+                    track_ids[i_box] = self.track_ids[i_track]
+                    is_box_free[i_box] = False
+                    is_track_free[i_track] = False
+
+        is_new = track_ids == -1
+        n_new = int(is_new.sum())
+        track_ids[is_new] = torch.arange(self.next_track_id, self.next_track_id + n_new)
+        self.next_track_id += n_new
+        return track_ids
+
+    def _update_tracks(self, pred, im_height, im_width):
+        if self.model_name is not None:
+            points2d = pred['joints2d']
+            # The parametric API gives the uncertainties in millimeters
+            uncertainties = pred['joint_uncertainties'] / 1000
+        else:
+            points2d = pred['poses2d']
+            uncertainties = pred['uncertainties']
+
+        if len(points2d) == 0:
+            self.boxes = points2d.new_zeros((0, 5))
+            self.force_keyframe = True
+            return
+
+        # The box around the 2D pose, with a margin
+        start = torch.min(points2d, dim=-2).values
+        end = torch.max(points2d, dim=-2).values
+        margin = (end - start) * self.box_margin
+        start = start - margin
+        end = end + margin
+        scores = pred['boxes'][:, 4:5].to(start.dtype)
+        self.boxes = torch.cat([start, end - start, scores], dim=-1)
+
+        # Check whether the tracking is still reliable
+        image_end = torch.tensor([im_width, im_height], dtype=start.dtype, device=start.device)
+        visible_size = torch.clamp(
+            torch.minimum(end, image_end) - torch.clamp(start, min=0), min=0
+        )
+        visible_fraction = torch.prod(visible_size, dim=-1) / torch.clamp(
+            torch.prod(end - start, dim=-1), min=1e-6
+        )
+        is_lost = torch.logical_or(
+            torch.mean(uncertainties, dim=-1) > self.max_uncertainty,
+            visible_fraction < self.min_visible_fraction,
+        )
+        self.force_keyframe = bool(torch.any(is_lost))
+
+
+def xywh_to_xyxy(boxes):
+    return torch.cat([boxes[..., :2], boxes[..., :2] + boxes[..., 2:4]], dim=-1)
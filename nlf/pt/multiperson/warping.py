@@ -1,4 +1,4 @@
-from typing import List, Tuple, Optional
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 import torch
 import torch.nn.functional as F
@@ -6,6 +6,244 @@ import torch.nn.functional as F
 from nlf.pt import ptu3d
 
 
+# The images that crops are taken from, prepared once and reused for all crops.
+# image_levels holds the pyramid, from full resolution to the coarsest level, each [B, C, H, W].
+# intrinsic_matrix_levels holds the intrinsics of each level for each image, [L, B, 3, 3].
+class CropSource(NamedTuple):
+    image_levels: List[torch.Tensor]
+    intrinsic_matrix_levels: torch.Tensor
+
+
+def build_crop_source(
+    images: torch.Tensor,
+    intrinsic_matrix: torch.Tensor,
+    n_pyramid_levels: int = 3,
+    invert: bool = False,
+) -> CropSource:
+    """Prepares the images for cropping with warp_crops.
+
+    Args:
+        images: the full images, shape [B, C, H, W]
+        intrinsic_matrix: intrinsics for each image, shape [B, 3, 3]
+        n_pyramid_levels: number of resolution levels to create, each half the previous one
+        invert: whether to replace the images with 1 - images (in-place), so that the zero
+            padding of grid_sample corresponds to white pixels after inverting the crops back
+    """
+    if invert:
+        # x.neg_().add_(1) is equivalent to 1 - x, but it's done in-place
+        images = images.neg_().add_(1)
+
+    # Create a very simple pyramid with lower resolution images for simple antialiasing.
+    image_levels = [images]
+    for _ in range(1, n_pyramid_levels):
+        # We use simple averaging (box filter) to create the pyramid, for efficiency
+        image_levels.append(F.avg_pool2d(image_levels[-1], 2, 2))
+
+    intrinsic_matrix_levels = torch.stack(
+        [
+            corner_aligned_scale_mat(1 / 2**i_level, device=intrinsic_matrix.device)
+            @ intrinsic_matrix
+            for i_level in range(n_pyramid_levels)
+        ]
+    )
+    return CropSource(image_levels, intrinsic_matrix_levels)
+
+
+def build_roi_crop_source(
+    images: torch.Tensor,
+    intrinsic_matrix: torch.Tensor,
+    footprints: torch.Tensor,
+    image_ids: torch.Tensor,
+    n_pyramid_levels: int = 3,
+    invert: bool = False,
+    max_area_fraction: float = 0.5,
+) -> CropSource:
+    """Like build_crop_source, but the pyramid only covers a region of interest of each image.
+
+    The region is the union of the footprints of the crops of the image, enlarged by the support
+    of bilinear sampling at the coarsest level. All images get a region of the same size, with
+    offsets aligned to the coarsest level so that every level is an exact sub-window of the
+    corresponding full-frame level. Pixels of the region that fall outside the frame are zero,
+    as they would be for grid_sample's zero padding. If the regions are not much smaller than
+    the frames, the full-frame build_crop_source is used instead.
+
+    Args:
+        images: the full images, shape [B, C, H, W]
+        intrinsic_matrix: intrinsics for each image, shape [B, 3, 3]
+        footprints: pixel bounding box (x_min, y_min, x_max, y_max) of each crop in its source
+            image, as returned by crop_footprints, shape [N, 4]
+        image_ids: the index of the source image for each crop, shape [N]
+        n_pyramid_levels: number of resolution levels to create, each half the previous one
+        invert: whether the pyramid should hold 1 - images (the input is not modified here)
+        max_area_fraction: the region is only used if its area is at most this fraction of
+            the frame area
+    """
+    n_images = images.shape[0]
+    height = images.shape[2]
+    width = images.shape[3]
+    device = images.device
+    if footprints.shape[0] == 0:
+        return build_crop_source(images, intrinsic_matrix, n_pyramid_levels, invert)
+
+    # Union of the footprints per image. Images without crops get an empty region.
+    image_ids = image_ids.to(footprints.device).long()
+    mins = torch.tensor([float(width), float(height)], device=footprints.device).repeat(
+        n_images, 1
+    )
+    maxs = torch.zeros((n_images, 2), device=footprints.device)
+    index = image_ids.unsqueeze(1).expand(-1, 2)
+    mins = mins.scatter_reduce(0, index, footprints[:, :2].float(), 'amin', include_self=False)
+    maxs = maxs.scatter_reduce(0, index, footprints[:, 2:].float(), 'amax', include_self=False)
+
+    # Bilinear sampling at level l reads up to 2 level pixels beyond the sampled point,
+    # each covering 2**l full-resolution pixels.
+    align = 2 ** (n_pyramid_levels - 1)
+    pad = float(2 * align + 2)
+    frame_size = torch.tensor([float(width), float(height)], device=footprints.device)
+    mins = torch.minimum(torch.clamp(torch.floor(mins - pad), min=0.0), frame_size)
+    maxs = torch.minimum(torch.clamp(torch.ceil(maxs + pad), min=0.0), frame_size)
+    offsets = torch.floor(mins / align) * align
+    roi_size = torch.ceil(torch.amax(maxs - offsets, dim=0) / align) * align
+    roi_size_list = torch.jit.annotate(List[float], roi_size.tolist())
+    roi_width = max(int(roi_size_list[0]), align)
+    roi_height = max(int(roi_size_list[1]), align)
+    if roi_width * roi_height > max_area_fraction * width * height:
+        return build_crop_source(images, intrinsic_matrix, n_pyramid_levels, invert)
+
+    offsets_list = torch.jit.annotate(List[List[int]], offsets.long().tolist())
+    roi = torch.zeros(
+        (n_images, images.shape[1], roi_height, roi_width), dtype=images.dtype, device=device
+    )
+    for i_image in range(n_images):
+        x0 = offsets_list[i_image][0]
+        y0 = offsets_list[i_image][1]
+        w = min(roi_width, width - x0)
+        h = min(roi_height, height - y0)
+        if w <= 0 or h <= 0:
+            continue
+        dst = roi[i_image, :, :h, :w]
+        dst.copy_(images[i_image, :, y0 : y0 + h, x0 : x0 + w])
+        if invert:
+            dst.neg_().add_(1)
+
+    # The full-frame pyramid drops the last row/column of a level when its size is odd.
+    # The same pixels are zeroed here, so that the regions match the full-frame levels exactly.
+    offsets = offsets.to(device)
+    image_levels = [roi]
+    for i_level in range(1, n_pyramid_levels):
+        level = F.avg_pool2d(image_levels[-1], 2, 2)
+        scale = 2**i_level
+        level_offsets = torch.div(offsets, scale, rounding_mode='floor').long()
+        limit_x = (width // scale) - level_offsets[:, 0]
+        limit_y = (height // scale) - level_offsets[:, 1]
+        cols = torch.arange(level.shape[3], device=device)
+        rows = torch.arange(level.shape[2], device=device)
+        outside = torch.logical_or(
+            cols.view(1, 1, 1, -1) >= limit_x.view(-1, 1, 1, 1),
+            rows.view(1, 1, -1, 1) >= limit_y.view(-1, 1, 1, 1),
+        )
+        image_levels.append(level.masked_fill_(outside, 0.0))
+
+    # Moving the origin to the top left of the region only shifts the principal point
+    roi_intrinsic_matrix = intrinsic_matrix.clone()
+    roi_intrinsic_matrix[:, :2, 2].sub_(offsets.to(intrinsic_matrix.dtype))
+    intrinsic_matrix_levels = torch.stack(
+        [
+            corner_aligned_scale_mat(1 / 2**i_level, device=intrinsic_matrix.device)
+            @ roi_intrinsic_matrix
+            for i_level in range(n_pyramid_levels)
+        ]
+    )
+    return CropSource(image_levels, intrinsic_matrix_levels)
+
+
+def crop_footprints(
+    intrinsic_matrix: torch.Tensor,
+    new_invprojmats: torch.Tensor,
+    distortion_coeffs: torch.Tensor,
+    output_shape: Tuple[int, int],
+    n_points_per_side: int = 9,
+):
+    """Computes the pixel bounding box of each crop in its source image.
+
+    Points along the border of each crop are mapped through the same geometry as in
+    make_sampling_grids (including the lens distortion), so the box covers all sampled pixels
+    as long as the crop border maps to the outline of its footprint.
+
+    Args:
+        intrinsic_matrix: intrinsics of the source image for each crop, shape [N, 3, 3]
+        new_invprojmats: inverse projection matrices of the crops, shape [N, 3, 3]
+        distortion_coeffs: lens distortion of the source image for each crop, shape [N, D]
+        output_shape: (height, width) of the crops
+        n_points_per_side: number of points sampled along each side of the crop border
+
+    Returns:
+        The boxes as (x_min, y_min, x_max, y_max), shape [N, 4].
+    """
+    device = new_invprojmats.device
+    h = float(output_shape[0] - 1)
+    w = float(output_shape[1] - 1)
+    t = torch.linspace(0.0, 1.0, n_points_per_side, device=device)
+    zeros = torch.zeros_like(t)
+    ones = torch.ones_like(t)
+    border = torch.cat(
+        [
+            torch.stack([t * w, zeros], dim=1),
+            torch.stack([t * w, ones * h], dim=1),
+            torch.stack([zeros, t * h], dim=1),
+            torch.stack([ones * w, t * h], dim=1),
+        ],
+        dim=0,
+    )
+    old_coords_homog = torch.matmul(ptu3d.to_homogeneous(border), new_invprojmats.float().mT)
+    undist_coords = old_coords_homog[..., :2] / old_coords_homog[..., 2:]
+    dist_coords = distort_points_batched(undist_coords, distortion_coeffs)
+    intrinsic_matrix = intrinsic_matrix.float()
+    pixel_coords = dist_coords @ intrinsic_matrix[:, :2, :2].mT + intrinsic_matrix[
+        :, :2, 2
+    ].unsqueeze(1)
+    return torch.cat([torch.amin(pixel_coords, dim=1), torch.amax(pixel_coords, dim=1)], dim=1)
+
+
+def warp_crops(
+    crop_source: CropSource,
+    new_invprojmats: torch.Tensor,
+    distortion_coeffs: torch.Tensor,
+    crop_scales: torch.Tensor,
+    output_shape: Tuple[int, int],
+    image_ids: torch.Tensor,
+    grid_cache: Optional[Dict[str, torch.Tensor]] = None,
+):
+    """Warps crops out of the images of a CropSource, picking the pyramid level per crop.
+
+    Args:
+        crop_source: the prepared images, see build_crop_source
+        new_invprojmats: inverse projection matrices of the crops, shape [N, 3, 3]
+        distortion_coeffs: lens distortion of the source image for each crop, shape [N, D]
+        crop_scales: zoom factor of each crop relative to the full resolution image, shape [N]
+        output_shape: (height, width) of the crops
+        image_ids: the index of the source image for each crop, shape [N]
+        grid_cache: optional cache for the pixel lattice, see grid_template
+
+    Returns:
+        The crops, shape [N, C, height, width].
+    """
+    n_pyramid_levels = len(crop_source.image_levels)
+    i_pyramid_levels = choose_pyramid_levels(crop_scales, n_pyramid_levels)
+    image_ids = image_ids.to(crop_source.intrinsic_matrix_levels.device).long()
+    intrinsic_matrix_per_crop = crop_source.intrinsic_matrix_levels[i_pyramid_levels, image_ids]
+    return warp_from_pyramid(
+        crop_source.image_levels,
+        i_pyramid_levels,
+        intrinsic_matrix_per_crop,
+        new_invprojmats,
+        distortion_coeffs,
+        output_shape,
+        image_ids,
+        grid_cache,
+    )
+
+
 def warp_images_with_pyramid(
     images: torch.Tensor,
     intrinsic_matrix: torch.Tensor,
@@ -15,34 +253,79 @@ def warp_images_with_pyramid(
     output_shape: Tuple[int, int],
     image_ids: torch.Tensor,
     n_pyramid_levels: int = 3,
+    grid_cache: Optional[Dict[str, torch.Tensor]] = None,
 ):
-    # Create a very simple pyramid with lower resolution images for simple antialiasing.
-    image_levels = [images]
-    for _ in range(1, n_pyramid_levels):
-        # We use simple averaging (box filter) to create the pyramid, for efficiency
-        image_levels.append(F.avg_pool2d(image_levels[-1], 2, 2))
+    # Here the intrinsics are given per crop, not per image
+    crop_source = build_crop_source(images, intrinsic_matrix, n_pyramid_levels)
+    i_pyramid_levels = choose_pyramid_levels(crop_scales, n_pyramid_levels)
+    crop_indices = torch.arange(image_ids.shape[0], device=i_pyramid_levels.device)
+    intrinsic_matrix_per_crop = crop_source.intrinsic_matrix_levels[i_pyramid_levels, crop_indices]
+    return warp_from_pyramid(
+        crop_source.image_levels,
+        i_pyramid_levels,
+        intrinsic_matrix_per_crop,
+        new_invprojmats,
+        distortion_coeffs,
+        output_shape,
+        image_ids,
+        grid_cache,
+    )
 
-    intrinsic_matrix_levels = [
-        corner_aligned_scale_mat(1 / 2**i_level, device=intrinsic_matrix.device) @ intrinsic_matrix
-        for i_level in range(n_pyramid_levels)
-    ]
 
+def choose_pyramid_levels(crop_scales: torch.Tensor, n_pyramid_levels: int):
     # Decide which pyramid level is most appropriate for each crop
     i_pyramid_levels = torch.floor(-torch.log2(crop_scales))
-    i_pyramid_levels = torch.clip(i_pyramid_levels, 0, n_pyramid_levels - 1).int()
+    return torch.clip(i_pyramid_levels, 0, n_pyramid_levels - 1).long()
 
-    return torch.stack(
-        [
-            warp_single_image(
-                image_levels[i_pyramid_levels[i]][image_ids[i]],
-                intrinsic_matrix_levels[i_pyramid_levels[i]][i],
-                new_invprojmats[i],
-                distortion_coeffs[i],
-                output_shape,
-            )
-            for i in range(len(image_ids))
-        ]
+
+def warp_from_pyramid(
+    image_levels: List[torch.Tensor],
+    i_pyramid_levels: torch.Tensor,
+    intrinsic_matrix: torch.Tensor,
+    new_invprojmats: torch.Tensor,
+    distortion_coeffs: torch.Tensor,
+    output_shape: Tuple[int, int],
+    image_ids: torch.Tensor,
+    grid_cache: Optional[Dict[str, torch.Tensor]] = None,
+):
+    images = image_levels[0]
+    n_crops = image_ids.shape[0]
+    image_sizes = torch.tensor(
+        [[float(im.shape[3]), float(im.shape[2])] for im in image_levels],
+        dtype=torch.float32,
+        device=images.device,
+    )[i_pyramid_levels]
+
+    # One grid_sample call per pyramid level, covering all crops that use that level
+    image_ids = image_ids.to(images.device)
+    crops = torch.empty(
+        (n_crops, images.shape[1], output_shape[0], output_shape[1]),
+        dtype=images.dtype,
+        device=images.device,
     )
+    # The grids of each level are written into the same preallocated buffer
+    grid_buffer = torch.empty(
+        (n_crops, output_shape[0], output_shape[1], 2), dtype=torch.float32, device=images.device
+    )
+    for i_level in range(len(image_levels)):
+        crop_indices_level = torch.nonzero(i_pyramid_levels == i_level).squeeze(1)
+        n_crops_level = crop_indices_level.shape[0]
+        if n_crops_level == 0:
+            continue
+
+        grids = make_sampling_grids(
+            intrinsic_matrix[crop_indices_level],
+            new_invprojmats[crop_indices_level],
+            distortion_coeffs[crop_indices_level],
+            image_sizes[crop_indices_level],
+            output_shape,
+            grid_cache=grid_cache,
+            out=grid_buffer[:n_crops_level],
+        )
+        crops[crop_indices_level] = sample_crops(
+            image_levels[i_level], grids, image_ids[crop_indices_level]
+        )
+    return crops
 
 
 def warp_images(
@@ -53,19 +336,20 @@ def warp_images(
     crop_scales: torch.Tensor,
     output_shape: Tuple[int, int],
     image_ids: torch.Tensor,
+    grid_cache: Optional[Dict[str, torch.Tensor]] = None,
 ):
-    return torch.stack(
-        [
-            warp_single_image(
-                images[image_ids[i]],
-                intrinsic_matrix[i],
-                new_invprojmats[i],
-                distortion_coeffs[i],
-                output_shape,
-            )
-            for i in range(len(image_ids))
-        ]
+    image_sizes = torch.tensor(
+        [float(images.shape[3]), float(images.shape[2])], dtype=torch.float32, device=images.device
+    ).expand(image_ids.shape[0], 2)
+    grids = make_sampling_grids(
+        intrinsic_matrix,
+        new_invprojmats,
+        distortion_coeffs,
+        image_sizes,
+        output_shape,
+        grid_cache=grid_cache,
     )
+    return sample_crops(images, grids, image_ids.to(images.device))
 
 
 def warp_single_image(
@@ -74,31 +358,187 @@ def warp_single_image(
     new_invprojmat: torch.Tensor,
     distortion_coeffs: torch.Tensor,
     output_shape: Tuple[int, int],
+    grid_cache: Optional[Dict[str, torch.Tensor]] = None,
 ):
-    device = image.device
-    new_coords = torch.stack(
+    # This goes through the same grid computation as the batched functions, so that warping
+    # crops one by one gives bitwise identical results to warping them all at once.
+    image_size = torch.tensor(
+        [[float(image.shape[2]), float(image.shape[1])]], dtype=torch.float32, device=image.device
+    )
+    grid = make_sampling_grids(
+        intrinsic_matrix.unsqueeze(0),
+        new_invprojmat.unsqueeze(0),
+        distortion_coeffs.unsqueeze(0),
+        image_size,
+        output_shape,
+        grid_cache=grid_cache,
+    )
+    return F.grid_sample(
+        image.unsqueeze(0),
+        grid.to(image.dtype),
+        align_corners=True,
+        mode='bilinear',
+        padding_mode='zeros',
+    ).squeeze(0)
+
+
+def make_sampling_grids(
+    intrinsic_matrix: torch.Tensor,
+    new_invprojmats: torch.Tensor,
+    distortion_coeffs: torch.Tensor,
+    image_sizes: torch.Tensor,
+    output_shape: Tuple[int, int],
+    grid_cache: Optional[Dict[str, torch.Tensor]] = None,
+    out: Optional[torch.Tensor] = None,
+):
+    """Computes the normalized grid_sample coordinates for a batch of crops.
+
+    The pixel lattice comes from grid_template and the result is written into `out` if it is
+    given. The homography, the lens distortion, the intrinsics and the normalization to
+    [-1, 1] are applied as separate steps, in the same order and precision as when warping a
+    single crop, so the coordinates are bitwise identical to the per-crop computation.
+
+    Args:
+        intrinsic_matrix: intrinsics of the source image for each crop, shape [N, 3, 3]
+        new_invprojmats: inverse projection matrices of the crops, shape [N, 3, 3]
+        distortion_coeffs: lens distortion of the source image for each crop, shape [N, D]
+        image_sizes: (width, height) of the source image for each crop, shape [N, 2]
+        output_shape: (height, width) of the crops
+        grid_cache: optional cache for the pixel lattice, see grid_template
+        out: optional float32 output buffer of shape [N, height, width, 2]
+
+    Returns:
+        The sampling grid, shape [N, height, width, 2], in the [-1, 1] convention of
+        F.grid_sample with align_corners=True.
+    """
+    device = new_invprojmats.device
+    n_crops = new_invprojmats.shape[0]
+    h = output_shape[0]
+    w = output_shape[1]
+    if out is None:
+        out = torch.empty((n_crops, h, w, 2), dtype=torch.float32, device=device)
+    out_flat = out.view(n_crops, h * w, 2)
+    template = grid_template(output_shape, device, torch.float32, grid_cache)
+
+    old_coords_homog = torch.matmul(template, new_invprojmats.float().mT)
+    old_coords_homog = ptu3d.to_homogeneous(
+        distort_points_batched(ptu3d.project(old_coords_homog), distortion_coeffs)
+    )
+    old_coords = torch.matmul(old_coords_homog, intrinsic_matrix.float().mT)[..., :2]
+    scales = 2.0 / (image_sizes.to(torch.float32) - 1)
+    torch.mul(old_coords, scales.unsqueeze(1), out=out_flat)
+    return out_flat.sub_(1.0).view(n_crops, h, w, 2)
+
+
+def grid_template(
+    output_shape: Tuple[int, int],
+    device: torch.device,
+    dtype: torch.dtype = torch.float32,
+    cache: Optional[Dict[str, torch.Tensor]] = None,
+):
+    """Returns the homogeneous pixel coordinates of an image with the given shape, as a
+    [height * width, 3] tensor, built only once per (shape, device, dtype) if a cache is given.
+    """
+    key = '{}x{}:{}:{}'.format(output_shape[0], output_shape[1], device, dtype)
+    if cache is not None and key in cache:
+        return cache[key]
+
+    coords = torch.stack(
         torch.meshgrid(
-            torch.arange(output_shape[1], device=device),
-            torch.arange(output_shape[0], device=device),
+            torch.arange(output_shape[1], device=device, dtype=dtype),
+            torch.arange(output_shape[0], device=device, dtype=dtype),
             indexing='xy',
         ),
         dim=-1,
-    ).float()
-    new_coords_homog = ptu3d.to_homogeneous(new_coords)
-    old_coords_homog = torch.einsum('hwc,Cc->hwC', new_coords_homog, new_invprojmat)
-    old_coords_homog = ptu3d.to_homogeneous(
-        distort_points(ptu3d.project(old_coords_homog), distortion_coeffs)
     )
-    old_coords = torch.einsum('hwc,Cc->hwC', old_coords_homog, intrinsic_matrix)[..., :2]
-    size = torch.tensor([image.shape[2], image.shape[1]], dtype=old_coords.dtype, device=device)
-    old_coords_normalized = old_coords.mul_(2.0 / (size - 1)).sub_(1.0)
-    return F.grid_sample(
-        image.unsqueeze(0),
-        old_coords_normalized.unsqueeze(0).to(image.dtype),
+    template = ptu3d.to_homogeneous(coords).reshape(-1, 3)
+    if cache is not None:
+        cache[key] = template
+    return template
+
+
+def sample_crops(
+    images: torch.Tensor,
+    grids: torch.Tensor,
+    image_ids: torch.Tensor,
+    max_padding_factor: float = 2.0,
+):
+    """Bilinearly samples crops from a batch of images with few grid_sample calls.
+
+    Crops coming from the same image are laid out below each other in one tall sampling grid.
+    When the images have different numbers of crops, the missing slots are filled with
+    coordinates far outside the image, which only sample the zero padding. If this padding
+    would make the sampled area more than max_padding_factor times the area of the crops (e.g.,
+    when most of the images have no crops, or one image has many more than the others), each
+    image with crops is sampled with a separate call instead.
+
+    Args:
+        images: the source images, shape [B, C, H, W]
+        grids: the sampling grids, as returned by make_sampling_grids, shape [N, h, w, 2]
+        image_ids: the index of the source image for each crop, shape [N]
+        max_padding_factor: the largest allowed ratio of padded slots to crops
+
+    Returns:
+        The crops, shape [N, C, h, w].
+    """
+    n_images = images.shape[0]
+    n_channels = images.shape[1]
+    n_crops = grids.shape[0]
+    h = grids.shape[1]
+    w = grids.shape[2]
+
+    if n_images == 1:
+        crops = F.grid_sample(
+            images,
+            grids.reshape(1, n_crops * h, w, 2).to(images.dtype),
+            align_corners=True,
+            mode='bilinear',
+            padding_mode='zeros',
+        )
+        return crops.reshape(n_channels, n_crops, h, w).transpose(0, 1)
+
+    image_ids = image_ids.long()
+    counts = torch.bincount(image_ids, minlength=n_images)
+    n_slots = int(torch.max(counts))
+    if n_images * n_slots > max_padding_factor * n_crops:
+        crops = torch.empty((n_crops, n_channels, h, w), dtype=images.dtype, device=images.device)
+        for i_image in torch.nonzero(counts).squeeze(1).tolist():
+            crop_indices = torch.nonzero(image_ids == i_image).squeeze(1)
+            crops[crop_indices] = sample_crops(
+                images[i_image : i_image + 1], grids[crop_indices], image_ids[crop_indices]
+            )
+        return crops
+
+    # Find out the slot of each crop among the crops of its image
+    sorted_image_ids, order = torch.sort(image_ids, stable=True)
+    first_indices = torch.cumsum(counts, dim=0) - counts
+    slots = torch.empty_like(image_ids)
+    slots[order] = torch.arange(n_crops, device=image_ids.device) - first_indices[sorted_image_ids]
+    grid_buffer = torch.full(
+        (n_images, n_slots, h, w, 2), -4.0, dtype=images.dtype, device=images.device
+    )
+    grid_buffer[image_ids, slots] = grids.to(images.dtype)
+    crops = F.grid_sample(
+        images,
+        grid_buffer.reshape(n_images, n_slots * h, w, 2),
         align_corners=True,
         mode='bilinear',
         padding_mode='zeros',
-    ).squeeze(0)
+    )
+    return crops.reshape(n_images, n_channels, n_slots, h, w)[image_ids, :, slots]
+
+
+def distort_points_batched(undist_points2d: torch.Tensor, distortion_coeffs: torch.Tensor):
+    """Like distort_points, but with separate distortion coefficients for each item of the
+    batch (first axis). Items with all-zero coefficients are passed through unchanged, just
+    as distort_points would do when called for those items alone."""
+    is_undistorted = torch.all(distortion_coeffs == 0, dim=-1)
+    if torch.all(is_undistorted):
+        return undist_points2d
+
+    distorted = distort_points(undist_points2d, distortion_coeffs)
+    is_undistorted = torch.reshape(is_undistorted, [-1] + [1] * (undist_points2d.ndim - 1))
+    return torch.where(is_undistorted, undist_points2d, distorted)
 
 
 def distort_points(undist_points2d: torch.Tensor, distortion_coeffs: torch.Tensor):
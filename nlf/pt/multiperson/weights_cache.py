@@ -0,0 +1,71 @@
+import hashlib
+import os
+import os.path as osp
+
+import numpy as np
+import torch
+
+from nlf.pt import ptu
+
+WEIGHT_NAMES = ('w_tensor', 'b_tensor', 'w_tensor_flipped', 'b_tensor_flipped')
+
+
+class WeightsCache:
+    """On-disk cache of the localizer field weights for sets of canonical points.
+
+    Evaluating the weight field for thousands of points (plus their flipped versions) takes
+    noticeable time, and inference scripts do it on every launch. This cache stores the result
+    as one .npy file per weight tensor, in a subdirectory named by a hash of the model file,
+    the canonical points and the dtype.
+
+    By default, the cache directory is placed next to the model file.
+    """
+
+    def __init__(self, model_path, cache_dir=None):
+        self.model_path = model_path
+        self.cache_dir = cache_dir if cache_dir is not None else f'{model_path}.weights_cache'
+        # The model file is identified by its path, size and modification time, which is much
+        # cheaper than hashing the whole checkpoint.
+        stat = os.stat(model_path)
+        self.model_id = f'{osp.abspath(model_path)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+    def key(self, canonical_points, dtype):
+        hasher = hashlib.sha1()
+        hasher.update(self.model_id.encode('utf8'))
+        points = canonical_points.detach().to('cpu', torch.float32).contiguous().numpy()
+        hasher.update(str(points.shape).encode('utf8'))
+        hasher.update(points.tobytes())
+        hasher.update(str(dtype).encode('utf8'))
+        return hasher.hexdigest()
+
+    def get(self, canonical_points, compute_fn, dtype=torch.float16):
+        """Returns the weights for the canonical points, computing them with
+        compute_fn(canonical_points) and storing them if they are not in the cache yet."""
+        entry_dir = f'{self.cache_dir}/{self.key(canonical_points, dtype)}'
+        device = canonical_points.device
+        if all(osp.exists(f'{entry_dir}/{name}.npy') for name in WEIGHT_NAMES):
+            return {
+                name: torch.from_numpy(np.load(f'{entry_dir}/{name}.npy')).to(device, dtype)
+                for name in WEIGHT_NAMES
+            }
+
+        weights = compute_fn(canonical_points)
+        os.makedirs(entry_dir, exist_ok=True)
+        for name in WEIGHT_NAMES:
+            # Write to a temporary file first, so that concurrent readers never see partial files
+            tmp_path = f'{entry_dir}/{name}.tmp{os.getpid()}.npy'
+            np.save(tmp_path, weights[name].detach().to('cpu', dtype).numpy())
+            os.replace(tmp_path, f'{entry_dir}/{name}.npy')
+        return {name: weights[name].to(dtype) for name in WEIGHT_NAMES}
+
+
+def get_weights_for_canonical_points(model, model_path, canonical_points, cache_dir=None):
+    """Cached version of model.get_weights_for_canonical_points for a loaded MultipersonNLF."""
+    cache = WeightsCache(model_path, cache_dir)
+    # Models saved before the compute_dtype setting existed always used float16
+    compute_dtype = getattr(model, 'compute_dtype', 'float16')
+    return cache.get(
+        canonical_points,
+        model.get_weights_for_canonical_points,
+        dtype=ptu.dtype_from_name(compute_dtype),
+    )
@@ -184,3 +184,20 @@ def ramp_function(x: float, start: float, length: float) -> float:
         return (x - start) / length
     else:
         return 1.0
+
+
+def dtype_from_name(name: str) -> torch.dtype:
+    if name == 'float16':
+        return torch.float16
+    elif name == 'bfloat16':
+        return torch.bfloat16
+    elif name == 'float32':
+        return torch.float32
+    else:
+        raise ValueError(f'Unsupported compute dtype: {name}')
+
+
+def default_compute_dtype(device: str) -> str:
+    # float16 convolutions and matmuls are emulated on CPU and much slower than float32.
+    # bfloat16 is only fast on CPUs with native support, see benchmarks/compute_dtype.py.
+    return 'float16' if torch.device(device).type == 'cuda' else 'float32'